@@ -0,0 +1,220 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the cost of @match dispatch for representative dispatchers:
+dispatch on scalar types, on string values, on varargs patterns using
+many() and opt(), on methods, and on nested tuple and list patterns.
+
+    python benchmarks/match.py [--json] [iterations]
+
+For each dispatcher this reports calls per second, and the garbage
+collected objects a call allocates. Python 2 has no allocation hook,
+so this is approximated by the gc allocation counter: the peak number
+of new objects alive at once during a call, sampled at every function
+call and return (objects reused from free lists, like frames and
+tuples, aren't always counted). The objects a call leaves behind are
+counted exactly, and should be zero once any caches are warm. With
+--json the results are written to stdout as json, for tracking
+regressions.
+"""
+
+import gc, json, os, platform, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from forge.match import match, many, opt
+
+class Node(object):
+    pass
+
+class Leaf(Node):
+    pass
+
+@match(int)
+def scalar(x):
+    return "int"
+
+@match(float)
+def scalar(x):
+    return "float"
+
+@match(basestring)
+def scalar(x):
+    return "string"
+
+@match(None)
+def scalar(x):
+    return "none"
+
+@match(Node)
+def scalar(x):
+    return "node"
+
+@match("str")
+def tag(name):
+    return "string"
+
+@match("int")
+def tag(name):
+    return "integer"
+
+@match("float")
+def tag(name):
+    return "float"
+
+@match("bool")
+def tag(name):
+    return "boolean"
+
+@match("null")
+def tag(name):
+    return "null"
+
+@match(basestring)
+def tag(name):
+    return name
+
+@match(many(int))
+def varargs(*ints):
+    return "ints"
+
+@match(basestring, opt(int))
+def varargs(name, count=1):
+    return "name"
+
+@match(many(basestring, min=2))
+def varargs(*names):
+    return "names"
+
+@match(Node, many(basestring), opt(dict))
+def varargs(node, *rest):
+    return "node"
+
+class Schema(object):
+
+    @match(Node)
+    def load(self, node):
+        return "node"
+
+    @match(basestring)
+    def load(self, name):
+        return "file"
+
+    @match(basestring, basestring)
+    def load(self, name, content):
+        return "content"
+
+class Scalar(Schema):
+
+    @match(Leaf)
+    def load(self, node):
+        return "leaf"
+
+SCHEMA = Scalar()
+
+@match((basestring, int))
+def nested(pair):
+    return "pair"
+
+@match([many((basestring, int))])
+def nested(pairs):
+    return "pairs"
+
+@match((Node, [many(Node)]))
+def nested(tree):
+    return "tree"
+
+@match([many(int)], opt((basestring, basestring)))
+def nested(ints, labels=None):
+    return "ints"
+
+CASES = (
+    ("types", scalar, [(1,), (1.5,), ("a",), (None,), (Node(),), (Leaf(),), (u"b",), (2,)]),
+    ("values", tag, [("str",), ("int",), ("float",), ("bool",), ("null",), ("timestamp",), ("binary",), ("str",)]),
+    ("varargs", varargs, [(), (1,), (1, 2, 3), ("a",), ("a", 2), ("a", "b", "c"), (Leaf(), "a", "b"),
+                          (Node(), "a", {})]),
+    ("method", SCHEMA.load, [(Node(),), (Leaf(),), ("service.yaml",), ("service.yaml", "name: a")]*2),
+    ("nested", nested, [(("a", 1),), ([("a", 1), ("b", 2)],), ((Node(), [Leaf(), Node()]),), ([1, 2, 3],),
+                        ([1, 2], ("x", "y")), ([("c", 3)],)]),
+)
+
+def calls(fn, args):
+    for a in args:
+        fn(*a)
+
+def noop(*args):
+    pass
+
+def objects(fn, args):
+    """
+    Return the peak number of new gc objects alive at once during a
+    call, and the number left alive after it, averaged over args and
+    less the objects the measurement itself allocates.
+    """
+    peak, retained = _objects(fn, args)
+    base_peak, base_retained = _objects(noop, args)
+    return max(0.0, peak - base_peak), max(0.0, retained - base_retained)
+
+def _objects(fn, args):
+    peak = [0]
+    def sample(frame, event, arg):
+        peak[0] = max(peak[0], gc.get_count()[0] - base)
+    gc.collect()
+    gc.disable()
+    try:
+        peaks = 0
+        before = len(gc.get_objects())
+        for a in args:
+            peak[0] = 0
+            base = gc.get_count()[0]
+            sys.setprofile(sample)
+            try:
+                fn(*a)
+            finally:
+                sys.setprofile(None)
+            peaks += peak[0]
+        retained = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    return float(peaks)/len(args), float(retained)/len(args)
+
+def main(args):
+    output = "--json" in args
+    args = [a for a in args if a != "--json"]
+    iterations = int(args[0]) if args else 2000
+
+    results = []
+    for name, fn, arguments in CASES:
+        # warm up any caches before measuring
+        calls(fn, arguments)
+        elapsed = min(timeit.repeat(lambda: calls(fn, arguments), number=iterations, repeat=5))
+        peak, retained = objects(fn, arguments)
+        results.append({"name": name,
+                        "ops_per_sec": iterations*len(arguments)/elapsed,
+                        "peak_objects_per_call": peak,
+                        "retained_objects_per_call": retained})
+
+    if output:
+        json.dump({"python": platform.python_version(), "iterations": iterations, "results": results},
+                  sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        print "%-10s %12s %12s %12s" % ("", "calls/s", "peak objs", "retained")
+        for r in results:
+            print "%-10s %12.1f %12.1f %12.1f" % (r["name"], r["ops_per_sec"], r["peak_objects_per_call"],
+                                                 r["retained_objects_per_call"])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
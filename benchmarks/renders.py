@@ -0,0 +1,71 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare rendering a service.yaml with a freshly compiled template, as
+renders used to, against the compiled template cache.
+
+    python benchmarks/renders.py [iterations]
+"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from jinja2 import Template
+from forge import jinja2
+
+SERVICE_YAML = """
+name: {{env.SERVICE_NAME | default("hello")}}
+requires:
+{% for dep in env.get("DEPENDENCIES", "auth,db,cache").split(",") %}
+  - {{dep}}
+{% endfor %}
+containers:
+  - dockerfile: Dockerfile
+    context: .
+    args:
+      BRANCH: {{branch}}
+profiles:
+  default:
+    replicas: {{env.REPLICAS | default(1)}}
+  {% for name in ["canary", "stable", "staging"] %}
+  {{name}}:
+    endpoint: /{{name}}
+    {% if name == "stable" %}
+    replicas: 3
+    {% endif %}
+  {% endfor %}
+istio: {{env.ISTIO | default(false)}}
+"""
+
+VARIABLES = {"env": {"SERVICE_NAME": "bench", "REPLICAS": "2"}, "branch": "master"}
+
+def uncached():
+    return Template(SERVICE_YAML, undefined=jinja2.WarnUndefined).render(**VARIABLES)
+
+def cached():
+    return jinja2.template(SERVICE_YAML).render(**VARIABLES)
+
+def main(iterations):
+    assert uncached() == cached()
+    results = []
+    for name, fn in ("uncached", uncached), ("cached", cached):
+        elapsed = min(timeit.repeat(fn, number=iterations, repeat=3))
+        results.append(elapsed)
+        print "%-10s %8.1f renders/s" % (name, iterations/elapsed)
+    print "speed-up   %8.1fx" % (results[0]/results[1])
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,85 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare loading composed yaml through the dispatched schema load
+methods against the compiled loaders, for a small service.yaml, a
+large one, and a forge.yaml with many profiles.
+
+    python benchmarks/schema.py [iterations]
+"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from forge import config, service_info
+from forge.yamlbackend import compose
+
+SMALL = """
+name: hello
+requires: [auth, db]
+containers:
+  - dockerfile: Dockerfile
+    context: .
+profiles:
+  default: {replicas: 1}
+"""
+
+CONTAINER = """
+  - dockerfile: svc%(i)d/Dockerfile
+    name: svc%(i)d
+    context: svc%(i)d
+    args: {BRANCH: master, VERSION: %(i)d, RATIO: 0.5}
+    builder: docker
+    rebuild:
+      root: /src
+      command: make
+      sources: [src, Makefile, setup.py]
+"""
+
+PROFILE = """
+  profile%(i)d:
+    replicas: %(i)d
+    endpoint: /profile%(i)d
+    resources: {cpu: 100m, memory: 128Mi}
+    env: [{name: A, value: "1"}, {name: B, value: two}]
+"""
+
+LARGE = "name: large\nrequires: [auth, db, cache]\ncontainers:\n%s\nprofiles:\n%s\nconfig:\n  rows:\n%s" % (
+    "".join(CONTAINER % {"i": i} for i in range(50)),
+    "".join(PROFILE % {"i": i} for i in range(50)),
+    "".join("  - {id: %d, name: row%d, weight: %d.5, enabled: true}\n" % (i, i, i) for i in range(500)))
+
+FORGE_YAML = "registry: {type: docker, url: registry.example.com, namespace: forge}\nprofiles:\n%s" % \
+    "".join("  p%d:\n    search-path: [a, b, c]\n    registry: {type: gcr, url: gcr.io, project: p%d}\n" % (i, i)
+            for i in range(100))
+
+CASES = (("small", service_info.SERVICE, SMALL),
+         ("large", service_info.SERVICE, LARGE),
+         ("forge.yaml", config.CONFIG, FORGE_YAML))
+
+def main(iterations):
+    print "%-12s %12s %12s %8s" % ("", "dispatch/s", "compiled/s", "speed-up")
+    for name, schema, content in CASES:
+        node = compose(content)
+        number = max(1, iterations*1000/len(content))
+        rates = []
+        for load in schema.load, schema.compile():
+            elapsed = min(timeit.repeat(lambda: load(node), number=number, repeat=3))
+            rates.append(number/elapsed)
+        print "%-12s %12.1f %12.1f %7.1fx" % (name, rates[0], rates[1], rates[1]/rates[0])
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
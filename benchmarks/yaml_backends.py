@@ -0,0 +1,128 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the python and libyaml yaml backends on the work forge does
+with yaml: composing rendered manifests, streaming them as events, and
+loading service descriptors through their schema.
+
+    python benchmarks/yaml_backends.py [iterations]
+"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from forge import service_info, yamlbackend
+
+DEPLOYMENT = """---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: svc-%(i)d
+  labels: {forge.service: svc-%(i)d, forge.profile: default}
+  annotations: {forge.repo: "https://github.com/example/svc.git", forge.version: 1234abcd.git}
+spec:
+  replicas: 3
+  selector:
+    matchLabels: {app: svc-%(i)d}
+  template:
+    metadata:
+      labels: {app: svc-%(i)d}
+    spec:
+      containers:
+      - name: svc-%(i)d
+        image: registry.example.com/svc-%(i)d:1234abcd.git
+        ports:
+        - containerPort: 8080
+        env:
+        - name: LOG_LEVEL
+          value: "info"
+        - name: DATABASE_URL
+          value: postgres://db:5432/svc
+        resources:
+          limits: {cpu: "1", memory: 512Mi}
+          requests: {cpu: 100m, memory: 128Mi}
+        readinessProbe:
+          httpGet: {path: /health, port: 8080}
+          initialDelaySeconds: 5
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: svc-%(i)d
+  annotations:
+    getambassador.io/config: |
+      ---
+      apiVersion: ambassador/v0
+      kind: Mapping
+      name: svc-%(i)d-mapping
+      prefix: /svc-%(i)d/
+      service: svc-%(i)d
+spec:
+  selector: {app: svc-%(i)d}
+  ports:
+  - {port: 80, targetPort: 8080}
+"""
+
+# a manifest stream for a deployment of 50 services
+MANIFESTS = "".join(DEPLOYMENT % {"i": i} for i in range(50))
+
+DESCRIPTOR = """
+name: hello
+requires:
+  - auth
+  - db
+containers:
+  - dockerfile: Dockerfile
+    context: .
+    args:
+      BRANCH: master
+  - dockerfile: sidecar/Dockerfile
+    name: sidecar
+profiles:
+  default:
+    replicas: 1
+  canary:
+    endpoint: /canary
+  stable:
+    endpoint: /stable
+    replicas: 3
+istio: false
+"""
+
+def compose():
+    return yamlbackend.compose_all(MANIFESTS)
+
+def stream():
+    return sum(1 for _ in yamlbackend.parse(MANIFESTS))
+
+def descriptor():
+    return service_info.load("service.yaml", DESCRIPTOR)
+
+def main(iterations):
+    if yamlbackend.CLoader is None:
+        print "libyaml is not available, nothing to compare"
+        return
+    print "%-12s %12s %12s %8s" % ("", "python/s", "libyaml/s", "speed-up")
+    for name, fn, number in ("compose", compose, 1), ("stream", stream, 1), ("descriptor", descriptor, 50):
+        rates = []
+        for backend in "python", "libyaml":
+            yamlbackend.BACKEND = backend
+            elapsed = min(timeit.repeat(fn, number=iterations*number, repeat=3))
+            rates.append(iterations*number/elapsed)
+        print "%-12s %12.1f %12.1f %7.1fx" % (name, rates[0], rates[1], rates[1]/rates[0])
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -30,7 +30,7 @@ from dotenv import find_dotenv, load_dotenv
 import util
 from . import __version__
 from .core import Forge
-from .kubernetes import Kubernetes
+from .kubernetes import DELETE_LIMIT, ROLLOUT_TIMEOUT, SYNC_INTERVAL, Kubernetes
 from collections import OrderedDict
 
 ENV = find_dotenv(usecwd=True)
@@ -42,11 +42,21 @@ if ENV: load_dotenv(ENV)
 @click.option('--config', envvar='FORGE_CONFIG', type=click.Path(exists=True))
 @click.option('--profile', envvar='FORGE_PROFILE')
 @click.option('--branch', envvar='FORGE_BRANCH')
+@click.option('--push-limit', envvar='FORGE_PUSH_LIMIT', type=click.INT, default=4,
+              help="Maximum number of concurrent image pushes.")
+@click.option('--cache-credentials', envvar='FORGE_CACHE_CREDENTIALS', is_flag=True,
+              help="Reuse short-lived registry tokens between runs.")
+@click.option('--kube-backend', envvar='FORGE_KUBE_BACKEND', type=click.Choice(['kubectl', 'api']),
+              default='kubectl', help="Access kubernetes by running kubectl, or through its API directly.")
 @click.pass_context
-def forge(context, verbose, config, profile, branch):
+def forge(context, verbose, config, profile, branch, push_limit, cache_credentials, kube_backend):
     context.obj = Forge(verbose=verbose, config=config,
                         profile=None if profile is None else str(profile),
-                        branch=None if branch is None else str(branch))
+                        branch=None if branch is None else str(branch),
+                        push_limit=push_limit,
+                        credential_cache=(os.path.expanduser("~/.forge/credentials.json")
+                                          if cache_credentials else None),
+                        kube_backend=kube_backend)
 
 @forge.command()
 @click.pass_obj
@@ -168,16 +178,42 @@ def manifests(forge):
 @click.option('-n', '--namespace', envvar='K8S_NAMESPACE', type=click.STRING)
 @click.option('--dry-run', is_flag=True, help="Run through the deploy steps without making changes.")
 @click.option('--prune', is_flag=True, help="Prune any resources not in the manifests.")
-def deploy(forge, namespace, dry_run, prune):
+@click.option('--batch', is_flag=True, help="Apply the manifests of all services together once they are built.")
+@click.option('--force-apply', is_flag=True, help="Apply all resources, even those that are unchanged.")
+@click.option('--wait', is_flag=True, help="Wait for the rollout of the deployed resources to finish.")
+@click.option('--timeout', type=click.IntRange(1), default=ROLLOUT_TIMEOUT,
+              help="How many seconds to wait for the rollout with --wait.")
+def deploy(forge, namespace, dry_run, prune, batch, force_apply, wait, timeout):
     """
     Build and deploy a service.
 
     They deploy command performs a `forge build` and then applies the
     resulting deployment manifests using `kubectl apply`.
+
+    With `--batch` the manifests of all the services are applied
+    together once everything is built, using a single `kubectl apply`
+    (or one per profile when pruning).
+
+    Resources whose `forge.manifest-hash` annotation matches the live
+    resource are not applied again unless `--force-apply` is given.
+
+    With `--wait` the command finishes only once the rollout of every
+    deployed deployment, statefulset and daemonset is complete, and
+    fails if a rollout fails or doesn't finish within `--timeout`.
     """
     forge.namespace = namespace
     forge.dry_run = dry_run
-    forge.execute(lambda svc: forge.deploy(*forge.build(svc), prune=prune))
+    forge.force_apply = force_apply
+    def finish(results):
+        if wait:
+            forge.wait(timeout)
+    if batch:
+        def deploy_all(builds):
+            forge.deploy_all(builds, prune=prune)
+            finish(builds)
+        forge.execute(forge.build, deploy_all)
+    else:
+        forge.execute(lambda svc: forge.deploy(*forge.build(svc), prune=prune), finish)
 
 @forge.command()
 @click.pass_obj
@@ -247,8 +283,10 @@ def match(name, pattern):
 @click.pass_obj
 @click.argument("service_pattern", required=False)
 @click.argument("profile_pattern", required=False)
+@click.option("--max-age", envvar="FORGE_MAX_AGE", type=float,
+              help="Use a snapshot of the cluster up to this many seconds old.")
 @task()
-def list(forge, service_pattern, profile_pattern):
+def list(forge, service_pattern, profile_pattern, max_age):
     """
     List deployed forge services.
 
@@ -260,12 +298,15 @@ def list(forge, service_pattern, profile_pattern):
 
     You can use shell-style pattern matching for either the service or
     the profile in order to filter what is printed.
+
+    With `--max-age` a snapshot of the cluster is used if there is one
+    that is recent enough, see `forge cache`.
     """
     bold = forge.terminal.bold
     red = forge.terminal.bold_red
 
-    kube = Kubernetes()
-    repos = kube.list()
+    kube = Kubernetes(backend=forge.kube_backend)
+    repos = kube.list(max_age=max_age)
     first = True
     for repo, service, profile, resources in unfurl(repos):
 
@@ -297,8 +338,13 @@ def list(forge, service_pattern, profile_pattern):
 @click.argument("service", required=False)
 @click.argument("profile", required=False)
 @click.option("--all", is_flag=True, help="Delete all services.")
+@click.option("--limit", type=click.IntRange(1), default=DELETE_LIMIT,
+              help="The maximum number of namespaces to delete from at once.")
+@click.option("--wait", is_flag=True, help="Wait for the deleted resources to go away.")
+@click.option("--max-age", envvar="FORGE_MAX_AGE", type=float,
+              help="Check the service exists against a snapshot of the cluster up to this many seconds old.")
 @task()
-def delete(forge, service, profile, all):
+def delete(forge, service, profile, all, limit, wait, max_age):
     """
     Delete (undeploy) k8s resources associated with a given profile or service.
 
@@ -309,6 +355,9 @@ def delete(forge, service, profile, all):
     `--all` option is supplied then all forge deployed resources are
     removed from the entire cluster.
 
+    Namespaces are deleted from concurrently, and finalizers aren't
+    waited for unless `--wait` is given.
+
     """
 
     if all and (service or profile):
@@ -321,10 +370,10 @@ def delete(forge, service, profile, all):
         "forge.service": service
     }
 
-    kube = Kubernetes()
+    kube = Kubernetes(backend=forge.kube_backend)
 
     if not all:
-        repos = kube.list()
+        repos = kube.list(max_age=max_age)
         services = set()
         profiles = set()
         for r, svc, prof, _ in unfurl(repos):
@@ -342,7 +391,28 @@ def delete(forge, service, profile, all):
         labels["forge.profile"] = profile
 
     with task.verbose(True):
-        kube.delete(labels)
+        kube.delete(labels, limit=limit, wait=wait)
+
+@forge.command()
+@click.pass_obj
+@click.option("--interval", type=float, default=SYNC_INTERVAL,
+              help="How often (in seconds) to save the snapshot.")
+@task()
+def cache(forge, interval):
+    """
+    Keep a snapshot of the forge deployed resources in the cluster.
+
+    The cache command runs until interrupted, keeping a local snapshot
+    of the forge deployed resources in the cluster up to date and
+    saving it every `--interval` seconds. With the api backend each
+    kind is listed once and then watched for changes, with kubectl
+    everything is listed again each interval.
+
+    Run it in the background and use `forge list --max-age` to query
+    the snapshot rather than the cluster.
+    """
+    kube = Kubernetes(backend=forge.kube_backend)
+    kube.sync(interval)
 
 def call_main():
     util.setup_yaml()
@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64, config, getpass, os, sys, util, yaml
+import base64, config, getpass, os, shutil, sys, tempfile, util, yaml
 from collections import OrderedDict
 
 from .output import Terminal
@@ -24,12 +24,12 @@ from .tasks import (
     TaskError
 )
 
-from .docker import Docker, GCRDocker, ECRDocker, LocalDocker
-from .kubernetes import Kubernetes
+from .docker import Docker, GCRDocker, ECRDocker, LocalDocker, PushScheduler, LOGINS
+from .kubernetes import HASH, Kubernetes, applied, resource_key
 from .service import Discovery, Service
 
 from .jinja2 import renders
-from .istio import istio
+from .manifest import Manifests, RenderStamp, render_key, sync_tree
 
 from scout import Scout
 from . import __version__
@@ -41,15 +41,21 @@ SETUP_TEMPLATE = """# Global forge configuration
 
 class Forge(object):
 
-    def __init__(self, verbose=0, config=None, profile=None, branch=None):
+    def __init__(self, verbose=0, config=None, profile=None, branch=None, push_limit=None, credential_cache=None,
+                 kube_backend="kubectl"):
         self.verbose = verbose
         self.config = config or util.search_parents("forge.yaml")
         self.profile = profile
         self.branch = branch
         self.namespace = None
         self.dry_run = False
+        self.force_apply = False
+        self.kube_backend = kube_backend
         self.terminal = Terminal()
         self.discovery = Discovery(self)
+        self.pusher = PushScheduler(push_limit)
+        if credential_cache:
+            LOGINS.path = credential_cache
 
         self.baked = []
         self.pushed = []
@@ -210,39 +216,71 @@ class Forge(object):
     @task()
     def push(self, service):
         unpushed = list(cull(lambda c: service.docker.needs_push(c.image, c.version), service.containers))
+        # schedule images with fewer layers first so that base layers
+        # are uploaded before the images that build on top of them
+        layers = dict((c.index, service.docker.layers(c.image, c.version)) for c in unpushed)
+        unpushed.sort(key=lambda c: len(layers[c.index]))
 
-        pushed = []
-        for container in unpushed:
-            with task.verbose(True):
-                pushed.append((container, service.docker.push(container.image, container.version)))
+        pushes = []
+        with task.verbose(True):
+            for container in unpushed:
+                pushes.append((container, self.pusher.schedule(service.docker, container.image, container.version,
+                                                               layers[container.index])))
 
         task.sync()
-        self.pushed.extend(pushed)
-
-    def template(self, svc):
-        svc.deployment()
-        k8s_dir = svc.manifest_target_dir
-        return k8s_dir, self.kube.resources(k8s_dir)
+        self.pushed.extend((container, push.get()) for container, push in pushes)
 
     @task()
     def manifest(self, service):
-        k8s_dir, resources = self.template(service)
+        """
+        Render and post-process the manifests for a service. Nothing is
+        done if the templates, metadata, labels, annotations and istio
+        configuration are all unchanged since the last time, and
+        otherwise only output files whose content changed are written.
+        """
+        k8s_dir = service.manifest_target_dir
+
         istio_config = service.info().get("istio", {})
         istioify = istio_config.get("enabled", False)
         ipranges = istio_config.get("includeIPRanges", None)
 
-        if istioify:
-            istio(k8s_dir, ipranges)
-
         labels = OrderedDict()
         labels["forge.service"] = service.name
         labels["forge.profile"] = service.profile
-        self.kube.label(k8s_dir, labels)
         anns = OrderedDict()
         anns["forge.repo"] = service.repo or ""
         anns["forge.descriptor"] = service.rel_descriptor
         anns["forge.version"] = service.version
-        self.kube.annotate(k8s_dir, anns)
+
+        stamp = RenderStamp(k8s_dir)
+        key = render_key(service.manifest_dir, service.metadata(), labels, anns, istio_config)
+        resources = stamp.get(key)
+        if resources is not None:
+            task.info("manifests: unchanged")
+        else:
+            stamp.clear()
+            parent = os.path.dirname(k8s_dir)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            staging = tempfile.mkdtemp(prefix=".%s-" % service.name, dir=parent)
+            try:
+                manifests = Manifests(staging)
+                env = util.RecordingEnv(os.environ)
+                with manifests.stage("render"):
+                    service.deployment(staging, env)
+
+                manifests.load()
+                resources = manifests.resources()
+                if istioify:
+                    manifests.inject(ipranges)
+                manifests.fixup(labels, anns)
+                manifests.write()
+                with manifests.stage("sync"):
+                    changed = sync_tree(staging, k8s_dir)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            stamp.put(key, resources, env)
+            task.info("manifests: %s, %d file(s) changed" % (manifests.report(), len(changed)))
 
         task.sync()
         self.rendered.append((service, k8s_dir, resources))
@@ -261,6 +299,68 @@ class Forge(object):
         task.sync()
         self.deployed.append((service, k8s_dir))
 
+    @task()
+    def deploy_all(self, builds, prune=False):
+        """
+        Deploy the output of several builds with as few kubectl
+        invocations as possible. When pruning, services are grouped by
+        profile so that the prune selector covers exactly the services
+        being deployed, otherwise everything is applied at once.
+        """
+        resources = dict((k8s_dir, r) for s, k8s_dir, r in self.rendered)
+
+        groups = OrderedDict()
+        for service, k8s_dir in builds:
+            groups.setdefault(service.profile if prune else None, []).append((service, k8s_dir))
+
+        @task(context="{0}")
+        def check(name, rendered, statuses, errors):
+            missing = [r for r in rendered if resource_key(r) not in statuses]
+            if missing:
+                quoted = ['"%s"' % resource_key(r)[1] for r in missing]
+                relevant = [e for e in errors if any(q in e for q in quoted)] or errors
+                raise TaskError("failed to apply %s:\n%s" % (", ".join(missing), "\n".join(relevant)))
+            for r in rendered:
+                task.info("%s %s" % (r, statuses[resource_key(r)]))
+
+        @task(context="forge")
+        def apply(profile, group):
+            if prune:
+                names = [s.name for s, k in group]
+                labels = {"forge.service": names if len(names) > 1 else names[0], "forge.profile": profile}
+            else:
+                labels = None
+            result, skipped = self.kube.apply_all([k for s, k in group], prune=labels)
+            statuses, errors = applied(result.output)
+            for _, kind, _, name in skipped:
+                statuses[(kind, name)] = "unchanged (%s)" % HASH
+            checks = [(service, k8s_dir, check.go(service.name, resources.get(k8s_dir, []), statuses, errors))
+                      for service, k8s_dir in group]
+            for service, k8s_dir, r in checks:
+                r.wait()
+                if r.value is not ERROR:
+                    self.deployed.append((service, k8s_dir))
+
+        with task.verbose(True):
+            for profile, group in groups.items():
+                apply.go(profile, group)
+            task.sync()
+
+    @task(context="forge")
+    def wait(self, timeout):
+        """
+        Wait for the rollout of everything that was deployed.
+        """
+        if self.dry_run or not self.deployed:
+            return
+        resources = dict((k8s_dir, r) for s, k8s_dir, r in self.rendered)
+        names = []
+        for service, k8s_dir in self.deployed:
+            names.extend(resources.get(k8s_dir, []))
+        services = sorted(set(s.name for s, k in self.deployed))
+        with task.verbose(True):
+            self.kube.wait(names, {"forge.service": services if len(services) > 1 else services[0]}, timeout)
+
     @task()
     def pull(self, service, pulled):
         with task.verbose(True):
@@ -280,7 +380,8 @@ class Forge(object):
         for name, profile in self.profiles.items():
             profile.docker = get_docker(profile.registry)
 
-        self.kube = Kubernetes(namespace=self.namespace, dry_run=self.dry_run)
+        self.kube = Kubernetes(namespace=self.namespace, dry_run=self.dry_run, force_apply=self.force_apply,
+                               backend=self.kube_backend)
 
     def load_services(self):
         start = util.search_parents("service.yaml")
@@ -311,20 +412,31 @@ class Forge(object):
             for container in service.containers:
                 service.docker.clean(container.image)
 
-    def execute(self, goal):
+    def execute(self, goal, finish=None):
+        """
+        Run goal for every service. If finish is supplied it is called
+        once all the goals are done with the results of those that
+        succeeded.
+        """
         self.load_config()
 
         @task(context="{0}")
         def service(name):
             svc = self.discovery.services[name]
-            goal(svc)
+            return goal(svc)
 
         @task(context="forge")
         def root():
             with task.verbose(self.verbose):
                 task.info("CONFIG: %s" % self.config)
-                for name in self.load_services():
-                    service.go(name)
+                results = [service.go(name) for name in self.load_services()]
+                if finish is not None:
+                    done = []
+                    for r in results:
+                        r.wait()
+                        if r.value is not ERROR:
+                            done.append(r.value)
+                    finish(done)
 
         exe = root.run()
         if exe.result is ERROR:
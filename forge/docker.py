@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import base64, boto3, os, urllib2, hashlib
+import base64, boto3, calendar, errno, json, os, sys, time, urllib2, hashlib
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
 from tasks import task, TaskError, get, sh, Secret
 
 
@@ -43,16 +45,127 @@ def image(registry, namespace, name, version):
     parts = (registry, namespace, "%s:%s" % (name, version))
     return "/".join(p for p in parts if p)
 
+class Credential(object):
+
+    def __init__(self, user, password, expires=None):
+        self.user = user
+        self.password = password
+        self.expires = expires
+
+    def expired(self, margin=60):
+        return self.expires is not None and time.time() + margin >= self.expires
+
+    def json(self):
+        return {"user": self.user, "password": self.password, "expires": self.expires}
+
+class LoginManager(object):
+
+    """
+    Tracks registry logins for the whole process. Logins are keyed by
+    registry endpoint and identity, so no matter how many profiles or services
+    point at a registry, the login (and any token fetch it involves)
+    happens once per run, or again when a token expires.
+
+    If a path is supplied, short-lived tokens are persisted there
+    between runs and reused until they expire. A persisted token saves
+    fetching a new one, but whatever uses it (e.g. docker login) is
+    still done once per run, since the docker config it went into
+    may not be the same.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.credentials = {}
+        self.pending = {}
+        self.used = set()
+        self.loaded = False
+
+    def _load(self):
+        if self.loaded or not self.path:
+            return
+        self.loaded = True
+        try:
+            with open(self.path) as fd:
+                saved = json.load(fd)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        except ValueError:
+            return
+        for key, value in saved.items():
+            cred = Credential(value["user"], value["password"], value["expires"])
+            if key not in self.credentials and not cred.expired():
+                self.credentials[key] = cred
+
+    def _save(self):
+        if not self.path:
+            return
+        saved = dict((k, c.json()) for k, c in self.credentials.items() if c.expires is not None and not c.expired())
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(saved, f)
+
+    def login(self, key, login, use=None):
+        """
+        Return the credential for the given key, invoking login to
+        acquire it if there is no valid credential yet, and passing it
+        to use if it hasn't been used in this run yet. Concurrent
+        logins for the same key wait for the first one to finish.
+        """
+        self._load()
+        cred = self.credentials.get(key)
+        valid = cred is not None and not cred.expired()
+        if valid and key in self.used:
+            return cred
+        if key in self.pending:
+            return self.pending[key].wait()
+
+        event = Event()
+        self.pending[key] = event
+        try:
+            if not valid:
+                cred = login()
+            if use is not None:
+                use(cred)
+        except:
+            exc_info = sys.exc_info()
+            del self.pending[key]
+            event.send_exception(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.credentials[key] = cred
+        self.used.add(key)
+        del self.pending[key]
+        if not valid and cred.expires is not None:
+            self._save()
+        event.send(cred)
+        return cred
+
+LOGINS = LoginManager()
+
 class DockerBase(object):
 
     def __init__(self):
         self.image_cache = {}
-        self.logged_in = False
+
+    @property
+    def login_key(self):
+        return self.registry
 
     def _login(self):
-        if not self.logged_in:
-            self._do_login()
-            self.logged_in = True
+        self._use_credential(LOGINS.login(self.login_key, self._do_login, self._docker_login))
+
+    def _do_login(self):
+        return Credential(None, None)
+
+    def _docker_login(self, cred):
+        pass
+
+    def _use_credential(self, cred):
+        pass
 
     @task()
     def local_exists(self, name, version):
@@ -88,6 +201,15 @@ class DockerBase(object):
         sh("docker", "push", img)
         return img
 
+    @task()
+    def layers(self, name, version):
+        """
+        Return the digests of the filesystem layers of a local image.
+        """
+        img = self.image(name, version)
+        output = sh("docker", "inspect", "--format", "{{json .RootFS.Layers}}", img).output
+        return json.loads(output.strip() or "null") or []
+
     @task()
     def build(self, directory, dockerfile, name, version, args, builder=None):
         args = args or {}
@@ -180,6 +302,54 @@ class DockerBase(object):
         return sh("docker", "run", "--rm", "-it", "--entrypoint", cmd, self.image(name, version), *args)
 
 
+class PushScheduler(object):
+
+    """
+    Schedules image pushes so that images sharing filesystem layers
+    are pushed one after another, in the order they were scheduled,
+    while unrelated images are pushed concurrently. Pushing images
+    that share layers sequentially lets the later pushes find (or
+    mount) the blobs uploaded by the earlier ones rather than racing
+    to upload the same blobs.
+
+    The limit bounds the number of pushes running at any one time.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.slots = Semaphore(limit) if limit else None
+        self.tails = {}
+
+    def schedule(self, docker, name, version, layers=None):
+        """
+        Schedule a push of the given image and return the (asynchronous)
+        result of the push. The image layers are looked up with `docker
+        inspect` unless they are supplied.
+        """
+        if layers is None:
+            layers = docker.layers(name, version)
+        waits = []
+        for layer in layers:
+            tail = self.tails.get(layer)
+            if tail is not None and tail not in waits:
+                waits.append(tail)
+        done = Event()
+        for layer in layers:
+            self.tails[layer] = done
+        return self._push.go(docker, name, version, waits, done)
+
+    @task("push")
+    def _push(self, docker, name, version, waits, done):
+        try:
+            for w in waits:
+                w.wait()
+            if self.slots is None:
+                return docker.push(name, version)
+            with self.slots:
+                return docker.push(name, version)
+        finally:
+            done.send()
+
 class Builder(object):
 
     def __init__(self, docker, cid, changes=()):
@@ -207,8 +377,6 @@ class Builder(object):
         sh("docker", "kill", self.cid, expected=(0, 1))
 
 
-import json, base64
-
 class Docker(DockerBase):
 
     def __init__(self, registry, namespace, user, password, verify=True):
@@ -234,13 +402,27 @@ class Docker(DockerBase):
         if not self._run_login and not self.user:
             raise TaskError("unable to locate docker credentials, please run `docker login %s`" % self.registry)
 
+        # profiles can log in to the same registry with different
+        # secrets, so logins are keyed by a digest of the secret too
+        self._secret = hashlib.sha1(self.password or "").hexdigest()[:16]
+
     @task()
     def image(self, name, version):
         return image(self.registry, self.namespace, name, version)
 
+    @property
+    def login_key(self):
+        return "%s@%s#%s" % (self.user, self.registry, self._secret)
+
     def _do_login(self):
+        return Credential(self.user, self.password)
+
+    def _docker_login(self, cred):
         if self._run_login:
-            sh("docker", "login", "-u", self.user, "-p", Secret(self.password), self.registry)
+            sh("docker", "login", "-u", cred.user, "-p", Secret(cred.password), self.registry)
+
+    def _use_credential(self, cred):
+        self.password = cred.password
 
     @task()
     def registry_get(self, api):
@@ -287,16 +469,24 @@ class Docker(DockerBase):
                 return False
         raise TaskError(response.content)
 
+# gcloud doesn't report when an access token expires, they are
+# normally valid for an hour
+GCR_TOKEN_TTL = 45*60
+
 class GCRDocker(Docker):
 
     def __init__(self, url, project, key):
         Docker.__init__(self, url, project, "_json_key" if key else "_token", key)
 
     def _do_login(self):
+        expires = None
         if self.user == "_token":
             self.password = sh("gcloud", "auth", "print-access-token",
                                output_transform = lambda x: "<OUTPUT_ELIDED>").output.strip()
-        Docker._do_login(self)
+            expires = time.time() + GCR_TOKEN_TTL
+        cred = Docker._do_login(self)
+        cred.expires = expires
+        return cred
 
 def _get_account():
     sts = boto3.client('sts')
@@ -316,6 +506,13 @@ class ECRDocker(DockerBase):
         if aws_secret_access_key: kwargs['aws_secret_access_key'] = aws_secret_access_key
         self.ecr = boto3.client('ecr', self.region, **kwargs)
         self.url = "{}.dkr.ecr.{}.amazonaws.com".format(self.account, self.region)
+        # tokens are minted for an AWS identity, so a change of
+        # credentials or profile needs a login of its own
+        self.identity = aws_access_key_id or os.environ.get("AWS_ACCESS_KEY_ID") or boto3.Session().profile_name
+
+    @property
+    def login_key(self):
+        return "%s@%s" % (self.identity, self.url)
 
     @property
     def registry(self):
@@ -330,8 +527,11 @@ class ECRDocker(DockerBase):
         data = response['authorizationData'][0]
         token = data['authorizationToken']
         user, password = base64.decodestring(token).split(":")
-        proxy = data['proxyEndpoint']
-        sh("docker", "login", "-u", user, "-p", Secret(password), proxy)
+        expires = data.get('expiresAt')
+        return Credential(user, password, calendar.timegm(expires.utctimetuple()) if expires else None)
+
+    def _docker_login(self, cred):
+        sh("docker", "login", "-u", cred.user, "-p", Secret(cred.password), "https://%s" % self.url)
 
     @task()
     def image(self, name, version):
@@ -361,6 +561,8 @@ class ECRDocker(DockerBase):
 
 class LocalDocker(DockerBase):
 
+    registry = None
+
     def image(self, name, version):
         return "{}:{}".format(name, version)
 
@@ -13,16 +13,86 @@
 # limitations under the License.
 
 import os
-from .tasks import task, sh
+from .tasks import task, sh, project
+from .yamlutil import MappingNode, MapView, compose, compose_all, serialize_all, view
+
+# a document of this kind separates the files of a batched injection
+# stream, istioctl passes kinds it doesn't know about through as is
+BOUNDARY = "ForgeInjectBoundary"
+
+# the maximum number of concurrent istioctl runs when falling back to
+# per file injection
+INJECT_LIMIT = 4
+
+def _ipranges(cmd, ipranges):
+    if ipranges is not None:
+        cmd.extend(["--includeIPRanges", ",".join(ipranges)])
+    return cmd
 
 @task()
-def istio(directory, ipranges=None):
-    for name in os.listdir(directory):
-        cmd = ["istioctl", "kube-inject", "-f", os.path.join(directory, name)]
+def inject(content, ipranges=None):
+    """
+    Run the supplied yaml through istioctl kube-inject and return the
+    result.
+    """
+    cmd = _ipranges(["istioctl", "kube-inject", "-f", "-"], ipranges)
+    return sh(*cmd, input=content).output
+
+def _boundary(index):
+    return compose("{apiVersion: v1, kind: %s, metadata: {name: '%d'}}" % (BOUNDARY, index))
+
+def _boundary_index(node):
+    if not isinstance(node, MappingNode):
+        return None
+    v = view(node)
+    md = v.get("metadata")
+    if v.get("kind") == BOUNDARY and isinstance(md, MapView):
+        return md.get("name")
+    return None
 
-        if ipranges is not None:
-            cmd.extend(["--includeIPRanges", ",".join(ipranges)])
+def _split(nodes, count):
+    files = [[]]
+    for nd in nodes:
+        index = _boundary_index(nd)
+        if index is None:
+            files[-1].append(nd)
+        elif index == str(len(files)):
+            files.append([])
+        else:
+            return None
+    return files if len(files) == count else None
 
-        munged = sh(*cmd).output
+@task()
+def inject_all(files, ipranges=None, limit=INJECT_LIMIT):
+    """
+    Inject a list of files, each a list of yaml documents, and return
+    the injected documents of each file.
+
+    All the files go through a single istioctl run, separated by
+    boundary documents. If istioctl does not preserve the boundaries
+    the files are injected separately, at most limit at a time.
+    """
+    if not files:
+        return []
+    stream = []
+    for index, docs in enumerate(files):
+        if index:
+            stream.append(_boundary(index))
+        stream.extend(docs)
+    result = _split(compose_all(inject(serialize_all(stream), ipranges)), len(files))
+    if result is not None:
+        return result
+    task.warn("istioctl did not preserve document boundaries, injecting %s files separately" % len(files))
+    return list(project(lambda docs: list(compose_all(inject(serialize_all(docs), ipranges))) if docs else [],
+                        files, limit))
+
+@task()
+def istio(directory, ipranges=None):
+    names = [name for name in sorted(os.listdir(directory)) if os.path.isfile(os.path.join(directory, name))]
+    files = []
+    for name in names:
+        with open(os.path.join(directory, name)) as f:
+            files.append(list(compose_all(f)))
+    for name, docs in zip(names, inject_all(files, ipranges)):
         with open(os.path.join(directory, name), 'write') as f:
-            f.write(munged)
+            f.write(serialize_all(docs))
@@ -14,9 +14,48 @@
 
 from __future__ import absolute_import
 
-from .tasks import task, TaskError
-from jinja2 import Environment, FileSystemLoader, Template, TemplateError, TemplateNotFound, Undefined, UndefinedError
-import os, shutil
+from .tasks import task, project, TaskError, OMIT
+from eventlet import tpool
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template, TemplateError, \
+    TemplateNotFound, Undefined, UndefinedError
+from jinja2.utils import LRUCache
+import hashlib, os, shutil, threading
+
+# where compiled templates are cached across runs
+BYTECODE_CACHE = os.path.expanduser("~/.forge/jinja2")
+
+# the maximum number of files of a template directory rendered at once
+RENDER_LIMIT = 8
+
+# the maximum number of compiled string templates kept by renders
+TEMPLATE_CACHE_SIZE = 256
+
+# templates rendered on worker threads can't echo their warnings
+# directly, they are collected here and echoed afterwards
+_local = threading.local()
+
+def warn(msg):
+    pending = getattr(_local, "warnings", None)
+    if pending is None:
+        task.echo(task.terminal().bold_red("warning: %s (this will become an error soon)" % msg))
+    else:
+        pending.append(msg)
+
+def collect_warnings(function, *args, **kwargs):
+    """
+    Call function, returning its result along with the warnings from
+    the templates it rendered on this thread. The warnings are still
+    echoed as usual.
+    """
+    saved = getattr(_local, "warnings", None)
+    _local.warnings = []
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        warnings, _local.warnings = _local.warnings, saved
+        for msg in warnings:
+            warn(msg)
+    return result, warnings
 
 
 class WarnUndefined(Undefined):
@@ -26,7 +65,7 @@ class WarnUndefined(Undefined):
             self._fail_with_undefined_error()
         except UndefinedError, e:
             msg = str(e)
-        task.echo(task.terminal().bold_red("warning: %s (this will become an error soon)" % msg))
+        warn(msg)
 
     def __iter__(self):
         self.warn()
@@ -64,6 +103,28 @@ class WarnUndefined(Undefined):
         self.warn()
         return Undefined.__hash__(self)
 
+_ENVIRONMENTS = {}
+
+def environment(root):
+    """
+    Return the jinja environment for templates under root. There is
+    one per root for the life of the process, so each template is
+    compiled at most once, and compiled templates are also cached on
+    disk in BYTECODE_CACHE for use by later runs.
+
+    Templates are reloaded when their mtime changes, and cached
+    bytecode is only used if it was compiled from the same source, so
+    edits to templates are always picked up.
+    """
+    root = os.path.abspath(root)
+    if root not in _ENVIRONMENTS:
+        if not os.path.exists(BYTECODE_CACHE):
+            os.makedirs(BYTECODE_CACHE)
+        _ENVIRONMENTS[root] = Environment(loader=FileSystemLoader(root),
+                                          undefined=WarnUndefined,
+                                          bytecode_cache=FileSystemBytecodeCache(BYTECODE_CACHE))
+    return _ENVIRONMENTS[root]
+
 def _do_render(env, root, name, variables):
     try:
         return env.get_template(name).render(**variables)
@@ -72,6 +133,34 @@ def _do_render(env, root, name, variables):
     except TemplateError, e:
         raise TaskError("%s/%s: %s" % (root, name, e))
 
+def _render_collecting(env, root, name, variables):
+    _local.warnings = []
+    try:
+        return _do_render(env, root, name, variables), _local.warnings
+    finally:
+        _local.warnings = None
+
+def _write(path, content):
+    """
+    Write a file atomically, so that it is never seen half written.
+    """
+    tmp = os.path.join(os.path.dirname(path), ".%s.tmp" % os.path.basename(path))
+    try:
+        with open(tmp, "write") as f:
+            f.write(content)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _render_file(env, root, name, variables, target):
+    # rendering is cpu bound, so it is done on a real thread to keep
+    # other tasks (e.g. other services) going meanwhile
+    rendered, warnings = tpool.execute(_render_collecting, env, root, name, variables)
+    for msg in warnings:
+        warn(msg)
+    _write(target, rendered)
+
 @task()
 def render(source, target, **variables):
     """Renders a file or directory as a jinja template using the supplied
@@ -86,30 +175,54 @@ def render(source, target, **variables):
 
     If the source points to a directory, the target is created as a
     directory. If the target already exists, it is removed and
-    recreated prior to rendering the template.
+    recreated prior to rendering the template. The files in the
+    directory are rendered concurrently, up to RENDER_LIMIT at once.
+
+    Each file is written atomically.
     """
     root = source if os.path.isdir(source) else os.path.dirname(source)
-    env = Environment(loader=FileSystemLoader(root),
-                      undefined=WarnUndefined)
+    env = environment(root)
     if os.path.isdir(source):
         if os.path.exists(target):
             shutil.rmtree(target)
         os.makedirs(target)
 
+        relpaths = []
         for path, dirs, files in os.walk(source):
             for name in files:
                 relpath = os.path.join(os.path.relpath(path, start=source), name)
-                rendered = _do_render(env, root, relpath, variables)
-                outfile = os.path.join(target, relpath)
-                outdir = os.path.dirname(outfile)
+                outdir = os.path.dirname(os.path.join(target, relpath))
                 if not os.path.exists(outdir):
                     os.makedirs(outdir)
-                with open(outfile, "write") as f:
-                    f.write(rendered)
+                relpaths.append(relpath)
+
+        @task()
+        def render_file(relpath):
+            _render_file(env, root, relpath, variables, os.path.join(target, relpath))
+            return OMIT
+
+        list(project(render_file, relpaths, RENDER_LIMIT))
+    else:
+        _render_file(env, root, os.path.basename(source), variables, target)
+
+_TEMPLATES = LRUCache(TEMPLATE_CACHE_SIZE)
+
+def template(source, undefined=WarnUndefined):
+    """
+    Return a compiled template for a string. The most recently used
+    templates are cached by the digest of their source and their
+    undefined policy, so the same source is only compiled once.
+    """
+    if isinstance(source, unicode):
+        digest = hashlib.sha1(source.encode("utf-8")).hexdigest()
     else:
-        rendered = _do_render(env, root, os.path.basename(source), variables)
-        with open(target, "write") as f:
-            f.write(rendered)
+        digest = hashlib.sha1(source).hexdigest()
+    key = (digest, undefined)
+    compiled = _TEMPLATES.get(key)
+    if compiled is None:
+        compiled = Template(source, undefined=undefined)
+        _TEMPLATES[key] = compiled
+    return compiled
 
 @task()
 def renders(name, source, **variables):
@@ -118,6 +231,6 @@ def renders(name, source, **variables):
     filename would normally appear in error messages.
     """
     try:
-        return Template(source, undefined=WarnUndefined).render(**variables)
+        return template(source).render(**variables)
     except TemplateError, e:
         raise TaskError("%s: %s" % (name, e))
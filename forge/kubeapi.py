@@ -0,0 +1,393 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A minimal client for the kubernetes API, used as an alternative to
+running kubectl. It reads kubeconfig the way kubectl does, caches API
+discovery, and talks to the API server over a single pooled session.
+"""
+
+import atexit, base64, hashlib, json, os, tempfile, time
+from .tasks import TaskError, requests
+from .yamlbackend import safe_load
+
+# the field manager used for server side apply
+FIELD_MANAGER = "forge"
+
+# how long (in seconds) cached API discovery is trusted
+DISCOVERY_TTL = 10*60
+
+class APIError(TaskError):
+
+    def __init__(self, status, reason, message):
+        TaskError.__init__(self, "Error from server (%s): %s" % (reason, message))
+        self.status = status
+        self.reason = reason
+
+class DiscoveryCache(object):
+
+    """
+    A file based cache for the results of API discovery. Entries are
+    trusted for ttl seconds.
+    """
+
+    def __init__(self, directory, ttl=DISCOVERY_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, "%s.json" % hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except ValueError:
+            return None
+        if time.time() - cached.get("time", 0) > self.ttl:
+            return None
+        return cached["value"]
+
+    def put(self, key, value):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"time": time.time(), "value": value}, f)
+        os.rename(tmp, self._path(key))
+
+class KubeConfig(object):
+
+    def __init__(self, server, namespace=None, verify=True, cert=None, token=None, auth=None):
+        self.server = server.rstrip("/")
+        self.namespace = namespace
+        self.verify = verify
+        self.cert = cert
+        self.token = token
+        self.auth = auth
+
+def _named(entries, name, what, path):
+    for entry in entries or ():
+        if entry.get("name") == name:
+            return entry.get(what) or {}
+    raise TaskError("%s: unable to find %s %s" % (path, what, name))
+
+# the temporary files holding kubeconfig data, by digest of the data,
+# removed on exit
+_DATA_FILES = {}
+
+@atexit.register
+def _remove_data_files():
+    for path in _DATA_FILES.values():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    _DATA_FILES.clear()
+
+def _file(base, entry, key):
+    """
+    Return the path of a file referenced by a kubeconfig entry, either
+    directly or as base64 encoded data. Data is written to a temporary
+    file once per process.
+    """
+    data = entry.get("%s-data" % key)
+    if data:
+        digest = hashlib.sha1(data).hexdigest()
+        if digest not in _DATA_FILES:
+            fd, path = tempfile.mkstemp(prefix="forge-kube-")
+            with os.fdopen(fd, "w") as f:
+                f.write(base64.b64decode(data))
+            _DATA_FILES[digest] = path
+        return _DATA_FILES[digest]
+    path = entry.get(key)
+    if path:
+        return os.path.join(base, os.path.expanduser(path))
+    return None
+
+def _context(path, context):
+    if path is None:
+        path = (os.environ.get("KUBECONFIG") or "").split(os.pathsep)[0] or os.path.expanduser("~/.kube/config")
+    try:
+        with open(path) as f:
+            conf = safe_load(f) or {}
+    except IOError, e:
+        raise TaskError("unable to read kubeconfig: %s" % e)
+
+    name = context or conf.get("current-context")
+    if not name:
+        raise TaskError("%s: no current context" % path)
+    ctx = _named(conf.get("contexts"), name, "context", path)
+    cluster = _named(conf.get("clusters"), ctx.get("cluster"), "cluster", path)
+    user = _named(conf.get("users"), ctx.get("user"), "user", path) if ctx.get("user") else {}
+    return path, name, ctx, cluster, user
+
+def kubeconfig_context(path=None, context=None):
+    """
+    Return the name, server and namespace of a kubeconfig context,
+    without loading any credentials.
+    """
+    path, name, ctx, cluster, user = _context(path, context)
+    return name, cluster.get("server"), ctx.get("namespace")
+
+def load_kubeconfig(path=None, context=None):
+    """
+    Load the cluster, user and namespace of a kubeconfig context,
+    defaulting to the current context of the kubeconfig kubectl would
+    use.
+    """
+    path, name, ctx, cluster, user = _context(path, context)
+    base = os.path.dirname(os.path.abspath(path))
+
+    if user.get("exec") or user.get("auth-provider"):
+        raise TaskError("%s: credential plugins are not supported by the api backend, use kubectl" % path)
+
+    if cluster.get("insecure-skip-tls-verify"):
+        verify = False
+    else:
+        verify = _file(base, cluster, "certificate-authority") or True
+
+    cert = _file(base, user, "client-certificate")
+    key = _file(base, user, "client-key")
+
+    token = user.get("token")
+    if not token and user.get("tokenFile"):
+        with open(os.path.join(base, user["tokenFile"])) as f:
+            token = f.read().strip()
+
+    return KubeConfig(server=cluster["server"],
+                      namespace=ctx.get("namespace"),
+                      verify=verify,
+                      cert=(cert, key) if cert and key else cert,
+                      token=token,
+                      auth=(user["username"], user.get("password", "")) if user.get("username") else None)
+
+class KubeAPI(object):
+
+    """
+    A kubernetes API client. All requests go through one session, so
+    connections to the API server are pooled and reused.
+
+    API discovery is done at most once per client, and is cached in
+    cache_dir (if supplied) for ttl seconds across runs.
+    """
+
+    def __init__(self, config, cache_dir=None, ttl=DISCOVERY_TTL):
+        self.config = config
+        self.cache = None if cache_dir is None else DiscoveryCache(cache_dir, ttl)
+        self.session = requests.Session()
+        self.session.verify = config.verify
+        self.session.cert = config.cert
+        if config.token:
+            self.session.headers["Authorization"] = "Bearer %s" % config.token
+        elif config.auth:
+            self.session.auth = config.auth
+        self._resources = None
+
+    def request(self, method, path, **kwargs):
+        url = self.config.server + path
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException, e:
+            raise TaskError("%s %s: %s" % (method, url, e))
+        if response.status_code >= 400:
+            try:
+                status = response.json()
+                raise APIError(response.status_code, status.get("reason") or response.reason,
+                               status.get("message") or response.text)
+            except ValueError:
+                raise APIError(response.status_code, response.reason, response.text)
+        return response
+
+    def _get(self, path):
+        return self.request("GET", path).json()
+
+    ## discovery
+
+    def _discover(self):
+        group_versions = [("", v) for v in self._get("/api").get("versions", ())]
+        for group in self._get("/apis").get("groups", ()):
+            preferred = group.get("preferredVersion") or group["versions"][0]
+            group_versions.append((group["name"], preferred["version"]))
+
+        resources = []
+        for group, version in group_versions:
+            path = "/apis/%s/%s" % (group, version) if group else "/api/%s" % version
+            for r in self._get(path).get("resources", ()):
+                # skip subresources like deployments/scale
+                if "/" in r["name"]:
+                    continue
+                resources.append({"kind": r["kind"],
+                                  "name": r["name"],
+                                  "singular": r.get("singularName") or r["kind"].lower(),
+                                  "shortNames": r.get("shortNames", []),
+                                  "group": group,
+                                  "version": version,
+                                  "namespaced": r.get("namespaced", False),
+                                  "verbs": r.get("verbs", [])})
+        return resources
+
+    def resources(self):
+        """
+        Return the API resources the server knows about, using a cached
+        copy when one is available.
+        """
+        if self._resources is None:
+            resources = self.cache.get(self.config.server) if self.cache else None
+            if resources is None:
+                resources = self._discover()
+                if self.cache:
+                    self.cache.put(self.config.server, resources)
+            self._resources = resources
+        return self._resources
+
+    def resource(self, kind, api_version=None):
+        """
+        Find an API resource by kind, plural, singular or short name,
+        optionally qualified with a group (e.g. deployments.apps), or
+        for an exact kind and apiVersion.
+        """
+        if api_version is not None:
+            group, _, version = api_version.rpartition("/")
+            for r in self.resources():
+                if r["kind"] == kind and r["group"] == group:
+                    return dict(r, version=version)
+            raise TaskError('no matches for kind "%s" in version "%s"' % (kind, api_version))
+
+        name, _, group = kind.lower().partition(".")
+        for r in self.resources():
+            names = [r["kind"].lower(), r["name"], r["singular"]] + r["shortNames"]
+            if name in names and (not group or group == r["group"]):
+                return r
+        raise TaskError('the server doesn\'t have a resource type "%s"' % kind)
+
+    def _path(self, resource, namespace=None, name=None):
+        if resource["group"]:
+            path = "/apis/%s/%s" % (resource["group"], resource["version"])
+        else:
+            path = "/api/%s" % resource["version"]
+        if resource["namespaced"] and namespace:
+            path += "/namespaces/%s" % namespace
+        path += "/%s" % resource["name"]
+        if name:
+            path += "/%s" % name
+        return path
+
+    def _namespace(self, resource, namespace):
+        if not resource["namespaced"]:
+            return None
+        return namespace or self.config.namespace or "default"
+
+    ## operations
+
+    def apply(self, doc, namespace=None, dry_run=False):
+        """
+        Server side apply a resource. Returns the applied resource, and
+        whether it was created.
+        """
+        resource = self.resource(doc["kind"], doc.get("apiVersion", "v1"))
+        md = doc.get("metadata") or {}
+        ns = self._namespace(resource, md.get("namespace") or namespace)
+        params = {"fieldManager": FIELD_MANAGER, "force": "true"}
+        if dry_run:
+            params["dryRun"] = "All"
+        response = self.request("PATCH", self._path(resource, ns, md.get("name")), params=params,
+                                data=json.dumps(doc),
+                                headers={"Content-Type": "application/apply-patch+yaml"})
+        return response.json(), response.status_code == 201
+
+    def get(self, kind, name, namespace=None, api_version=None):
+        """
+        Return a resource, or None if it doesn't exist.
+        """
+        resource = self.resource(kind, api_version)
+        try:
+            return self._get(self._path(resource, self._namespace(resource, namespace), name))
+        except APIError, e:
+            if e.status == 404:
+                return None
+            raise
+
+    def list(self, kind, selector=None, namespace=None, chunk_size=None):
+        """
+        List the resources of a kind matching a label selector, across
+        all namespaces unless one is supplied. If a chunk_size is
+        supplied the resources are fetched a page at a time.
+        """
+        return self.list_versioned(kind, selector, namespace, chunk_size)[0]
+
+    def list_versioned(self, kind, selector=None, namespace=None, chunk_size=None):
+        """
+        Like list, but return the resourceVersion of the list too, so
+        that it can be watched from.
+        """
+        resource = self.resource(kind)
+        params = {"labelSelector": selector} if selector else {}
+        if chunk_size:
+            params["limit"] = chunk_size
+        items = []
+        while True:
+            page = self.request("GET", self._path(resource, namespace), params=params).json()
+            for item in page.get("items") or ():
+                # list items don't carry their kind
+                item.setdefault("kind", resource["kind"])
+                item.setdefault("apiVersion", "/".join(filter(None, (resource["group"], resource["version"]))))
+                items.append(item)
+            metadata = page.get("metadata") or {}
+            token = metadata.get("continue")
+            if not token:
+                return items, metadata.get("resourceVersion")
+            params["continue"] = token
+
+    def watch(self, kind, selector=None, namespace=None, timeout=None, resource_version=None):
+        """
+        Watch the resources of a kind matching a label selector,
+        across all namespaces unless one is supplied, yielding each
+        event as it arrives. Unless a resource_version to watch from
+        is supplied, the current resources are reported first as ADDED
+        events. The server ends the watch after timeout seconds.
+        """
+        resource = self.resource(kind)
+        params = {"watch": "true"}
+        if resource_version:
+            params["resourceVersion"] = resource_version
+        if selector:
+            params["labelSelector"] = selector
+        if timeout:
+            params["timeoutSeconds"] = int(timeout)
+        response = self.request("GET", self._path(resource, namespace), params=params, stream=True)
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("type") == "ERROR":
+                    status = event.get("object") or {}
+                    raise APIError(status.get("code"), status.get("reason"), status.get("message"))
+                obj = event.get("object") or {}
+                obj.setdefault("kind", resource["kind"])
+                obj.setdefault("apiVersion", "/".join(filter(None, (resource["group"], resource["version"]))))
+                yield event
+        finally:
+            response.close()
+
+    def delete(self, kind, name, namespace=None, dry_run=False):
+        resource = self.resource(kind)
+        params = {"propagationPolicy": "Background"}
+        if dry_run:
+            params["dryRun"] = "All"
+        self.request("DELETE", self._path(resource, self._namespace(resource, namespace), name), params=params)
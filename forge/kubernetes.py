@@ -12,11 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, glob
-from tasks import task, TaskError, get, sh, SHResult
+import hashlib, json, os, glob, re, tempfile
+from collections import OrderedDict
+from eventlet.green import time
+from tasks import task, TaskError, get, project, sh, SHResult, ERROR, OMIT
 from forge.match import match
-from forge.yamlutil import MappingNode, Node, as_node, compose, compose_all, serialize_all, view
+from forge.kubeapi import FIELD_MANAGER, APIError, DiscoveryCache, KubeAPI, kubeconfig_context, \
+    load_kubeconfig
+from forge.snapshot import Snapshot
+from forge.yamlutil import MappingNode, Node, ScalarNode, as_node, compose, compose_all, serialize, serialize_all, view
 from forge import yamlutil
+from forge.yamlbackend import parse, safe_load_all
+from yaml import emit, CollectionStartEvent, CollectionEndEvent, DocumentStartEvent, DocumentEndEvent, \
+    MappingStartEvent, MappingEndEvent, ScalarEvent
+from yaml.resolver import Resolver
 
 @match(MappingNode, basestring, dict)
 def fixup(node, key, pairs):
@@ -39,6 +48,236 @@ def fixup(node, key, pairs):
 def fixup(*args):
     pass
 
+# The event based fixup below produces the same result as fixup, but
+# works directly on the yaml event stream, so memory use stays flat
+# no matter how big the documents are. Only the metadata of a
+# document is ever buffered, and only when it precedes the kind.
+
+NULL = u'tag:yaml.org,2002:null'
+_RESOLVER = Resolver()
+
+def _is_null(event):
+    if not isinstance(event, ScalarEvent):
+        return False
+    tag = event.tag
+    if tag is None or tag == u'!':
+        tag = _RESOLVER.resolve(ScalarNode, event.value, event.implicit)
+    return tag == NULL
+
+def _applies(kind):
+    return kind and kind.lower() not in ('ns', 'namespace')
+
+def _node_events(first, events):
+    yield first
+    if isinstance(first, CollectionStartEvent):
+        depth = 1
+        while depth:
+            event = next(events)
+            if isinstance(event, CollectionStartEvent):
+                depth += 1
+            elif isinstance(event, CollectionEndEvent):
+                depth -= 1
+            yield event
+
+def _skip(first, events):
+    for _ in _node_events(first, events):
+        pass
+
+def _scalar(value):
+    # this mirrors how the serializer decides scalar implicitness so
+    # we get the same output as serializing an as_node(value)
+    node = as_node(value)
+    implicit = (node.tag == _RESOLVER.resolve(ScalarNode, node.value, (True, False)),
+                node.tag == _RESOLVER.resolve(ScalarNode, node.value, (False, True)))
+    return ScalarEvent(None, node.tag, implicit, node.value)
+
+def _mapping(pairs):
+    yield MappingStartEvent(None, None, True, flow_style=True)
+    for k, v in pairs.items():
+        yield _scalar(k)
+        yield _scalar(v)
+    yield MappingEndEvent()
+
+def _pair(events):
+    """
+    Read the key of the next mapping entry. Returns the key name (None
+    for non scalar keys), the key events, and the first event of the
+    value, or None if the mapping has ended.
+    """
+    first = next(events)
+    if isinstance(first, MappingEndEvent):
+        return None, [first], None
+    key = list(_node_events(first, events))
+    name = first.value if isinstance(first, ScalarEvent) else None
+    return name, key, next(events)
+
+def _merge(events, pairs):
+    remaining = OrderedDict(pairs)
+    while True:
+        name, key, value = _pair(events)
+        if value is None:
+            break
+        for e in key: yield e
+        if name in remaining:
+            yield _scalar(remaining.pop(name))
+            _skip(value, events)
+        else:
+            for e in _node_events(value, events): yield e
+    for k, v in remaining.items():
+        yield _scalar(k)
+        yield _scalar(v)
+    yield key[0]
+
+def _fixup_metadata(first, events, fixups):
+    if _is_null(first):
+        yield MappingStartEvent(None, None, True, flow_style=True)
+        for k, pairs in fixups.items():
+            yield _scalar(k)
+            for e in _mapping(pairs): yield e
+        yield MappingEndEvent()
+        return
+    if not isinstance(first, MappingStartEvent):
+        for e in _node_events(first, events): yield e
+        return
+
+    yield first
+    remaining = OrderedDict(fixups)
+    while True:
+        name, key, value = _pair(events)
+        if value is None:
+            break
+        for e in key: yield e
+        if name in remaining:
+            pairs = remaining.pop(name)
+            if _is_null(value):
+                for e in _mapping(pairs): yield e
+            elif isinstance(value, MappingStartEvent):
+                yield value
+                for e in _merge(events, pairs): yield e
+            else:
+                for e in _node_events(value, events): yield e
+        else:
+            for e in _node_events(value, events): yield e
+    for k, pairs in remaining.items():
+        yield _scalar(k)
+        for e in _mapping(pairs): yield e
+    yield key[0]
+
+def _flush(pending, kind, fixups):
+    for name, key, value in pending:
+        for e in key: yield e
+        if name == "metadata" and _applies(kind):
+            rest = iter(value)
+            for e in _fixup_metadata(next(rest), rest, fixups): yield e
+        else:
+            for e in value: yield e
+
+def _fixup_document(first, events, fixups):
+    if not isinstance(first, MappingStartEvent):
+        for e in _node_events(first, events): yield e
+        return
+
+    yield first
+    kind = None
+    seen_kind = False
+    seen_metadata = False
+    pending = None
+    while True:
+        name, key, value = _pair(events)
+        if value is None:
+            break
+        if name == "kind" and not seen_kind:
+            seen_kind = True
+            value = list(_node_events(value, events))
+            kind = value[0].value if isinstance(value[0], ScalarEvent) else None
+            if pending is not None:
+                for e in _flush(pending, kind, fixups): yield e
+                pending = None
+            for e in key + value: yield e
+        elif name == "metadata" and not seen_metadata:
+            seen_metadata = True
+            if seen_kind:
+                for e in key: yield e
+                if _applies(kind):
+                    for e in _fixup_metadata(value, events, fixups): yield e
+                else:
+                    for e in _node_events(value, events): yield e
+            else:
+                pending = [(name, key, list(_node_events(value, events)))]
+        elif pending is not None:
+            pending.append((name, key, list(_node_events(value, events))))
+        else:
+            for e in key: yield e
+            for e in _node_events(value, events): yield e
+
+    if pending is not None:
+        for e in _flush(pending, kind, fixups): yield e
+    elif not seen_metadata and _applies(kind):
+        yield _scalar("metadata")
+        for e in _fixup_metadata(_scalar(None), iter(()), fixups): yield e
+    yield key[0]
+
+def _merged(fixups, more):
+    result = OrderedDict((k, OrderedDict(v)) for k, v in fixups.items())
+    for k, pairs in more.items():
+        result.setdefault(k, OrderedDict()).update(pairs)
+    return result
+
+def fixup_events(events, fixups, extra=()):
+    """
+    Apply fixups to a stream of yaml events, e.g. from parse. The
+    fixups map a metadata key (labels or annotations) to the pairs to
+    merge into it. Null documents are dropped.
+
+    The optional extra fixups are a sequence with an entry for each
+    (non null) document, to be merged with the fixups for just that
+    document.
+    """
+    events = iter(events)
+    extra = iter(extra)
+    for event in events:
+        if isinstance(event, DocumentStartEvent):
+            first = next(events)
+            if _is_null(first):
+                next(events) # the document end
+                continue
+            yield event
+            more = next(extra, None)
+            for e in _fixup_document(first, events, _merged(fixups, more) if more else fixups): yield e
+        else:
+            yield event
+
+def hash_events(events):
+    """
+    Yield a hash of each document in a stream of yaml events.
+    """
+    digest = None
+    for event in events:
+        if isinstance(event, DocumentStartEvent):
+            digest = hashlib.sha1()
+        elif isinstance(event, DocumentEndEvent):
+            yield digest.hexdigest()
+        elif digest is not None:
+            digest.update(repr((event.__class__.__name__, getattr(event, "anchor", None),
+                                getattr(event, "tag", None), getattr(event, "value", None))))
+
+def fixup_file(path, fixups, extra=()):
+    """
+    Apply fixups to a yaml file in place, streaming from the original
+    to a temporary file that then replaces it.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(path))
+    try:
+        with open(path) as input, os.fdopen(fd, "w") as output:
+            emit(fixup_events(parse(input), fixups, extra), output)
+        os.chmod(tmp, os.stat(path).st_mode & 0777)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+# the kinds to list when discovery isn't available
 ALL = ('csr',
        'clusterrolebindings',
        'clusterroles',
@@ -103,6 +342,229 @@ def status_summary(kind, status):
 def status_summary(kind, status):
     return str(status)
 
+READY = "ready"
+PROGRESSING = "progressing"
+FAILED = "failed"
+
+def _observed(item):
+    generation = (item.get("metadata") or {}).get("generation", 0)
+    return (item.get("status") or {}).get("observedGeneration", 0) >= generation
+
+@match("deployment", object)
+def rollout(kind, item):
+    spec = item.get("spec") or {}
+    status = item.get("status") or {}
+    for cond in status.get("conditions") or ():
+        if cond.get("type") == "Progressing" and cond.get("reason") == "ProgressDeadlineExceeded":
+            return FAILED
+    replicas = spec.get("replicas", 1)
+    if (not _observed(item) or
+        status.get("updatedReplicas", 0) < replicas or
+        status.get("replicas", 0) > status.get("updatedReplicas", 0) or
+        status.get("availableReplicas", 0) < status.get("updatedReplicas", 0)):
+        return PROGRESSING
+    return READY
+
+@match("statefulset", object)
+def rollout(kind, item):
+    spec = item.get("spec") or {}
+    status = item.get("status") or {}
+    if (not _observed(item) or
+        status.get("readyReplicas", 0) < spec.get("replicas", 1) or
+        status.get("currentRevision") != status.get("updateRevision")):
+        return PROGRESSING
+    return READY
+
+@match("daemonset", object)
+def rollout(kind, item):
+    status = item.get("status") or {}
+    desired = status.get("desiredNumberScheduled", 0)
+    if (not _observed(item) or
+        status.get("updatedNumberScheduled", 0) < desired or
+        status.get("numberAvailable", 0) < desired):
+        return PROGRESSING
+    return READY
+
+@match(basestring, object)
+def rollout(kind, item):
+    return READY
+
+def api_group(api_version):
+    "Return the group of an apiVersion, which is empty for the core group."
+    return api_version.rsplit("/", 1)[0] if "/" in api_version else ""
+
+def resource_name(api_version, kind, name):
+    """
+    Return the name kubectl uses for a resource, i.e. kind.group/name,
+    where the group is taken from the apiVersion and omitted for the
+    core group.
+    """
+    group = api_group(api_version)
+    if group:
+        return "%s.%s/%s" % (kind.lower(), group, name)
+    else:
+        return "%s/%s" % (kind.lower(), name)
+
+# the keys resource_names looks at, for skimming documents
+RESOURCE_KEYS = ("apiVersion", "kind", "metadata", "name", "items")
+
+def resource_names(docs):
+    """
+    Return the kubectl names of the resources defined in a sequence
+    of yaml views (or skims with RESOURCE_KEYS), expanding any lists.
+    """
+    for doc in docs:
+        if not isinstance(doc, (yamlutil.MapView, dict)):
+            continue
+        kind = doc.get("kind")
+        if kind and kind.endswith("List") and "items" in doc:
+            for name in resource_names(doc["items"]):
+                yield name
+            continue
+        md = doc.get("metadata")
+        name = md.get("name") if isinstance(md, (yamlutil.MapView, dict)) else None
+        if kind and name:
+            yield resource_name(str(doc.get("apiVersion") or ""), kind, name)
+
+# the annotation holding the hash of a resource's final manifest
+HASH = "forge.manifest-hash"
+
+MANIFEST_EXTENSIONS = (".yaml", ".yml", ".json")
+
+def manifest_hash(node):
+    return hashlib.sha1(serialize(node)).hexdigest()
+
+def _hashed(node, namespace):
+    """
+    Return the (group, kind, namespace, name) of a document along with
+    its manifest hash, or None if it doesn't have both. Documents that
+    don't specify a namespace are in the supplied one.
+    """
+    if not isinstance(node, MappingNode):
+        return None
+    v = view(node)
+    kind = v.get("kind")
+    md = v.get("metadata")
+    if not kind or not isinstance(md, yamlutil.MapView) or not md.get("name"):
+        return None
+    anns = md.get("annotations")
+    digest = anns.get(HASH) if isinstance(anns, yamlutil.MapView) else None
+    if not digest:
+        return None
+    return (api_group(str(v.get("apiVersion") or "")), kind.lower(), md.get("namespace") or namespace,
+            md.get("name")), digest
+
+def _live_hashes(output, namespace):
+    # kubectl's stderr is mixed in with the output, so look for the
+    # start of the json
+    start = output.find("{")
+    if start < 0:
+        return {}
+    data = json.loads(output[start:])
+    items = data.get("items", ()) if data.get("kind") == "List" else [data]
+    result = {}
+    for item in items:
+        md = item.get("metadata", {})
+        # cluster scoped resources are keyed like the documents that
+        # define them, which are given the default namespace
+        key = (api_group(item.get("apiVersion", "")), item.get("kind", "").lower(),
+               md.get("namespace") or namespace, md.get("name"))
+        result[key] = md.get("annotations", {}).get(HASH)
+    return result
+
+class JSONItems(object):
+
+    """
+    Incrementally parse the items of the kubernetes List objects in
+    the json output of `kubectl get`, fed to it a line at a time, and
+    pass each of them to a handler as soon as it is complete.
+
+    kubectl indents its json, so an item starts and ends with a brace
+    on a line of its own at the indentation of the first item, and
+    only the lines of the current item need buffering. Output that
+    isn't laid out like that is buffered and parsed on close.
+    """
+
+    ITEMS = re.compile(r'^\s*"items": \[$')
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending = []
+        self.item = None
+        self.indent = None
+        self.state = "outside"
+
+    def feed(self, line):
+        if self.state == "fallback":
+            self.pending.append(line)
+        elif self.state == "outside":
+            self.pending.append(line)
+            if self.ITEMS.match(line):
+                self.state = "items"
+            elif '"items"' in line and '"items": []' not in line:
+                self.state = "fallback"
+        elif self.item is None:
+            stripped = line.strip()
+            if stripped in ("]", "],"):
+                self.state = "outside"
+                self.pending = []
+            elif stripped == "{":
+                self.indent = line[:line.index("{")]
+                self.item = [line]
+            elif self.pending:
+                self.pending.append(line)
+                self.state = "fallback"
+            else:
+                raise ValueError("unexpected json: %s" % line)
+        else:
+            self.item.append(line)
+            if line.rstrip() in (self.indent + "}", self.indent + "},"):
+                text = "".join(self.item).rstrip().rstrip(",")
+                self.item = None
+                # once an item has been handled there is no going back
+                self.pending = None
+                self.handler(json.loads(text))
+
+    def close(self):
+        if self.item is not None:
+            raise ValueError("truncated json")
+        if self.state != "fallback":
+            return
+        text = "".join(self.pending)
+        decoder = json.JSONDecoder()
+        index = text.find("{")
+        while index >= 0:
+            obj, end = decoder.raw_decode(text, index)
+            for item in obj.get("items", ()) if obj.get("kind", "").endswith("List") else (obj,):
+                self.handler(item)
+            index = text.find("{", end)
+
+def _identity(item):
+    return item
+
+def _reference(item):
+    md = item.get("metadata", {})
+    return {"kind": item.get("kind"), "apiVersion": item.get("apiVersion", "v1"),
+            "metadata": {"name": md.get("name"), "namespace": md.get("namespace")}}
+
+def _project(item):
+    """
+    Reduce a resource to the fields forge list needs.
+    """
+    md = item.get("metadata", {})
+    anns = md.get("annotations") or {}
+    labels = md.get("labels") or {}
+    result = {"kind": item.get("kind"),
+              "metadata": {"name": md.get("name"),
+                           "namespace": md.get("namespace"),
+                           "annotations": dict((k, v) for k, v in anns.items() if k.startswith("forge.")),
+                           "labels": dict((k, v) for k, v in labels.items() if k.startswith("forge."))}}
+    if "status" in item:
+        result["status"] = item["status"]
+    if "subsets" in item:
+        result["subsets"] = item["subsets"]
+    return result
+
 def is_yaml_empty(dir):
     for name in glob.glob("%s/*.yaml" % dir):
         with open(name) as f:
@@ -110,24 +572,271 @@ def is_yaml_empty(dir):
                 return False
     return True
 
+def _requirement(key, value):
+    if isinstance(value, (list, tuple)):
+        return "%s in (%s)" % (key, ",".join(value))
+    elif value:
+        return "%s=%s" % (key, value)
+    else:
+        return key
+
+def label_selector(labels):
+    return ",".join(_requirement(k, v) for k, v in labels.items())
+
 def selector(labels):
-    return "-l%s" % (",".join(("%s=%s" % (k, v)) if v else k for k, v in labels.items()))
+    return "-l%s" % label_selector(labels)
+
+# kubectl apply reports each resource as either kind.group/name verb,
+# or in older versions as kind "name" verb
+APPLIED = (re.compile(r'^([\w.-]+)/(\S+) (\w.*)$'), re.compile(r'^([\w.-]+) "([^"]+)" (\w.*)$'))
+
+def resource_key(resource):
+    """
+    Return a (kind, name) pair for a kubectl resource name that
+    matches regardless of how kubectl qualified the kind.
+    """
+    kind, _, name = resource.partition("/")
+    return kind.split(".")[0].lower(), name
+
+def applied(output):
+    """
+    Parse the output of kubectl apply. Returns a dict mapping the
+    resource_key of each applied resource to what kubectl did with
+    it, and a list of any other (error) lines.
+    """
+    result = {}
+    errors = []
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        for regex in APPLIED:
+            m = regex.match(line)
+            if m:
+                result[(m.group(1).split(".")[0].lower(), m.group(2))] = m.group(3)
+                break
+        else:
+            errors.append(line)
+    return result, errors
+
+def _recovered(t, *args, **kwargs):
+    """
+    Run a task, recovering from any error in it or its children and
+    raising the error instead, so that a caller that handles the error
+    isn't failed by it.
+    """
+    result = t.go(*args, **kwargs)
+    result.wait()
+    if result.value is ERROR:
+        result.recover()
+        raise result.exception[0], result.exception[1], result.exception[2]
+    return result.value
+
+# the maximum number of concurrent requests made by the api backend,
+# and of concurrent kubectl gets when listing
+API_LIMIT = 8
+LIST_LIMIT = 8
+
+# the page size used when listing
+CHUNK_SIZE = 500
+
+# the maximum number of namespaces deleted from concurrently
+DELETE_LIMIT = 8
+
+# how long (in seconds) to wait for deleted resources to go away
+DELETE_TIMEOUT = 5*60
+
+# the kinds whose rollout is waited for
+ROLLOUT_KINDS = ("deployment", "statefulset", "daemonset")
+
+# how long (in seconds) to wait for rollouts to finish
+ROLLOUT_TIMEOUT = 5*60
+
+# kinds that are shared between services and so never deleted
+SHARED = ("namespaces", "storageclasses")
+
+# where the api backend caches API discovery
+DISCOVERY_CACHE = os.path.expanduser("~/.forge/discovery")
+
+# where snapshots of the forge deployed resources in a cluster are kept
+SNAPSHOT_DIR = os.path.expanduser("~/.forge/snapshots")
+
+# how often (in seconds) forge cache saves its snapshot
+SYNC_INTERVAL = 5
+
+# how long (in seconds) each watch made by forge cache lasts
+WATCH_TIMEOUT = 5*60
 
 class Kubernetes(object):
 
-    def __init__(self, namespace=None, context=None, dry_run=False):
+    """
+    Access to a kubernetes cluster. The kubectl backend runs kubectl
+    for everything, the api backend talks to the API server directly
+    using the kubeconfig kubectl would use.
+    """
+
+    def __init__(self, namespace=None, context=None, dry_run=False, force_apply=False, backend="kubectl"):
         self.namespace = namespace or os.environ.get("K8S_NAMESPACE", None)
         self.context = context
         self.dry_run = dry_run
+        self.force_apply = force_apply
+        if backend not in ("kubectl", "api"):
+            raise TaskError("unknown kubernetes backend: %s" % backend)
+        self.backend = backend
+        self._api = None
+        self._kinds = None
+        self._context = None
+
+    @property
+    def api(self):
+        if self._api is None:
+            self._api = KubeAPI(load_kubeconfig(context=self.context), cache_dir=DISCOVERY_CACHE)
+        return self._api
+
+    def _kubeconfig(self):
+        """
+        Return the name, server and namespace of the kubeconfig context
+        in use, or Nones if kubeconfig can't be read.
+        """
+        if self._context is None:
+            try:
+                self._context = kubeconfig_context(context=self.context)
+            except TaskError:
+                self._context = (self.context, None, None)
+        return self._context
+
+    def _default_namespace(self):
+        "Return the namespace of resources that don't specify one."
+        return self.namespace or self._kubeconfig()[2] or "default"
+
+    def _discovery_key(self):
+        name, server, namespace = self._kubeconfig()
+        if server:
+            return "kubectl %s %s" % (server, name)
+        return "kubectl %s %s" % (os.environ.get("KUBECONFIG", ""), name)
+
+    def kinds(self):
+        """
+        Return the names of all the kinds of resource that can be
+        listed, from API discovery. Discovery is cached, so CRDs are
+        included without a discovery call every time.
+        """
+        if self._kinds is None:
+            if self.backend == "api":
+                self._kinds = ["%s.%s" % (r["name"], r["group"]) if r["group"] else r["name"]
+                               for r in self.api.resources() if "list" in r["verbs"]]
+            else:
+                cache = DiscoveryCache(DISCOVERY_CACHE)
+                key = self._discovery_key()
+                kinds = cache.get(key)
+                if kinds is None:
+                    try:
+                        kinds = _recovered(sh, "kubectl", "api-resources", "--verbs=list", "-o", "name").output.split()
+                        cache.put(key, kinds)
+                    except TaskError, e:
+                        task.info("unable to discover resources, using defaults: %s" % e)
+                        kinds = list(ALL)
+                self._kinds = kinds
+        return self._kinds
+
+    def snapshot_path(self):
+        return os.path.join(SNAPSHOT_DIR, "%s.json" % hashlib.sha1(self._discovery_key()).hexdigest())
+
+    def _snapshot(self, items):
+        snapshot = Snapshot(self.snapshot_path())
+        bykind = {}
+        for item in items:
+            bykind.setdefault(item["kind"], []).append(item)
+        for kind, kind_items in bykind.items():
+            snapshot.replace(kind, kind_items)
+        return snapshot
+
+    def _unshared(self):
+        return [k for k in self.kinds() if k.split(".")[0] not in SHARED + ('ns', 'sc')]
+
+    def _stream(self, yaml_dirs):
+        parts = []
+        for yaml_dir in yaml_dirs:
+            for name in sorted(os.listdir(yaml_dir)):
+                if os.path.splitext(name)[1] not in MANIFEST_EXTENSIONS:
+                    continue
+                with open(os.path.join(yaml_dir, name)) as f:
+                    text = f.read()
+                if text.strip():
+                    # the leading document marker keeps kubectl from
+                    # mistaking the stream for json
+                    parts.append("---\n%s\n" % text)
+        return "".join(parts)
+
+    def _documents(self, yaml_dirs):
+        for yaml_dir in yaml_dirs:
+            for name in sorted(os.listdir(yaml_dir)):
+                if os.path.splitext(name)[1] not in MANIFEST_EXTENSIONS:
+                    continue
+                with open(os.path.join(yaml_dir, name)) as f:
+                    for nd in compose_all(f):
+                        yield nd
+
+    @task()
+    def unchanged(self, yaml_dirs):
+        """
+        Return the (group, kind, namespace, name) of the resources in
+        yaml_dirs whose manifest hash matches that of the live
+        resource, using a single `kubectl get`.
+        """
+        namespace = self._default_namespace()
+        hashes = dict(filter(None, (_hashed(nd, namespace) for nd in self._documents(yaml_dirs))))
+        if not hashes:
+            return set()
+        cmd = "kubectl", "get", "-o", "json", "--ignore-not-found"
+        for yaml_dir in yaml_dirs:
+            cmd += "-f", yaml_dir
+        if self.namespace:
+            cmd += "--namespace", self.namespace
+        try:
+            if self.backend == "api":
+                live = _recovered(self._api_live_hashes, yaml_dirs, namespace)
+            else:
+                live = _live_hashes(_recovered(sh, *cmd).output, namespace)
+        except (TaskError, ValueError), e:
+            task.info("unable to compare with live resources, applying everything: %s" % e)
+            return set()
+        return set(k for k, digest in hashes.items() if live.get(k) == digest)
+
+    def _select(self, yaml_dirs, prune):
+        """
+        Figure out which manifests need applying. Returns the yaml to
+        apply, or None if everything needs applying, along with the
+        (group, kind, namespace, name) of the unchanged resources that
+        were left out.
+
+        Pruning deletes whatever isn't applied, so everything is
+        applied when pruning.
+        """
+        if prune or self.force_apply:
+            return None, set()
+        skipped = self.unchanged(yaml_dirs)
+        if not skipped:
+            return None, skipped
+        task.info("skipping %s unchanged resources" % len(skipped))
+        namespace = self._default_namespace()
+        docs = []
+        for nd in self._documents(yaml_dirs):
+            hashed = _hashed(nd, namespace)
+            if hashed is None or hashed[0] not in skipped:
+                docs.append(nd)
+        return serialize_all(docs), skipped
 
     @task()
     def resources(self, yaml_dir):
         if is_yaml_empty(yaml_dir):
             return []
-        cmd = "kubectl", "apply", "--dry-run", "-f", yaml_dir, "-o", "name"
-        if self.namespace:
-            cmd += "--namespace", self.namespace
-        return sh(*cmd).output.split()
+        result = []
+        for name in sorted(os.listdir(yaml_dir)):
+            if os.path.splitext(name)[1] not in MANIFEST_EXTENSIONS:
+                continue
+            with open(os.path.join(yaml_dir, name)) as f:
+                result.extend(resource_names(view(nd) for nd in compose_all(f)))
+        return result
 
     def _labeltate(self, yaml_dir, labels, annotate):
         if is_yaml_empty(yaml_dir):
@@ -135,20 +844,10 @@ class Kubernetes(object):
         key = "annotations" if annotate else "labels"
 
         for name in os.listdir(yaml_dir):
-            fixed = []
-            with open(os.path.join(yaml_dir, name), 'read') as f:
-                for nd in compose_all(f):
-                    fixup(nd, key, labels)
-                    # we filter out null nodes because istioctl sticks
-                    # them in for some reason, and then we end up
-                    # serializing them in a way that kubectl doesn't
-                    # understand
-                    if nd.tag == u'tag:yaml.org,2002:null':
-                        continue
-                    fixed.append(nd)
-            munged = serialize_all(fixed)
-            with open(os.path.join(yaml_dir, name), 'write') as f:
-                f.write(munged)
+            # we filter out null nodes because istioctl sticks them in
+            # for some reason, and then we end up serializing them in
+            # a way that kubectl doesn't understand
+            fixup_file(os.path.join(yaml_dir, name), {key: labels})
 
     @task()
     def annotate(self, yaml_dir, labels):
@@ -162,65 +861,117 @@ class Kubernetes(object):
     def apply(self, yaml_dir, prune=None):
         if is_yaml_empty(yaml_dir):
             return SHResult("", 0, "")
-        cmd = "kubectl", "apply", "-f", yaml_dir
+        content, skipped = self._select([yaml_dir], prune)
+        if self.backend == "api":
+            result = self._api_apply(self._stream([yaml_dir]) if content is None else content, prune)
+            if result.code:
+                raise TaskError("%s failed: %s" % (result.command, result.output))
+            return result
+        if content is None:
+            cmd = "kubectl", "apply", "-f", yaml_dir
+        elif content.strip():
+            cmd = "kubectl", "apply", "-f", "-"
+        else:
+            return SHResult("", 0, "")
         if self.namespace:
             cmd += "--namespace", self.namespace
         if self.dry_run:
             cmd += "--dry-run",
         if prune:
             cmd += "--prune", selector(prune)
-        result = sh(*cmd)
+        result = sh(*cmd, input=content)
         return result
 
     @task()
-    def list(self):
+    def apply_all(self, yaml_dirs, prune=None):
+        """
+        Apply the manifests in several directories with a single
+        kubectl invocation, streaming them to `kubectl apply -f -`.
+
+        Returns the result of kubectl along with the (group, kind,
+        namespace, name) of any unchanged resources that were skipped. A failure of kubectl
+        to apply some of the resources is not an error here, use
+        applied() on the output to find out what was and wasn't
+        applied.
+        """
+        content, skipped = self._select(yaml_dirs, prune)
+        if content is None:
+            content = self._stream(yaml_dirs)
+        if not content.strip():
+            return SHResult("", 0, ""), skipped
+        if self.backend == "api":
+            return self._api_apply(content, prune), skipped
+        cmd = "kubectl", "apply", "-f", "-"
+        if self.namespace:
+            cmd += "--namespace", self.namespace
+        if self.dry_run:
+            cmd += "--dry-run",
+        if prune:
+            cmd += "--prune", selector(prune)
+        return sh(*cmd, input=content, expected=(0, 1)), skipped
+
+    @task()
+    def list(self, max_age=None):
         """
         Return a structured view of all forge deployed resources in a kubernetes cluster.
+
+        If max_age is supplied, a snapshot of the cluster saved in the
+        last max_age seconds (e.g. by `forge cache`) is used instead of
+        listing the cluster, and if there isn't one the result of
+        listing is saved as the new snapshot, as long as every kind
+        could be listed.
         """
-        output = sh("kubectl", "get", "--all-namespaces", ",".join(ALL), "-oyaml", "-lforge.service").output
+        snapshot = None
+        if max_age is not None:
+            snapshot = Snapshot.load(self.snapshot_path(), max_age)
+        if snapshot is not None:
+            items = snapshot.items()
+        else:
+            skipped = []
+            items = self._list(self.kinds(), {"forge.service": None}, skipped=skipped)
+            if max_age is not None and not skipped:
+                self._snapshot(items).save()
 
         repos = {}
         endpoints = {}
-        for nd in yamlutil.load("kubectl-get", output):
-            items = nd["items"]
-            for i in items:
-                kind = i["kind"].lower()
-                md = i["metadata"]
-                name = md["name"]
-                namespace = md["namespace"]
-                status = i.get("status", {})
-
-                ann = md.get("annotations", {})
-
-                repo = ann.get("forge.repo", "(none)")
-                descriptor = ann.get("forge.descriptor", "(none)")
-                version = ann.get("forge.version", "(none)")
-
-                labels = md.get("labels", {})
-                service = labels["forge.service"]
-                profile = labels["forge.profile"]
-
-                if kind == "endpoints":
-                    endpoints[(namespace, name)] = i["subsets"]
-                    continue
+        for i in items:
+            kind = i["kind"].lower()
+            md = i["metadata"]
+            name = md["name"]
+            namespace = md["namespace"]
+            status = i.get("status", {})
+
+            ann = md.get("annotations", {})
+
+            repo = ann.get("forge.repo", "(none)")
+            descriptor = ann.get("forge.descriptor", "(none)")
+            version = ann.get("forge.version", "(none)")
+
+            labels = md.get("labels", {})
+            service = labels["forge.service"]
+            profile = labels["forge.profile"]
 
-                if repo not in repos:
-                    repos[repo] = {}
+            if kind == "endpoints":
+                endpoints[(namespace, name)] = i["subsets"]
+                continue
 
-                if service not in repos[repo]:
-                    repos[repo][service] = {}
+            if repo not in repos:
+                repos[repo] = {}
 
-                if profile not in repos[repo][service]:
-                    repos[repo][service][profile] = []
+            if service not in repos[repo]:
+                repos[repo][service] = {}
 
-                repos[repo][service][profile].append({
-                    "kind": kind,
-                    "namespace": namespace,
-                    "name": name,
-                    "version": version,
-                    "descriptor": descriptor,
-                    "status": status
-                })
+            if profile not in repos[repo][service]:
+                repos[repo][service][profile] = []
+
+            repos[repo][service][profile].append({
+                "kind": kind,
+                "namespace": namespace,
+                "name": name,
+                "version": version,
+                "descriptor": descriptor,
+                "status": status
+            })
 
         for repo, services in repos.items():
             for service, profiles in services.items():
@@ -235,26 +986,359 @@ class Kubernetes(object):
 
         return repos
 
+    def _list(self, kinds, labels, reduce=_project, skipped=None):
+        """
+        Return the resources of the given kinds that match the labels,
+        across all namespaces, passing each through reduce as it is
+        read so that only the fields that are needed are kept.
+
+        Each kind is listed separately, a page at a time, with up to
+        LIST_LIMIT kinds in flight at once. A kind that can't be
+        listed is skipped, and added to skipped if it is supplied. If
+        none of the kinds can be listed that is an error.
+        """
+        errors = OrderedDict()
+        merged = OrderedDict()
+        def add(item):
+            md = item.get("metadata", {})
+            # the same resource can be served under more than one group
+            key = md.get("uid") or (item.get("kind"), md.get("namespace"), md.get("name"))
+            if key not in merged:
+                merged[key] = reduce(item)
+
+        requirements = label_selector(labels)
+        @task()
+        def list_kind(kind):
+            try:
+                if self.backend == "api":
+                    for item in self.api.list(kind, requirements, chunk_size=CHUNK_SIZE):
+                        add(item)
+                else:
+                    parser = JSONItems(add)
+                    _recovered(sh, "kubectl", "get", kind, "--all-namespaces", "-ojson",
+                               "--chunk-size=%s" % CHUNK_SIZE, selector(labels), output_handler=parser.feed)
+                    parser.close()
+            except (TaskError, ValueError), e:
+                # not every cluster serves every kind
+                task.info("skipping %s: %s" % (kind, e))
+                errors[kind] = e
+            return OMIT
+
+        list(project(list_kind, kinds, API_LIMIT if self.backend == "api" else LIST_LIMIT))
+        if kinds and len(errors) == len(kinds):
+            raise TaskError("unable to list any resources: %s" % errors.values()[0])
+        if skipped is not None:
+            skipped.extend(k for k in kinds if k in errors)
+        return merged.values()
+
     @task()
-    def delete(self, labels):
-        # never try to delete namespaces or storage classes because they are shared resources
-        all = ",".join(r for r in ALL if r not in ('ns', 'sc'))
-        lines = sh("kubectl", "get", all, '--all-namespaces', selector(labels), '-ogo-template={{range .items}}{{.kind}} {{.metadata.namespace}} {{.metadata.name}}{{"\\n"}}{{end}}').output.splitlines()
-
-        byns = {}
-        for line in lines:
-            parts = line.split()
-            if len(parts) == 2:
-                kind, name = parts
-                namespace = None
-            else:
-                kind, namespace, name = parts
-            if namespace not in byns:
-                byns[namespace] = []
-            byns[namespace].append((kind, name))
-        for ns in sorted(byns.keys()):
-            names = sorted("%s/%s" % (k, n) for k, n in byns[ns])
-            if ns is None:
-                sh("kubectl", "delete", *names)
+    def _api_live_hashes(self, yaml_dirs, namespace):
+        def live(doc):
+            md = doc.get("metadata") or {}
+            api_version = doc.get("apiVersion", "v1")
+            obj = self.api.get(doc["kind"], md["name"], md.get("namespace") or self.namespace, api_version)
+            anns = (obj or {}).get("metadata", {}).get("annotations") or {}
+            key = api_group(api_version), doc["kind"].lower(), md.get("namespace") or namespace, md["name"]
+            return key, anns.get(HASH)
+        docs = [d for d in self._api_documents(self._stream(yaml_dirs)) if (d.get("metadata") or {}).get("name")]
+        return dict(project(live, docs, API_LIMIT))
+
+    def _api_documents(self, content):
+        for doc in safe_load_all(content):
+            if not isinstance(doc, dict) or not doc.get("kind"):
+                continue
+            if doc["kind"].endswith("List") and "items" in doc:
+                for item in doc["items"]:
+                    yield item
             else:
-                sh("kubectl", "delete", "-n", ns, *names)
+                yield doc
+
+    def _api_apply(self, content, prune=None):
+        """
+        Server side apply the supplied yaml, and prune if asked. The
+        result mimics kubectl's output so it can be parsed with
+        applied().
+        """
+        lines = []
+        code = 0
+        keep = set()
+        for doc in self._api_documents(content):
+            md = doc.get("metadata") or {}
+            name = resource_name(doc.get("apiVersion", "v1"), doc["kind"], md.get("name"))
+            try:
+                obj, created = self.api.apply(doc, namespace=self.namespace, dry_run=self.dry_run)
+            except TaskError, e:
+                lines.append(str(e))
+                code = 1
+                continue
+            keep.add(obj["metadata"].get("uid"))
+            lines.append("%s %s%s" % (name, "created" if created else "serverside-applied",
+                                      " (dry run)" if self.dry_run else ""))
+        if prune and not code:
+            for item in self._list(self._unshared(), prune, _identity):
+                md = item["metadata"]
+                # only prune what forge applied in the first place
+                managers = [(f.get("manager"), f.get("operation")) for f in md.get("managedFields") or ()]
+                if md.get("uid") in keep or (FIELD_MANAGER, "Apply") not in managers:
+                    continue
+                self.api.delete(item["kind"], md["name"], md.get("namespace"), dry_run=self.dry_run)
+                lines.append("%s pruned" % resource_name(item["apiVersion"], item["kind"], md["name"]))
+        return SHResult("apply (%s)" % self.api.config.server, code, "".join("%s\n" % l for l in lines))
+
+    def _watch(self, resource, labels, handler, timeout):
+        """
+        Call handler with each state of the resources of a kind that
+        match the labels until it raises StopIteration or the timeout
+        is hit.
+        """
+        if self.backend == "api":
+            events = self.api.watch(resource, label_selector(labels), self.namespace, timeout)
+            try:
+                for event in events:
+                    if event["type"] in ("ADDED", "MODIFIED"):
+                        handler(event["object"])
+            except StopIteration:
+                events.close()
+            return
+
+        lines = []
+        def feed(line):
+            # kubectl prints each object as indented json
+            lines.append(line)
+            if line.rstrip() == "}":
+                text = "".join(lines)
+                del lines[:]
+                handler(json.loads(text[text.index("{"):]))
+
+        cmd = ["kubectl", "get", resource, "--watch", "-ojson", "--request-timeout=%ss" % timeout, selector(labels)]
+        cmd.extend(["-n", self.namespace] if self.namespace else ["--all-namespaces"])
+        # kubectl exits nonzero when the request times out
+        sh(*cmd, output_handler=feed, expected=(0, 1))
+
+    @task()
+    def wait(self, names, labels, timeout=ROLLOUT_TIMEOUT):
+        """
+        Wait for the rollout of the named resources to finish, where
+        names are kubectl resource names like deployment.apps/foo.
+        Rather than polling each resource there is a single watch per
+        kind, selected by labels, and the rollout of every resource is
+        tracked from its events. Raises a TaskError if a rollout fails
+        or the timeout is hit before everything is ready.
+        """
+        expected = OrderedDict()
+        for name in names:
+            kind, _, group = name.partition("/")[0].partition(".")
+            if kind in ROLLOUT_KINDS:
+                expected.setdefault("%ss.%s" % (kind, group) if group else "%ss" % kind, set()).add(name)
+
+        states = {}
+        deadline = time.time() + timeout
+
+        @task()
+        def watch(resource):
+            def update(item):
+                kind = item["kind"].lower()
+                name = resource_name(item.get("apiVersion", "v1"), item["kind"], item["metadata"]["name"])
+                if name not in expected[resource]:
+                    return
+                states[name] = (rollout(kind, item), status_summary(kind, item.get("status") or {}))
+                done = [states.get(n, (PROGRESSING,))[0] != PROGRESSING for n in expected[resource]]
+                if all(done) or any(state == FAILED for state, _ in states.values()):
+                    raise StopIteration()
+            self._watch(resource, labels, update, max(1, int(deadline - time.time())))
+            return OMIT
+
+        list(project(watch, expected.keys()))
+
+        unfinished = []
+        for resource, pending in expected.items():
+            for name in sorted(pending):
+                state, summary = states.get(name, (PROGRESSING, "(none)"))
+                task.info("%s %s: %s" % (name, state, summary))
+                if state != READY:
+                    unfinished.append(name)
+        if unfinished:
+            raise TaskError("rollout of %s did not finish" % ", ".join(unfinished))
+
+    @task()
+    def sync(self, interval=SYNC_INTERVAL, rounds=None):
+        """
+        Keep the snapshot of the forge deployed resources in the
+        cluster up to date, saving it every interval seconds, for the
+        given number of rounds or forever.
+
+        The api backend lists each kind once and then watches it from
+        the resourceVersion of the list, listing again only when that
+        is too old to watch from. The kubectl backend lists everything
+        again every interval.
+
+        The snapshot is only saved while every kind is in sync, kinds
+        that couldn't be listed are tried again every interval. If a
+        watch fails, so does syncing.
+        """
+        labels = {"forge.service": None}
+        if self.backend != "api":
+            count = 0
+            while rounds is None or count < rounds:
+                skipped = []
+                items = self._list(self.kinds(), labels, skipped=skipped)
+                if skipped:
+                    task.info("not saving the snapshot, unable to list %s" % ", ".join(skipped))
+                else:
+                    self._snapshot(items).save()
+                count += 1
+                time.sleep(interval)
+            return
+
+        snapshot = Snapshot(self.snapshot_path())
+        requirements = label_selector(labels)
+        state = {"done": False, "failed": None}
+        # the kinds whose part of the snapshot is out of date, and those
+        # that haven't been listed yet so aren't being watched
+        unsynced = set()
+        unwatched = set(self.kinds())
+
+        @task()
+        def list_kind(kind):
+            try:
+                items, version = self.api.list_versioned(kind, requirements, chunk_size=CHUNK_SIZE)
+            except TaskError, e:
+                task.info("skipping %s: %s" % (kind, e))
+                unsynced.add(kind)
+                return False
+            snapshot.replace(kind, [_project(i) for i in items], version)
+            unsynced.discard(kind)
+            return True
+
+        @task()
+        def watch_kind(kind):
+            while not state["done"]:
+                try:
+                    for event in self.api.watch(kind, requirements, timeout=WATCH_TIMEOUT,
+                                                resource_version=snapshot.resource_version(kind)):
+                        obj = event["object"]
+                        if event["type"] in ("ADDED", "MODIFIED", "DELETED"):
+                            snapshot.update(kind, event["type"], _project(obj),
+                                            (obj.get("metadata") or {}).get("resourceVersion"))
+                except APIError, e:
+                    if e.status != 410:
+                        unsynced.add(kind)
+                        state["failed"] = "watch of %s failed: %s" % (kind, e)
+                        return
+                    # the snapshot is too old to watch from
+                    if not list_kind(kind):
+                        time.sleep(interval)
+                except TaskError, e:
+                    task.info("watch of %s failed, retrying: %s" % (kind, e))
+                    time.sleep(interval)
+
+        def watch():
+            kinds = sorted(unwatched)
+            for kind, listed in zip(kinds, project(list_kind, kinds, API_LIMIT)):
+                if listed:
+                    unwatched.discard(kind)
+                    watch_kind.go(kind)
+
+        try:
+            count = 0
+            while True:
+                if unwatched:
+                    watch()
+                if state["failed"]:
+                    raise TaskError(state["failed"])
+                if unsynced:
+                    task.info("not saving the snapshot, %s not in sync" % ", ".join(sorted(unsynced)))
+                else:
+                    snapshot.save()
+                count += 1
+                if rounds is not None and count >= rounds:
+                    break
+                time.sleep(interval)
+        finally:
+            state["done"] = True
+
+    @task()
+    def delete(self, labels, limit=DELETE_LIMIT, wait=False, timeout=DELETE_TIMEOUT):
+        """
+        Delete the resources matching the labels. Each namespace is
+        deleted from separately, with up to limit namespaces at once,
+        and without waiting for finalizers. If wait is true, return
+        only once all the deleted resources are gone. Nothing is
+        deleted unless every kind can be listed.
+        """
+        # never try to delete namespaces or storage classes because they are shared resources
+        skipped = []
+        items = self._list(self._unshared(), labels, _reference, skipped=skipped)
+        if skipped:
+            raise TaskError("unable to list %s, not deleting anything" % ", ".join(skipped))
+        byns = OrderedDict()
+        for item in items:
+            md = item["metadata"]
+            byns.setdefault(md.get("namespace"), []).append(item)
+
+        timings = {}
+        @task()
+        def delete_namespace(ns):
+            start = time.time()
+            self._delete(ns, byns[ns])
+            timings[ns] = time.time() - start
+            return OMIT
+
+        @task()
+        def wait_namespace(ns):
+            start = time.time()
+            self._wait_deleted(ns, byns[ns], timeout)
+            timings[ns] += time.time() - start
+            return OMIT
+
+        namespaces = sorted(byns.keys())
+        list(project(delete_namespace, namespaces, limit))
+        if wait and not self.dry_run:
+            list(project(wait_namespace, namespaces, limit))
+
+        for ns in namespaces:
+            task.info("%s: %d resource(s) deleted in %.1fs" % (ns or "(cluster)", len(byns[ns]), timings[ns]))
+
+    def _delete(self, ns, items):
+        if self.backend == "api":
+            for item in items:
+                md = item["metadata"]
+                self.api.delete(item["kind"], md["name"], ns, dry_run=self.dry_run)
+                task.info("%s deleted" % resource_name(item["apiVersion"], item["kind"], md["name"]))
+            return
+
+        names = sorted(resource_name(i.get("apiVersion", "v1"), i["kind"], i["metadata"]["name"]) for i in items)
+        if ns is None:
+            sh("kubectl", "delete", "--wait=false", *names)
+        else:
+            sh("kubectl", "delete", "--wait=false", "-n", ns, *names)
+
+    def _wait_deleted(self, ns, items, timeout):
+        if self.backend == "api":
+            deadline = time.time() + timeout
+            for item in items:
+                md = item["metadata"]
+                while self.api.get(item["kind"], md["name"], ns, item["apiVersion"]) is not None:
+                    if time.time() > deadline:
+                        raise TaskError("timed out waiting for %s to be deleted" %
+                                        resource_name(item["apiVersion"], item["kind"], md["name"]))
+                    time.sleep(1)
+            return
+
+        names = sorted(resource_name(i.get("apiVersion", "v1"), i["kind"], i["metadata"]["name"]) for i in items)
+        nsargs = ["-n", ns] if ns is not None else []
+        deadline = time.time() + timeout
+        left = timeout
+        while names:
+            result = sh(*(["kubectl", "wait", "--for=delete", "--timeout=%ss" % left] + nsargs + names), expected=(0, 1))
+            if result.code == 0:
+                return
+            if "timed out" in result.output:
+                raise TaskError(result)
+            # kubectl wait fails for resources that are already gone, so
+            # wait again for those that are left, if that's why it failed
+            remaining = sh(*(["kubectl", "get", "--ignore-not-found", "-o", "name"] + nsargs + names)).output.split()
+            if len(remaining) >= len(names):
+                raise TaskError(result)
+            names = remaining
+            left = max(1, int(deadline - time.time()))
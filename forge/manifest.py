@@ -0,0 +1,273 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib, json, os, tempfile, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from yaml import emit
+from .istio import inject, inject_all
+from .yamlbackend import parse
+from .kubernetes import HASH, RESOURCE_KEYS, fixup, fixup_events, fixup_file, hash_events, manifest_hash, \
+    resource_names
+from .yamlutil import compose_all, serialize_all, skim, view
+
+NULL = u'tag:yaml.org,2002:null'
+
+# manifests bigger than this are never composed into node trees, they
+# are streamed through fixup_events when written out instead
+STREAM_SIZE = 4*1024*1024
+
+# bump this whenever a change to forge changes its output for the same
+# templates and metadata, so that stale render stamps are ignored
+RENDER_VERSION = "1"
+
+def _file_hash(path):
+    digest = hashlib.sha1()
+    with open(path) as f:
+        for chunk in iter(lambda: f.read(64*1024), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _tree(directory):
+    """
+    Return the relative paths of all the files in a directory tree.
+    """
+    result = []
+    for path, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            result.append(os.path.relpath(os.path.join(path, name), directory))
+    return result
+
+def render_key(template_dir, metadata, labels, annotations, istio):
+    """
+    Return a hash of everything that goes into the manifests of a
+    service: the templates, the metadata they are rendered with, the
+    labels and annotations they are fixed up with and the istio
+    configuration they are injected with.
+
+    The environment in the metadata is left out, the variables the
+    templates actually looked up are recorded by RenderStamp.
+    """
+    digest = hashlib.sha1(RENDER_VERSION)
+    for relpath in _tree(template_dir):
+        digest.update("%s\0%s\0" % (relpath, _file_hash(os.path.join(template_dir, relpath))))
+    metadata = dict((k, v) for k, v in metadata.items() if k != "env")
+    digest.update(json.dumps([metadata, labels, annotations, istio], sort_keys=True, default=str))
+    return digest.hexdigest()
+
+def _env_key(key, names):
+    "Return key combined with the current values of the named environment variables."
+    return hashlib.sha1(repr((str(key), [(str(n), os.environ.get(n)) for n in names]))).hexdigest()
+
+def sync_tree(source, target):
+    """
+    Make target an exact copy of source, moving over only files whose
+    content differs, so that unchanged files are left untouched.
+    Returns the relative paths of the files that changed.
+    """
+    if not os.path.exists(target):
+        os.makedirs(target)
+    changed = []
+    wanted = set(_tree(source))
+    for relpath in sorted(wanted):
+        src = os.path.join(source, relpath)
+        dst = os.path.join(target, relpath)
+        if os.path.isfile(dst) and _file_hash(dst) == _file_hash(src):
+            continue
+        if not os.path.exists(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        os.rename(src, dst)
+        changed.append(relpath)
+    for relpath in _tree(target):
+        if relpath not in wanted:
+            os.remove(os.path.join(target, relpath))
+            changed.append(relpath)
+    for path, dirs, files in os.walk(target, topdown=False):
+        if path != target and not os.listdir(path):
+            os.rmdir(path)
+    return changed
+
+class RenderStamp(object):
+
+    """
+    A record of the last render of a service's manifests: the render
+    key it was done for, the environment variables its templates
+    looked up, the resources it produced, and the hashes of the files
+    it wrote. It is kept next to the output directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = directory.rstrip(os.sep) + ".stamp"
+
+    def get(self, key):
+        """
+        Return the resources of the last render if it was done for key
+        with the same values of the environment variables it looked up
+        and its output is still intact, otherwise None.
+        """
+        try:
+            with open(self.path) as f:
+                stamp = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if stamp.get("key") != _env_key(key, stamp.get("env", ())) or not os.path.isdir(self.directory):
+            return None
+        files = stamp.get("files", {})
+        if sorted(files) != _tree(self.directory):
+            return None
+        for relpath, digest in files.items():
+            if _file_hash(os.path.join(self.directory, relpath)) != digest:
+                return None
+        return stamp["resources"]
+
+    def put(self, key, resources, env=None):
+        """
+        Record a render done for key. If the templates were rendered
+        with a RecordingEnv it is supplied as env, and nothing is
+        recorded if they enumerated the environment.
+        """
+        if env is not None and env.everything:
+            self.clear()
+            return
+        names = sorted(env.used) if env is not None else []
+        files = dict((relpath, _file_hash(os.path.join(self.directory, relpath)))
+                     for relpath in _tree(self.directory))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": _env_key(key, names), "env": names, "resources": resources, "files": files}, f)
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Manifests(object):
+
+    """
+    The rendered manifests for a service. The manifests are read and
+    parsed once, post-processed in memory as yaml node trees (istio
+    injection, labels, annotations), and then written out once. All
+    the files go through istio injection in a single batch.
+
+    Every resource is annotated with a hash of its final manifest so
+    that unchanged resources can be skipped when deploying.
+
+    Files larger than stream_size are not parsed into node trees,
+    their fixups (and hashes) are applied on the yaml event stream at
+    write time.
+
+    The time spent in each stage is recorded in timings.
+    """
+
+    def __init__(self, directory, stream_size=STREAM_SIZE):
+        self.directory = directory
+        self.stream_size = stream_size
+        self.documents = OrderedDict()
+        # name -> injected content, or None to stream from the file
+        self.streamed = OrderedDict()
+        self.fixups = None
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.time() - start)
+
+    def report(self):
+        return ", ".join("%s %.3fs" % (name, elapsed) for name, elapsed in self.timings.items())
+
+    def load(self):
+        with self.stage("load"):
+            self.documents.clear()
+            self.streamed.clear()
+            self.fixups = None
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if not os.path.isfile(path): continue
+                if os.path.getsize(path) > self.stream_size:
+                    self.streamed[name] = None
+                    continue
+                with open(path) as f:
+                    self.documents[name] = list(compose_all(f))
+
+    def resources(self):
+        """
+        Return the kubectl names of the loaded resources.
+        """
+        result = []
+        for name, docs in self.documents.items():
+            result.extend(resource_names(view(nd) for nd in docs))
+        for name in self.streamed:
+            with open(os.path.join(self.directory, name)) as f:
+                result.extend(resource_names(skim(f, RESOURCE_KEYS)))
+        return result
+
+    def inject(self, ipranges=None):
+        with self.stage("istio"):
+            names = self.documents.keys()
+            injected = inject_all([self.documents[name] for name in names], ipranges)
+            self.documents.update(zip(names, injected))
+            for name, content in self.streamed.items():
+                if content is None:
+                    with open(os.path.join(self.directory, name)) as f:
+                        content = f.read()
+                self.streamed[name] = inject(content, ipranges)
+
+    def fixup(self, labels, annotations):
+        with self.stage("label"):
+            self.fixups = OrderedDict((("labels", labels), ("annotations", annotations)))
+            for name, docs in self.documents.items():
+                fixed = []
+                for nd in docs:
+                    # we filter out null nodes because istioctl sticks
+                    # them in for some reason, and then we end up
+                    # serializing them in a way that kubectl doesn't
+                    # understand
+                    if nd.tag == NULL:
+                        continue
+                    fixup(nd, "labels", labels)
+                    fixup(nd, "annotations", annotations)
+                    fixup(nd, "annotations", {HASH: manifest_hash(nd)})
+                    fixed.append(nd)
+                self.documents[name] = fixed
+
+    def write(self):
+        with self.stage("write"):
+            for name, docs in self.documents.items():
+                with open(os.path.join(self.directory, name), "write") as f:
+                    f.write(serialize_all(docs))
+            for name, content in self.streamed.items():
+                path = os.path.join(self.directory, name)
+                if content is None:
+                    if self.fixups is not None:
+                        with open(path) as f:
+                            hashes = self._hashes(f)
+                        fixup_file(path, self.fixups, hashes)
+                    continue
+                events = parse(content)
+                if self.fixups is not None:
+                    events = fixup_events(events, self.fixups, self._hashes(content))
+                with open(path, "write") as f:
+                    emit(events, f)
+
+    def _hashes(self, source):
+        # the hash of a streamed document is computed in a separate
+        # pass over it, so that the document needn't be held in memory
+        return [{"annotations": {HASH: digest}}
+                for digest in hash_events(fixup_events(parse(source), self.fixups))]
@@ -19,6 +19,11 @@ class MatchError(Exception):
 
 EPSILON = object()
 
+# the maximum number of transitions kept for each DFA state; the
+# transitions are keyed by argument class, so this bounds the memory
+# used by dispatchers that see an unbounded number of classes
+MATCH_CACHE_SIZE = 1024
+
 class State:
 
     sequence = 0
@@ -30,6 +35,9 @@ class State:
         self.epsilons = ()
         self.action = None
         self.match_value = True
+        self.keys = None
+        self.dstates = None
+        self.dfa = None
 
     @property
     def transitions(self):
@@ -143,48 +151,145 @@ class State:
         else:
             return "State(S%s)" % self.id
 
+    def _dstate(self, states):
+        key = frozenset(states.items())
+        dstate = self.dstates.get(key)
+        if dstate is None:
+            dstate = self.dstates[key] = DState(states)
+        return dstate
+
+    def _determinize(self):
+        """
+        Prepare the DFA for this pattern. It is built lazily as values
+        are matched, so forcing the pattern's delayed keys is deferred
+        until the first match, when recursive references (e.g. to the
+        class being defined) can be resolved.
+        """
+        if self.dfa is None:
+            self.force()
+            self.keys = frozenset(k for s in self.nodes for k in s.matches if not isinstance(k, Marker))
+            self.dstates = {}
+            self.dfa = self._dstate({self: 0})
+        return self.dfa
+
+    def _step(self, dstate, value):
+        """
+        Compute the DFA state reached from dstate on value, by subset
+        construction. As when simulating the NFA, a state's distance
+        extends the distance of the state it was reached from with the
+        index of the projection it was reached by, and the nearest
+        distance is kept. Only the order of distances matters, so they
+        are replaced by their rank to keep the DFA finite.
+        """
+        if not dstate.states:
+            return dstate
+        next = {}
+        for state, rank in dstate.states.items():
+            count = 0
+            for proj in projections(value, state.match_value):
+                for s in state[proj]:
+                    distance = (rank, count)
+                    if s not in next or distance < next[s]:
+                        next[s] = distance
+                count += 1
+        ranks = dict((d, i) for i, d in enumerate(sorted(set(next.values()))))
+        return self._dstate(dict((s, ranks[d]) for s, d in next.items()))
+
     def match(self, *args, **kwargs):
+        dstate = self._determinize()
+        keys = self.keys
+        # like projections, only the start state can skip matching values
+        match_value = self.match_value
+        for value in flatten(args):
+            # a transition is keyed by the class of the value, along with
+            # the value itself if the pattern matches on it, or by the
+            # marker around a nested sequence; the projections of values
+            # carrying MATCH_TRAITS and of super objects aren't
+            # determined by their class, so those are simulated
+            if isinstance(value, Marker):
+                key = value
+            elif isinstance(value, super) or getattr(value, "MATCH_TRAITS", None) is not None:
+                return self._match(args)
+            else:
+                key = value.__class__
+                if match_value:
+                    try:
+                        if value in keys:
+                            key = (key, value)
+                    except TypeError:
+                        pass
+            match_value = True
+            next = dstate.transitions.get(key)
+            if next is None:
+                next = self._step(dstate, value)
+                if len(dstate.transitions) >= MATCH_CACHE_SIZE:
+                    dstate.transitions.clear()
+                dstate.transitions[key] = next
+            dstate = next
+        if dstate.action is None:
+            self._fail(args, dstate.nearest)
+        return dstate.action
+
+    def _match(self, args):
+        "Match args by simulating the NFA."
         states = {self: ()}
-        remaining = list(args)
         for value in flatten(args):
             next = {}
             for state, distance in states.items():
                 count = 0
                 for proj in projections(value, state.match_value):
-                    transitions = state[proj]
-                    if transitions:
-                        for s in transitions:
-                            if s not in next:
-                                next[s] = distance + (count,)
+                    for s in state[proj]:
+                        if s not in next or distance + (count,) < next[s]:
+                            next[s] = distance + (count,)
                     count += 1
             states = next
-        nearest = {}
-        minimum = None
-        for state, distance in states.items():
-            if state.action:
-                if minimum is None:
-                    nearest = {state.action: state}
-                    minimum = distance
-                elif distance < minimum:
-                    nearest = {state.action: state}
-                    minimum = distance
-                elif distance == minimum:
-                    nearest[state.action] = state
+        nearest = _nearest(states)
+        if len(nearest) != 1:
+            self._fail(args, nearest)
+        return nearest[0]
+
+    def _fail(self, args, nearest):
         if len(nearest) > 1:
-            dfns = "\n".join([ppfun(n.action) for n in nearest.values()])
+            dfns = "\n".join([ppfun(a) for a in nearest])
             raise MatchError("arguments ({}) match multiple actions:\n\n{}".format(ppargs(args), dfns))
-        if not nearest:
+        else:
             dfns = "\n".join([ppfun(n.action) for n in self.nodes if n.action])
             raise MatchError("arguments ({}) do not match:\n\n{}".format(ppargs(args), dfns))
-        assert len(nearest) == 1, nearest
-        state = nearest.popitem()[1]
-        assert state.action, (state, remaining)
-        return state.action
 
     def apply(self, *args, **kwargs):
         return self.match(*args, **kwargs)(*args, **kwargs)
 
 
+def _nearest(states):
+    """
+    Return the distinct actions of the nearest accepting states, given
+    a map from states to distances.
+    """
+    accepting = [(d, s.id, s.action) for s, d in states.items() if s.action]
+    if not accepting:
+        return []
+    minimum = min(accepting)[0]
+    nearest = []
+    for d, _, action in sorted(accepting):
+        if d == minimum and action not in nearest:
+            nearest.append(action)
+    return nearest
+
+class DState(object):
+
+    """
+    A state of the DFA for a pattern: the NFA states that are active,
+    mapped to the rank of their distance. Whether the state accepts,
+    and if the nearest match is ambiguous, is worked out when the
+    state is built rather than on every match.
+    """
+
+    def __init__(self, states):
+        self.states = states
+        self.transitions = {}
+        self.nearest = _nearest(states)
+        self.action = self.nearest[0] if len(self.nearest) == 1 else None
+
 def deduplicate(items):
     deduped = []
     for item in items:
@@ -171,8 +171,9 @@ code:
 
 import base64, os, StringIO, textwrap
 from collections import OrderedDict
-from yaml import ScalarNode, SequenceNode, MappingNode, CollectionNode, Node, compose_all
+from yaml import ScalarNode, SequenceNode, MappingNode, CollectionNode, Node
 from forge.match import match, many, opt
+from forge.yamlbackend import compose_all
 
 class SchemaError(Exception):
     pass
@@ -203,7 +204,17 @@ class Schema(object):
         if len(trees) != 1:
             raise SchemaError("%s: expected a single yaml document, found %s documents" % (name, len(trees)))
         tree = trees[0]
-        return self.load(tree)
+        return self.compile()(tree)
+
+    def compile(self):
+        """Return a function that loads a yaml node exactly as load does,
+        with all the dispatch on schema and node types done up front. The
+        schema is compiled on first use, so it shouldn't be modified after
+        it has been used to load anything."""
+        loader = self.__dict__.get("_loader")
+        if loader is None:
+            loader = self._loader = _compiled(self, {})
+        return loader
 
 @match(ScalarNode)
 def _scalar2py(node):
@@ -712,3 +723,208 @@ class Union(Schema):
         for s in self.schemas:
             for t in s.traversal:
                 yield t
+
+## compiled loaders
+##
+## Loading a node through the dispatched load methods costs several
+## dispatches per node. A schema tree can instead be compiled once
+## into plain functions that do the same checks in the same order and
+## so raise the same errors.
+
+def _fast_tag(node):
+    "The same as _tag for a node, without dispatching."
+    if isinstance(node, ScalarNode):
+        tag = node.tag
+        tag = tag[tag.rfind(":") + 1:]
+        return _YAML2ENGLISH.get(tag, tag)
+    elif isinstance(node, MappingNode):
+        return "map"
+    elif isinstance(node, SequenceNode):
+        return "sequence"
+    else:
+        return _tag(node)
+
+_SCALAR2PY = {
+    "null": lambda node: None,
+    "str": lambda node: node.value,
+    "int": lambda node: int(node.value),
+    "float": lambda node: float(node.value),
+    "bool": lambda node: node.value.lower() == "true"
+}
+
+def _fast_scalar2py(node):
+    tag = node.tag
+    convert = _SCALAR2PY.get(tag[tag.rfind(":") + 1:])
+    if convert is None:
+        # let dispatch report the tag it doesn't know
+        return _scalar2py(node)
+    return convert(node)
+
+def _owner(schema, name):
+    "Return the class whose definition of the named method a schema uses."
+    for cls in schema.__class__.__mro__:
+        if name in cls.__dict__:
+            return cls
+
+def _mismatch(schema, node):
+    raise SchemaError("expecting %s, got %s\n%s" % (schema.name, _fast_tag(node), node.start_mark))
+
+def _compiled(schema, memo):
+    loader = memo.get(schema)
+    if loader is None:
+        # recursive references resolve to the compiled loader once it exists
+        memo[schema] = lambda node: memo[schema](node)
+        compiler = _COMPILERS.get(_owner(schema, "load"))
+        if compiler is None:
+            loader = schema.load
+        else:
+            loader = compiler(schema, memo)
+        memo[schema] = loader
+    return loader
+
+def _compile_scalar(schema, memo):
+    tags = schema.tags
+    if len(tags) == 1:
+        expecting = tags[0]
+    else:
+        expecting = "one of (%s)" % "|".join(tags)
+    decoder = _DECODERS.get(_owner(schema, "decode"))
+    decode = schema.decode if decoder is None else decoder(schema, memo)
+
+    def load(node):
+        if not isinstance(node, ScalarNode):
+            _mismatch(schema, node)
+        if node.tag.endswith(":null"):
+            return None
+        actual = _fast_tag(node)
+        if actual not in tags:
+            raise SchemaError("expecting %s, got %s\n%s" % (expecting, actual, node.start_mark))
+        return decode(node)
+    return load
+
+def _decode_constant(schema, memo):
+    value = schema.value
+    load = _compiled(schema.type, memo)
+    def decode(node):
+        loaded = load(node)
+        if value != loaded:
+            raise SchemaError("expected %s, got %s\n%s" % (value, loaded, node.start_mark))
+        return loaded
+    return decode
+
+_DECODERS = {
+    Scalar: lambda schema, memo: _fast_scalar2py,
+    Boolean: lambda schema, memo: lambda node: node.value.lower() == "true",
+    String: lambda schema, memo: lambda node: node.value,
+    Base64: lambda schema, memo: lambda node: base64.decodestring(node.value),
+    Integer: lambda schema, memo: lambda node: int(node.value),
+    Float: lambda schema, memo: lambda node: float(node.value),
+    Constant: _decode_constant
+}
+
+def _compile_map(schema, memo):
+    item = _compiled(schema.type, memo)
+    def load(node):
+        if not isinstance(node, MappingNode):
+            _mismatch(schema, node)
+        result = OrderedDict()
+        for k, v in node.value:
+            result[k.value] = item(v)
+        return result
+    return load
+
+def _compile_sequence(schema, memo):
+    item = _compiled(schema.type, memo)
+    def load(node):
+        if not isinstance(node, SequenceNode):
+            _mismatch(schema, node)
+        return [item(n) for n in node.value]
+    return load
+
+def _compile_any(schema, memo):
+    def load(node):
+        if isinstance(node, ScalarNode):
+            return _fast_scalar2py(node)
+        elif isinstance(node, MappingNode):
+            result = OrderedDict()
+            for k, v in node.value:
+                result[k.value] = load(v)
+            return result
+        elif isinstance(node, SequenceNode):
+            return [load(n) for n in node.value]
+        else:
+            _mismatch(schema, node)
+    return load
+
+def _compile_class(schema, memo):
+    fields = dict((name, (f.alias or f.name, _compiled(f.type, memo))) for name, f in schema.fields.items())
+    defaults = [(f.alias or f.name, f.name, f.default) for f in schema.fields.values()]
+    constructor = schema.constructor
+    strict = schema.strict
+    unknown = None if strict else _compiled(Any(), memo)
+
+    def load(node):
+        if not isinstance(node, MappingNode):
+            _mismatch(schema, node)
+        loaded = {}
+        for k, v in node.value:
+            key = k.value
+            if key in fields:
+                alias, field = fields[key]
+            elif strict:
+                raise SchemaError("no such field: %s\n%s" % (key, k.start_mark))
+            else:
+                alias, field = key, unknown
+            loaded[alias] = field(v)
+        for key, name, default in defaults:
+            if key not in loaded:
+                if default is REQUIRED:
+                    raise SchemaError("required field '%s' is missing\n%s" % (name, node.start_mark))
+                elif default is not OMIT:
+                    loaded[key] = default
+        try:
+            return constructor(**loaded)
+        except SchemaError, e:
+            raise SchemaError("%s\n\n%s" % (e, node.start_mark))
+    return load
+
+def _compile_union(schema, memo):
+    tags = dict((t, _compiled(s, memo)) for t, s in schema.tags.items())
+    classes = [s for s in schema.schemas if isinstance(s, Class)]
+    loaders = dict((s, _compiled(s, memo)) for s in classes)
+    signatures = schema.signatures
+    constants = schema.constants
+
+    def load(node):
+        t = _fast_tag(node)
+        if signatures and t == "map":
+            candidates = set(classes)
+            for k, v in node.value:
+                if v.tag.endswith(":map") or v.tag.endswith(":seq"): continue
+                if k.value in constants and v.value in constants[k.value]:
+                    candidates.intersection_update(constants[k.value][v.value])
+            if len(candidates) == 1:
+                return loaders[candidates.pop()](node)
+            else:
+                raise SchemaError("expecting one of (%s), got %s\n%s" % ("|".join(str(s) for s in signatures), t,
+                                                                           node.start_mark))
+        if t not in tags:
+            v = node.value
+            if (isinstance(v, str) or isinstance(v, unicode)):
+                if v not in tags:
+                    raise SchemaError("expecting one of (%s), got %s(%s)" % ("|".join(str(s) for s in
+                                                                          schema.tags.keys() + signatures), t, v))
+                return tags[v](node)
+            raise SchemaError("expecting one of (%s), got %s" % ("|".join(str(s) for s in
+            schema.tags.keys() + signatures), t))
+        return tags[t](node)
+    return load
+
+_COMPILERS = {
+    Scalar: _compile_scalar,
+    Map: _compile_map,
+    Sequence: _compile_sequence,
+    Any: _compile_any,
+    Class: _compile_class,
+    Union: _compile_union
+}
@@ -12,18 +12,117 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy, errno, fnmatch, hashlib, jsonschema, os, pathspec, util, yaml
+import copy, cPickle, errno, fnmatch, hashlib, json, jsonschema, os, pathspec, tempfile, util, yaml
 from collections import OrderedDict
 from forge import service_info
-from .jinja2 import render, renders
+from .jinja2 import collect_warnings, render, renders, warn
 from .schema import SchemaError
 from .tasks import sh, task, TaskError
 from .github import Github
 from forge import yamlutil
+from . import __version__
+
+# where validated service.yaml contents are cached across runs
+SERVICE_CACHE = os.path.expanduser("~/.forge/services")
+
+# bump this whenever a change to forge changes what is loaded from the
+# same service.yaml, so that stale cache entries are ignored
+SERVICE_CACHE_VERSION = "2"
+
+# the number of files kept in SERVICE_CACHE, the least recently used
+# are removed beyond that
+SERVICE_CACHE_SIZE = 1000
+
+def _digest(*parts):
+    return hashlib.sha1(repr((__version__, SERVICE_CACHE_VERSION) + parts)).hexdigest()
+
+def _write_atomic(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.rename(tmp, path)
+
+def _prune():
+    try:
+        paths = [os.path.join(SERVICE_CACHE, n) for n in os.listdir(SERVICE_CACHE)]
+    except OSError:
+        return
+    if len(paths) <= SERVICE_CACHE_SIZE:
+        return
+    def mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+    for path in sorted(paths, key=mtime)[:len(paths) - SERVICE_CACHE_SIZE]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _touch(*paths):
+    for path in paths:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+def _load_cached(path, content, key, vars):
+    index = os.path.join(SERVICE_CACHE, "%s.env" % key)
+    try:
+        with open(index) as f:
+            names = [str(n) for n in json.load(f)]
+    except (IOError, ValueError):
+        names = None
+    if names is not None:
+        entry = os.path.join(SERVICE_CACHE, "%s.pickle" % _digest(key, [(n, os.environ.get(n)) for n in names]))
+        try:
+            with open(entry, "rb") as f:
+                result, warnings = cPickle.load(f)
+            _touch(index, entry)
+        except Exception:
+            pass
+        else:
+            # the warnings of the original render are repeated
+            for msg in warnings:
+                warn(msg)
+            return result
+
+    env = util.RecordingEnv(os.environ)
+    result, warnings = collect_warnings(load_service_yamls, path, content, env=env, **vars)
+    if not env.everything:
+        names = sorted(env.used)
+        entry = os.path.join(SERVICE_CACHE, "%s.pickle" % _digest(key, [(n, env.used[n]) for n in names]))
+        _write_atomic(entry, cPickle.dumps((result, warnings), cPickle.HIGHEST_PROTOCOL))
+        _write_atomic(index, json.dumps(names))
+        _prune()
+    return result
+
+_LOADED = {}
 
 def load_service_yaml(path, **vars):
+    """
+    Load a service.yaml, rendering it with the environment and the
+    supplied variables.
+
+    The result is kept for the rest of the run, and cached on disk in
+    SERVICE_CACHE keyed by the version of forge, the content of the
+    file, the variables, and the values of the environment variables
+    the template looked up, so an unchanged descriptor skips rendering
+    and validation. Only the SERVICE_CACHE_SIZE most recently used
+    files are kept.
+    """
     with open(path, "read") as f:
-        return load_service_yamls(path, f.read(), **vars)
+        content = f.read()
+    if "env" in vars:
+        return load_service_yamls(path, content, **vars)
+    key = _digest(os.path.abspath(path), hashlib.sha1(content).hexdigest(), sorted(vars.items()))
+    if key not in _LOADED:
+        _LOADED[key] = _load_cached(path, content, key, vars)
+    return copy.deepcopy(_LOADED[key])
 
 def _dump_and_raise(rendered, e):
     task.echo("==unparseable service yaml==")
@@ -71,17 +170,26 @@ def get_search_path(forge, svc):
     for p in svc.search_path:
         yield os.path.join(forge.base, p)
 
+# the top level keys that mark a yaml file as a kubernetes resource
+K8S_KEYS = frozenset(("apiVersion", "kind", "metadata"))
+
 def is_service_descriptor(path):
+    """
+    Check whether a service.yaml is a service descriptor rather than a
+    kubernetes resource. Only the top level keys of the first document
+    are looked at, and parsing stops as soon as they are all found.
+    """
+    found = set()
     try:
-        objs = yamlutil.load(path)
+        with open(path) as f:
+            for key in yamlutil.top_level_keys(f):
+                found.add(key)
+                if found >= K8S_KEYS:
+                    return False
     except yaml.parser.ParserError, e:
         return True
     except yaml.scanner.ScannerError, e:
         return True
-    if objs:
-        first = objs[0]
-        if "apiVersion" in first and "kind" in first and "metadata" in first:
-            return False
     return True
 
 class Discovery(object):
@@ -362,9 +470,11 @@ class Service(object):
     def manifest_target_dir(self):
         return os.path.join(self.root, ".forge", "k8s", self.name)
 
-    def deployment(self):
+    def deployment(self, target=None, env=None):
         metadata = self.metadata()
-        render(self.manifest_dir, self.manifest_target_dir, **metadata)
+        if env is not None:
+            metadata["env"] = env
+        render(self.manifest_dir, target or self.manifest_target_dir, **metadata)
 
     def info(self):
         if self._info is None:
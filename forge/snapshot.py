@@ -0,0 +1,100 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local copy of the forge deployed resources in a cluster, so that
+repeated queries don't have to download the whole cluster state.
+"""
+
+import json, os, tempfile, time
+from collections import OrderedDict
+
+def _key(item):
+    md = item.get("metadata") or {}
+    return md.get("uid") or "%s/%s/%s" % (item.get("kind"), md.get("namespace"), md.get("name"))
+
+class Snapshot(object):
+
+    """
+    The resources of a cluster by kind, along with the resourceVersion
+    each kind was last synced at. A snapshot is saved to a file
+    stamped with the time it was saved, and is only loaded while it is
+    younger than the caller's freshness bound.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.kinds = {}
+        self.time = None
+
+    @classmethod
+    def load(cls, path, max_age):
+        """
+        Load the snapshot saved at path, or return None if there isn't
+        one or it is older than max_age seconds.
+        """
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - saved.get("time", 0) > max_age:
+            return None
+        snapshot = cls(path)
+        snapshot.kinds = saved["kinds"]
+        snapshot.time = saved["time"]
+        return snapshot
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.time = time.time()
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"time": self.time, "kinds": self.kinds}, f)
+        os.rename(tmp, self.path)
+
+    def replace(self, kind, items, resource_version=None):
+        """
+        Replace all the resources of a kind, e.g. after a list.
+        """
+        self.kinds[kind] = {"resourceVersion": resource_version,
+                            "items": dict((_key(i), i) for i in items)}
+
+    def update(self, kind, event, item, resource_version=None):
+        """
+        Apply a watch event to the resources of a kind.
+        """
+        entry = self.kinds.setdefault(kind, {"resourceVersion": None, "items": {}})
+        if event == "DELETED":
+            entry["items"].pop(_key(item), None)
+        else:
+            entry["items"][_key(item)] = item
+        if resource_version:
+            entry["resourceVersion"] = resource_version
+
+    def resource_version(self, kind):
+        return (self.kinds.get(kind) or {}).get("resourceVersion")
+
+    def items(self):
+        """
+        Return all the resources, with any resource that was seen under
+        more than one kind reported once.
+        """
+        seen = OrderedDict()
+        for kind in sorted(self.kinds):
+            for key, item in sorted(self.kinds[kind]["items"].items()):
+                seen.setdefault(key, item)
+        return seen.values()
@@ -12,10 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import eventlet, functools, sys, os
+import errno, eventlet, functools, sys, os
 from contextlib import contextmanager
 from eventlet.corolocal import local
 from eventlet.green import time
+from eventlet.semaphore import Semaphore
 from .sentinel import Sentinel
 
 logging = eventlet.import_patched('logging')
@@ -312,8 +313,18 @@ def _taskify(obj):
             return obj(*args, **kwargs)
         return applicator
 
-def project(task, sequence):
+def _bounded(t, limit):
+    semaphore = Semaphore(limit)
+    @task()
+    def bounded(*args, **kwargs):
+        with semaphore:
+            return t(*args, **kwargs)
+    return bounded
+
+def project(task, sequence, limit=None):
     task = _taskify(task)
+    if limit is not None:
+        task = _bounded(task, limit)
     execs = []
     for obj in sequence:
         execs.append(task.go(obj))
@@ -352,11 +363,34 @@ class SHResult(object):
         else:
             return self.output
 
+def _feed(stream, input):
+    try:
+        stream.write(input)
+    except IOError, e:
+        # the command exited without reading all its input, its exit
+        # status tells the rest of the story
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        stream.close()
+
 @task("CMD")
 def sh(*args, **kwargs):
+    """
+    Run a command and return an SHResult.
+
+    If an output_handler is supplied it is called with each line of
+    output as it is read, and the output is neither logged nor kept,
+    except for the last few lines, so that arbitrarily large output
+    can be processed in constant memory. The handler can raise
+    StopIteration to kill the command once it has seen enough, in
+    which case its exit status is ignored.
+    """
     output_transform = kwargs.pop("output_transform", lambda l: l)
     expected = kwargs.pop("expected", (0,))
     output_buffer = kwargs.pop("output_buffer", 10)
+    input = kwargs.pop("input", None)
+    output_handler = kwargs.pop("output_handler", None)
     cmd = tuple(str(a) for a in args)
 
     kwcopy = kwargs.copy()
@@ -377,11 +411,30 @@ def sh(*args, **kwargs):
     command = " ".join(parts)
 
     try:
-        p = Popen(cmd, stderr=STDOUT, stdout=PIPE, **kwargs)
+        if input is None:
+            p = Popen(cmd, stderr=STDOUT, stdout=PIPE, **kwargs)
+        else:
+            p = Popen(cmd, stderr=STDOUT, stdout=PIPE, stdin=PIPE, **kwargs)
+            # feed the input from a separate green thread so a command
+            # that produces output as it reads can't deadlock us
+            eventlet.spawn(_feed, p.stdin, input)
         output = ""
+        tail = []
+        stopped = False
         line_buffer = [command]
         start = time.time()
         for line in p.stdout:
+            if output_handler is not None:
+                tail.append(line)
+                try:
+                    output_handler(line)
+                except StopIteration:
+                    p.kill()
+                    stopped = True
+                    break
+                if len(tail) > output_buffer:
+                    tail.pop(0)
+                continue
             output += line
             line_buffer.append(output_transform(line[:-1]))
             elapsed = time.time() - start
@@ -392,10 +445,10 @@ def sh(*args, **kwargs):
         while line_buffer:
             task.info(line_buffer.pop(0))
         p.wait()
-        result = SHResult(command, p.returncode, output)
+        result = SHResult(command, p.returncode, output if output_handler is None else "".join(tail))
     except OSError, e:
         raise TaskError("error executing command '%s': %s" % (command, e))
-    if p.returncode in expected:
+    if stopped or p.returncode in expected:
         return result
     else:
         raise TaskError("command '%s' failed[%s]: %s" % (command, result.code, result.output))
@@ -59,6 +59,22 @@ def parse_treespec(treespec, **substitutions):
         raise ValueError("unterminated file: %s" % filename)
     return result
 
+def fakebin(monkeypatch, name, script):
+    """
+    Put a fake command on the path that runs the supplied shell
+    script. Returns a function that counts how often it has been run.
+    """
+    bin = mkdtemp()
+    path = os.path.join(bin, name)
+    with open(path, "write") as f:
+        f.write('#!/bin/sh\necho run >> "$(dirname "$0")/runs"\n%s\n' % script)
+    os.chmod(path, 0755)
+    monkeypatch.setenv("PATH", bin + os.pathsep + os.environ["PATH"])
+    def runs():
+        runs = os.path.join(bin, "runs")
+        return open(runs).read().count("run") if os.path.exists(runs) else 0
+    return runs
+
 import re
 from forge.output import Terminal
 
@@ -12,9 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, time
+import eventlet, os, tempfile, time
 from forge.tasks import sh, TaskError
-from forge.docker import Docker, ECRDocker
+from forge.docker import Docker, ECRDocker, GCRDocker, PushScheduler, LoginManager, Credential
 from .common import mktree
 
 registry = "registry.hub.docker.com"
@@ -187,3 +187,96 @@ CMD ["content.txt"]
         assert result.output.strip() == "updated_content"
     finally:
         builder.kill()
+
+class FakePusher(object):
+
+    def __init__(self, layers):
+        self._layers = layers
+        self.events = []
+
+    def layers(self, name, version):
+        return self._layers[name]
+
+    def push(self, name, version):
+        self.events.append(("start", name))
+        eventlet.sleep(0.05)
+        self.events.append(("end", name))
+        return name
+
+def test_push_scheduler_shared_layers():
+    dr = FakePusher({"base": ["l1"], "app": ["l1", "l2"], "other": ["l3"]})
+    sched = PushScheduler()
+    pushes = [sched.schedule(dr, name, "v") for name in ("base", "app", "other")]
+    assert [p.get() for p in pushes] == ["base", "app", "other"]
+    # app shares a layer with base, so it waits for base to finish
+    assert dr.events.index(("start", "app")) > dr.events.index(("end", "base"))
+    # other is unrelated, so it is pushed concurrently with base
+    assert dr.events.index(("start", "other")) < dr.events.index(("end", "base"))
+
+def test_push_scheduler_limit():
+    dr = FakePusher({"a": ["l1"], "b": ["l2"], "c": ["l3"]})
+    sched = PushScheduler(limit=1)
+    pushes = [sched.schedule(dr, name, "v") for name in ("a", "b", "c")]
+    for p in pushes:
+        p.get()
+    starts = [i for i, (ev, _) in enumerate(dr.events) if ev == "start"]
+    ends = [i for i, (ev, _) in enumerate(dr.events) if ev == "end"]
+    assert all(s == e - 1 for s, e in zip(starts, ends))
+
+class Counter(object):
+
+    def __init__(self, expires=None):
+        self.count = 0
+        self.expires = expires
+
+    def __call__(self):
+        self.count += 1
+        eventlet.sleep(0.01)
+        return Credential("user", "token-%s" % self.count, self.expires)
+
+def test_login_once():
+    logins = LoginManager()
+    login = Counter()
+    creds = [eventlet.spawn(logins.login, "registry", login) for i in range(5)]
+    assert set(c.wait().password for c in creds) == set(["token-1"])
+    assert logins.login("registry", login).password == "token-1"
+    assert login.count == 1
+
+def test_login_expired():
+    logins = LoginManager()
+    login = Counter(expires=time.time() - 1)
+    logins.login("registry", login)
+    logins.login("registry", login)
+    assert login.count == 2
+
+def test_login_key():
+    a = GCRDocker("gcr.io", "a", '{"project": "a"}')
+    b = GCRDocker("gcr.io", "b", '{"project": "b"}')
+    assert a.login_key != b.login_key
+    assert a.login_key == GCRDocker("gcr.io", "c", '{"project": "a"}').login_key
+    assert '"project"' not in a.login_key
+
+def test_ecr_login_key():
+    a = ECRDocker(account="1", region="us-east-1", aws_access_key_id="a", aws_secret_access_key="s")
+    b = ECRDocker(account="1", region="us-east-1", aws_access_key_id="b", aws_secret_access_key="s")
+    assert a.login_key != b.login_key
+    assert a.registry == b.registry
+
+def test_login_persisted():
+    path = os.path.join(tempfile.mkdtemp(), "credentials.json")
+    login = Counter(expires=time.time() + 3600)
+    used = []
+    LoginManager(path).login("registry", login, used.append)
+    logins = LoginManager(path)
+    assert logins.login("registry", login, used.append).password == "token-1"
+    assert logins.login("registry", login, used.append).password == "token-1"
+    assert login.count == 1
+    # a persisted token is still used (e.g. for docker login) once per run
+    assert [c.password for c in used] == ["token-1", "token-1"]
+
+def test_login_not_persisted_without_expiry():
+    path = os.path.join(tempfile.mkdtemp(), "credentials.json")
+    login = Counter()
+    LoginManager(path).login("registry", login)
+    LoginManager(path).login("registry", login)
+    assert login.count == 2
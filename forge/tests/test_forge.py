@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, pexpect, sys, time, yaml
-from .common import mktree, defuzz
+import json, os, pexpect, sys, time, yaml
+from .common import fakebin, mktree, defuzz
+from forge.core import Forge
+from forge.kubernetes import Kubernetes
 from forge.tasks import sh
 
 START_TIME = time.time()
@@ -184,7 +186,7 @@ def test_deploy():
         forge.expect('forgetest-[0-9-]+:')
         forge.expect('rendered')
         forge.expect('service/forgetest-[0-9-]+')
-        forge.expect('deployment/forgetest-[0-9-]+')
+        forge.expect('deployment.extensions/forgetest-[0-9-]+')
         forge.expect('deployed')
         forge.expect('forgetest-[0-9-]+')
         forge.expect(pexpect.EOF)
@@ -358,3 +360,53 @@ def test_rebuilder():
 
 def test_rebuilder_subdir():
     do_test_rebuilder(REBUILDER_SUBDIR, "rebuilder/subdir/src/hello.py")
+
+DEPLOY_ALL = """
+@@a/k8s/manifests.yaml
+---
+apiVersion: apps/v1
+kind: Deployment
+metadata: {name: dep, annotations: {forge.manifest-hash: abc}}
+---
+apiVersion: v1
+kind: ConfigMap
+metadata: {name: cm, annotations: {forge.manifest-hash: abc}}
+@@
+
+@@b/k8s/manifests.yaml
+---
+apiVersion: v1
+kind: Service
+metadata: {name: svc, annotations: {forge.manifest-hash: new}}
+@@
+"""
+
+LIVE = {"kind": "List", "items": [
+    {"apiVersion": "apps/v1", "kind": "Deployment",
+     "metadata": {"name": "dep", "namespace": "ns", "annotations": {"forge.manifest-hash": "abc"}}},
+    {"apiVersion": "v1", "kind": "ConfigMap",
+     "metadata": {"name": "cm", "namespace": "ns", "annotations": {"forge.manifest-hash": "abc"}}},
+    {"apiVersion": "v1", "kind": "Service",
+     "metadata": {"name": "svc", "namespace": "ns", "annotations": {"forge.manifest-hash": "old"}}}
+]}
+
+class Deployed(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = "default"
+
+def test_deploy_all_unchanged(monkeypatch):
+    directory = mktree(DEPLOY_ALL)
+    fakebin(monkeypatch, "kubectl", """
+case "$1" in
+  get) echo '%s' ;;
+  apply) cat > /dev/null ; echo "service/svc configured" ;;
+esac""" % json.dumps(LIVE))
+    forge = Forge()
+    forge.kube = Kubernetes(namespace="ns")
+    a, b = Deployed("a"), Deployed("b")
+    builds = [(a, os.path.join(directory, "a", "k8s")), (b, os.path.join(directory, "b", "k8s"))]
+    forge.rendered = [(a, builds[0][1], ["deployment.apps/dep", "configmap/cm"]), (b, builds[1][1], ["service/svc"])]
+    forge.deploy_all(builds)
+    assert forge.deployed == builds
@@ -13,8 +13,9 @@
 # limitations under the License.
 
 import os
-from forge.istio import istio
-from .common import mktree
+from forge.istio import istio, inject_all
+from forge.yamlutil import compose_all, view
+from .common import fakebin, mktree
 
 YAML = """
 @@kube.yaml
@@ -83,3 +84,19 @@ def test_include_ip_ranges():
         data = file.read()
 
     assert "- 10.0.0.0/8,172.32.0.0/16" in data
+
+FILES = ("a: 1\n---\nb: 2\n", "c: 3\n", "")
+
+def check(result):
+    assert [[list(view(nd).keys()) for nd in docs] for docs in result] == [[["a"], ["b"]], [["c"]], []]
+
+def test_inject_all_batched(monkeypatch):
+    runs = fakebin(monkeypatch, "istioctl", "cat")
+    check(inject_all([list(compose_all(f)) for f in FILES]))
+    assert runs() == 1
+
+def test_inject_all_fallback(monkeypatch):
+    runs = fakebin(monkeypatch, "istioctl", "grep -v ForgeInjectBoundary || true")
+    check(inject_all([list(compose_all(f)) for f in FILES]))
+    # the empty file never reaches istioctl
+    assert runs() == 3
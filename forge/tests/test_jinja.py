@@ -12,11 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
+import os, pytest
+from tempfile import mkdtemp
+from forge import jinja2
 from forge.tasks import TaskError
-from forge.jinja2 import render, renders
+from forge.jinja2 import environment, render, renders
+from jinja2 import Undefined
+from jinja2.utils import LRUCache
 from .common import mktree
 
+@pytest.fixture(autouse=True)
+def bytecode_cache(monkeypatch):
+    cache = mkdtemp()
+    monkeypatch.setattr(jinja2, "BYTECODE_CACHE", cache)
+    monkeypatch.setattr(jinja2, "_ENVIRONMENTS", {})
+    return cache
+
 TEMPLATE_TREE = """
 @@template_dir/file1
 {{hello}} {{world}}!
@@ -63,9 +74,83 @@ def test_render_error():
     except TaskError, e:
         assert "template_err.in: 'foo' is undefined" in str(e)
 
+def test_environment_cached(bytecode_cache):
+    root = mktree(TEMPLATE_TREE)
+    source = os.path.join(root, "template_dir")
+    assert environment(source) is environment(source + "/")
+    render(source, os.path.join(root, "out"), hello="Hello", world="World")
+    assert len(os.listdir(bytecode_cache)) == 3
+
+    # a fresh process reuses the compiled templates
+    jinja2._ENVIRONMENTS.clear()
+    cached = set(os.listdir(bytecode_cache))
+    render(source, os.path.join(root, "out"), hello="Hi", world="There")
+    assert set(os.listdir(bytecode_cache)) == cached
+    assert open(os.path.join(root, "out", "file1")).read() == "Hi There!"
+
+def test_environment_reload():
+    root = mktree(TEMPLATE_TREE)
+    source = os.path.join(root, "template_file.in")
+    target = os.path.join(root, "template_file")
+    render(source, target, hello="Hello", world="World")
+    with open(source, "write") as f:
+        f.write("{{world}} {{hello}}!")
+    # make sure the edit is seen even if it happens within the mtime resolution
+    mtime = os.path.getmtime(source) + 2
+    os.utime(source, (mtime, mtime))
+    render(source, target, hello="Hello", world="World")
+    assert open(target).read() == "World Hello!"
+
+    # a fresh process doesn't use the stale bytecode
+    jinja2._ENVIRONMENTS.clear()
+    with open(source, "write") as f:
+        f.write("{{hello}}, {{world}}!")
+    render(source, target, hello="Hello", world="World")
+    assert open(target).read() == "Hello, World!"
+
+def test_render_many():
+    root = mktree("".join("@@tenants/tenant-%s.yaml\nname: {{prefix}}-%s\n@@\n" % (i, i) for i in range(100)))
+    target = os.path.join(root, "out")
+    render(os.path.join(root, "tenants"), target, prefix="t")
+    assert sorted(os.listdir(target)) == sorted("tenant-%s.yaml" % i for i in range(100))
+    for i in range(100):
+        assert open(os.path.join(target, "tenant-%s.yaml" % i)).read() == "name: t-%s" % i
+
+def test_render_dir_error():
+    root = mktree(TEMPLATE_TREE + "@@template_dir/bad\n{{foo.bar}}\n@@\n")
+    try:
+        render(os.path.join(root, "template_dir"), os.path.join(root, "out"), hello="Hello", world="World")
+        assert False, "should error"
+    except TaskError, e:
+        assert "template_dir/./bad: 'foo' is undefined" in str(e)
+
+def test_render_warning():
+    root = mktree("@@templates/warn\nhello {{nonexistent}}\n@@\n")
+    target = os.path.join(root, "out")
+    render(os.path.join(root, "templates"), target)
+    assert open(os.path.join(target, "warn")).read() == "hello "
+    assert os.listdir(target) == ["warn"]
+
 def test_renders():
     assert renders("foo", "{{hello}} {{world}}!", hello="Hello", world="World") == "Hello World!"
 
+def test_renders_cached():
+    jinja2._TEMPLATES.clear()
+    source = "{{hello}} {{world}}!"
+    compiled = jinja2.template(source)
+    assert jinja2.template(source) is compiled
+    assert jinja2.template(unicode(source)) is compiled
+    assert jinja2.template(source, undefined=Undefined) is not compiled
+    assert renders("foo", source, hello="Hi", world="There") == "Hi There!"
+    assert renders("bar", source, hello="Hello", world="World") == "Hello World!"
+    assert len(jinja2._TEMPLATES) == 2
+
+def test_renders_cache_bounded(monkeypatch):
+    monkeypatch.setattr(jinja2, "_TEMPLATES", LRUCache(2))
+    for i in range(5):
+        assert renders("foo", "%s {{x}}" % i, x="x") == "%s x" % i
+    assert len(jinja2._TEMPLATES) == 2
+
 def test_renders_err():
     try:
         renders("foo", "{{foo.bar}}")
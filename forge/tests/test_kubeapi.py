@@ -0,0 +1,329 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64, eventlet, json, os, pytest, urlparse, uuid
+from eventlet import wsgi
+from tempfile import mkdtemp
+from forge import kubeapi, kubernetes
+from forge.kubeapi import APIError, KubeAPI, kubeconfig_context, load_kubeconfig
+from forge.kubernetes import Kubernetes, applied
+from forge.tasks import TaskError
+from .common import mktree
+
+def _resource(kind, name, namespaced=True, *short):
+    return {"kind": kind, "name": name, "namespaced": namespaced, "shortNames": list(short),
+            "singularName": kind.lower(), "verbs": ["create", "delete", "get", "list", "patch"]}
+
+class StubAPI(object):
+
+    """
+    Just enough of the kubernetes API server to test against.
+    """
+
+    GROUPS = {"": ("v1", [_resource("Service", "services", True, "svc"),
+                          _resource("ConfigMap", "configmaps", True, "cm"),
+                          _resource("Namespace", "namespaces", False, "ns"),
+                          {"kind": "Service", "name": "services/status", "namespaced": True}]),
+              "apps": ("v1", [_resource("Deployment", "deployments", True, "deploy")])}
+
+    def __init__(self, token):
+        self.token = token
+        self.objects = {}
+        self.requests = []
+        self.watch_error = None
+
+    def start(self):
+        sock = eventlet.listen(("127.0.0.1", 0))
+        eventlet.spawn(wsgi.server, sock, self, log_output=False)
+        return "http://127.0.0.1:%s" % sock.getsockname()[1]
+
+    def reply(self, start_response, status, body):
+        start_response(status, [("Content-Type", "application/json")])
+        return [json.dumps(body)]
+
+    def error(self, start_response, code, reason, message):
+        return self.reply(start_response, "%s %s" % (code, reason),
+                          {"kind": "Status", "reason": reason, "message": message, "code": code})
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        path = environ["PATH_INFO"]
+        query = dict(urlparse.parse_qsl(environ.get("QUERY_STRING", "")))
+        self.requests.append((method, path))
+
+        if environ.get("HTTP_AUTHORIZATION") != "Bearer %s" % self.token:
+            return self.error(start_response, 401, "Unauthorized", "Unauthorized")
+
+        if path == "/api":
+            return self.reply(start_response, "200 OK", {"versions": ["v1"]})
+        if path == "/apis":
+            return self.reply(start_response, "200 OK", {"groups": [
+                {"name": g, "preferredVersion": {"groupVersion": "%s/%s" % (g, v), "version": v}}
+                for g, (v, _) in self.GROUPS.items() if g]})
+
+        parts = path.strip("/").split("/")
+        group = "" if parts[0] == "api" else parts[1]
+        version, resources = self.GROUPS[group]
+        rest = parts[3:] if group else parts[2:]
+        if not rest:
+            return self.reply(start_response, "200 OK", {"resources": resources})
+
+        namespace = None
+        if rest[0] == "namespaces" and len(rest) > 2:
+            namespace = rest[1]
+            rest = rest[2:]
+        plural = rest[0]
+        name = rest[1] if len(rest) > 1 else None
+        kind = [r["kind"] for r in resources if r["name"] == plural][0]
+        key = (group, plural, namespace, name)
+
+        if method == "GET" and name is None:
+            items = [o for (g, p, ns, n), o in self.objects.items()
+                     if g == group and p == plural and namespace in (None, ns) and
+                     self.selected(o, query.get("labelSelector"))]
+            if query.get("watch") == "true":
+                # report what exists, then end the watch as if it timed out
+                start_response("200 OK", [("Content-Type", "application/json")])
+                if self.watch_error:
+                    code, reason = self.watch_error
+                    return ["%s\n" % json.dumps({"type": "ERROR", "object": {"kind": "Status", "code": code,
+                                                                              "reason": reason, "message": reason}})]
+                return ["%s\n" % json.dumps({"type": "ADDED", "object": o}) for o in items]
+            return self.reply(start_response, "200 OK", {"kind": "%sList" % kind, "items": items})
+        if method == "GET":
+            if key not in self.objects:
+                return self.error(start_response, 404, "NotFound", '%s "%s" not found' % (plural, name))
+            return self.reply(start_response, "200 OK", self.objects[key])
+        if method == "PATCH":
+            doc = json.loads(environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"])))
+            if doc.get("spec", {}).get("invalid"):
+                return self.error(start_response, 422, "Invalid", '%s "%s" is invalid' % (kind, name))
+            created = key not in self.objects
+            if query.get("dryRun") != "All":
+                md = doc["metadata"]
+                md["namespace"] = namespace
+                md["uid"] = self.objects[key]["metadata"]["uid"] if not created else str(uuid.uuid4())
+                md["managedFields"] = [{"manager": query["fieldManager"], "operation": "Apply"}]
+                self.objects[key] = doc
+            return self.reply(start_response, "201 Created" if created else "200 OK", doc)
+        if method == "DELETE":
+            if key not in self.objects:
+                return self.error(start_response, 404, "NotFound", '%s "%s" not found' % (plural, name))
+            return self.reply(start_response, "200 OK", self.objects.pop(key))
+
+    def selected(self, obj, selector):
+        labels = obj["metadata"].get("labels") or {}
+        for requirement in (selector or "").split(","):
+            if not requirement:
+                continue
+            if "=" in requirement:
+                k, v = requirement.split("=")
+                if labels.get(k) != v:
+                    return False
+            elif requirement not in labels:
+                return False
+        return True
+
+    def names(self):
+        return sorted(n for g, p, ns, n in self.objects)
+
+KUBECONFIG = """
+apiVersion: v1
+kind: Config
+current-context: stub
+contexts:
+- name: stub
+  context: {cluster: stub, user: stub, namespace: forge-test}
+clusters:
+- name: stub
+  cluster: {server: "%s"}
+users:
+- name: stub
+  user: {token: "%s"}
+"""
+
+@pytest.fixture
+def stub(monkeypatch):
+    api = StubAPI("sekret")
+    server = api.start()
+    config = os.path.join(mkdtemp(), "config")
+    with open(config, "write") as f:
+        f.write(KUBECONFIG % (server, api.token))
+    monkeypatch.setenv("KUBECONFIG", config)
+    monkeypatch.setattr(kubernetes, "DISCOVERY_CACHE", mkdtemp())
+    monkeypatch.setattr(kubernetes, "SNAPSHOT_DIR", mkdtemp())
+    return api
+
+def test_kubeconfig(stub):
+    config = load_kubeconfig()
+    assert config.server.startswith("http://127.0.0.1:")
+    assert config.namespace == "forge-test"
+    assert config.token == "sekret"
+
+INLINE = """
+apiVersion: v1
+kind: Config
+current-context: inline
+contexts:
+- name: inline
+  context: {cluster: inline, user: inline}
+clusters:
+- name: inline
+  cluster: {server: "https://kube.example.com", certificate-authority-data: "%s"}
+users:
+- name: inline
+  user: {client-certificate-data: "%s", client-key-data: "%s"}
+""" % tuple(base64.b64encode(s) for s in ("ca", "cert", "key"))
+
+def test_kubeconfig_data(monkeypatch):
+    config = os.path.join(mkdtemp(), "config")
+    with open(config, "write") as f:
+        f.write(INLINE)
+    monkeypatch.setattr(kubeapi, "_DATA_FILES", {})
+    assert kubeconfig_context(config) == ("inline", "https://kube.example.com", None)
+    assert kubeapi._DATA_FILES == {}
+    first = load_kubeconfig(config)
+    second = load_kubeconfig(config)
+    assert (first.verify, first.cert) == (second.verify, second.cert)
+    with open(first.cert[1]) as f:
+        assert f.read() == "key"
+    paths = kubeapi._DATA_FILES.values()
+    assert len(paths) == 3
+    kubeapi._remove_data_files()
+    assert not any(os.path.exists(p) for p in paths)
+
+def test_discovery_cached(stub):
+    cache = mkdtemp()
+    api = KubeAPI(load_kubeconfig(), cache_dir=cache)
+    assert api.resource("deploy")["name"] == "deployments"
+    assert api.resource("deployments.apps")["kind"] == "Deployment"
+    assert api.resource("Service", "v1")["name"] == "services"
+    count = len(stub.requests)
+    api = KubeAPI(load_kubeconfig(), cache_dir=cache)
+    assert api.resource("svc")["name"] == "services"
+    assert len(stub.requests) == count
+
+def test_unauthorized(stub):
+    config = load_kubeconfig()
+    config.token = "wrong"
+    try:
+        KubeAPI(config).resources()
+        assert False, "expected an error"
+    except APIError, e:
+        assert e.status == 401
+
+MANIFESTS = """
+@@k8s/manifests.yaml
+---
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: cm
+  labels: {forge.service: svc, forge.profile: default}
+  annotations: {forge.repo: repo, forge.descriptor: service.yaml, forge.version: "1.git"}
+---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: dep
+  labels: {forge.service: svc, forge.profile: default}
+  annotations: {forge.repo: repo, forge.descriptor: service.yaml, forge.version: "1.git"}
+spec: {replicas: 1}
+@@
+"""
+
+def test_apply_list_delete(stub):
+    directory = os.path.join(mktree(MANIFESTS), "k8s")
+    kube = Kubernetes(backend="api")
+    result = kube.apply(directory)
+    assert result.output.splitlines() == ["configmap/cm created", "deployment.apps/dep created"]
+    assert stub.names() == ["cm", "dep"]
+    assert kube.apply(directory).output.splitlines() == ["configmap/cm serverside-applied",
+                                                         "deployment.apps/dep serverside-applied"]
+
+    repos = kube.list()
+    resources = repos["repo"]["svc"]["default"]
+    assert sorted((r["kind"], r["namespace"], r["name"]) for r in resources) == \
+        [("configmap", "forge-test", "cm"), ("deployment", "forge-test", "dep")]
+
+    kube.delete({"forge.service": "svc"})
+    assert stub.names() == []
+
+def test_wait(stub):
+    directory = os.path.join(mktree(MANIFESTS), "k8s")
+    kube = Kubernetes(backend="api")
+    kube.apply(directory)
+    names = ["configmap/cm", "deployment.apps/dep"]
+    try:
+        kube.wait(names, {"forge.service": "svc"}, timeout=1)
+        assert False, "expected an error"
+    except TaskError, e:
+        assert "deployment.apps/dep" in str(e)
+
+    stub.objects[("apps", "deployments", "forge-test", "dep")]["status"] = {
+        "observedGeneration": 1, "replicas": 1, "updatedReplicas": 1, "availableReplicas": 1
+    }
+    kube.wait(names, {"forge.service": "svc"}, timeout=1)
+
+def test_sync(stub):
+    directory = os.path.join(mktree(MANIFESTS), "k8s")
+    kube = Kubernetes(backend="api")
+    kube.apply(directory)
+    kube.sync(interval=0.1, rounds=2)
+    assert ("GET", "/apis/apps/v1/deployments") in stub.requests
+
+    count = len(stub.requests)
+    repos = Kubernetes(backend="api").list(max_age=60)
+    assert sorted(r["name"] for r in repos["repo"]["svc"]["default"]) == ["cm", "dep"]
+    assert len(stub.requests) == count
+
+def test_sync_watch_failed(stub):
+    directory = os.path.join(mktree(MANIFESTS), "k8s")
+    kube = Kubernetes(backend="api")
+    kube.apply(directory)
+    stub.watch_error = (403, "Forbidden")
+    try:
+        kube.sync(interval=0.1, rounds=3)
+        assert False, "expected an error"
+    except TaskError, e:
+        assert "watch of" in str(e)
+        assert "Forbidden" in str(e)
+
+def test_apply_prune(stub):
+    directory = os.path.join(mktree(MANIFESTS), "k8s")
+    kube = Kubernetes(backend="api")
+    kube.apply(directory)
+    with open(os.path.join(directory, "manifests.yaml")) as f:
+        content = f.read()
+    with open(os.path.join(directory, "manifests.yaml"), "write") as f:
+        f.write(content[:content.index("---\napiVersion: apps/v1")])
+    result = kube.apply(directory, prune={"forge.service": "svc", "forge.profile": "default"})
+    assert "deployment.apps/dep pruned" in result.output
+    assert stub.names() == ["cm"]
+
+def test_apply_all_invalid(stub):
+    directory = os.path.join(mktree(MANIFESTS.replace("replicas: 1", "invalid: true")), "k8s")
+    kube = Kubernetes(backend="api")
+    result, skipped = kube.apply_all([directory])
+    assert result.code == 1
+    statuses, errors = applied(result.output)
+    assert statuses == {("configmap", "cm"): "created"}
+    assert errors == ['Error from server (Invalid): Deployment "dep" is invalid']
+
+def test_unchanged(stub):
+    directory = os.path.join(mktree(MANIFESTS.replace("forge.version: \"1.git\"}\n---",
+                                                      "forge.version: \"1.git\", forge.manifest-hash: abc}\n---")), "k8s")
+    kube = Kubernetes(backend="api", force_apply=True)
+    kube.apply(directory)
+    assert kube.unchanged([directory]) == set([("", "configmap", "forge-test", "cm")])
@@ -12,10 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, time
+import json, os, time
+from tempfile import mkdtemp
+from forge import kubernetes
 from forge.tasks import TaskError, sh
-from forge.kubernetes import Kubernetes
-from .common import mktree
+from collections import OrderedDict
+from yaml import parse, emit, safe_load_all
+from forge.kubernetes import HASH, JSONItems, Kubernetes, applied, fixup_events, resource_names, selector, \
+    rollout, READY, PROGRESSING, FAILED
+from forge import yamlutil
+from .common import fakebin, mktree
 
 START_TIME = time.time()
 MANGLE = str(START_TIME).replace('.', '-')
@@ -63,12 +69,43 @@ spec:
 @@
 """
 
+FIXUPS = OrderedDict((("labels", {"forge.service": "svc"}), ("annotations", {"forge.repo": "repo"})))
+
+def streamed(content):
+    return list(safe_load_all(emit(fixup_events(parse(content), FIXUPS))))
+
+def test_fixup_events_null():
+    assert streamed("---\n---\nkind: Pod\n...\n---\n") == \
+        [{"kind": "Pod", "metadata": {"labels": {"forge.service": "svc"}, "annotations": {"forge.repo": "repo"}}}]
+
+def test_fixup_events_namespace():
+    assert streamed("kind: Namespace\nmetadata: {name: ns}\n") == [{"kind": "Namespace", "metadata": {"name": "ns"}}]
+
+def test_fixup_events_merge():
+    pod, = streamed("metadata:\n  labels: {forge.service: old, app: x}\n  name: pod\nkind: Pod\n")
+    assert pod["metadata"] == {"labels": {"forge.service": "svc", "app": "x"}, "name": "pod",
+                               "annotations": {"forge.repo": "repo"}}
+
 def test_resources():
     directory = mktree(K8S_TREE, MANGLE=MANGLE)
     kube = Kubernetes()
     resources = kube.resources(os.path.join(directory, "k8s"))
     assert mangle('service/kube-test-service-MANGLE') in resources
-    assert mangle('deployment/kube-test-deployment-MANGLE') in resources
+    assert mangle('deployment.extensions/kube-test-deployment-MANGLE') in resources
+
+def test_resource_names():
+    docs = yamlutil.load("test", """
+kind: List
+apiVersion: v1
+items:
+- {kind: ConfigMap, apiVersion: v1, metadata: {name: cm}}
+- {kind: Role, apiVersion: rbac.authorization.k8s.io/v1, metadata: {name: role}}
+---
+---
+{kind: Deployment, apiVersion: apps/v1, metadata: {name: dep}}
+""")
+    assert list(resource_names(docs)) == ["configmap/cm", "role.rbac.authorization.k8s.io/role",
+                                          "deployment.apps/dep"]
 
 def kget(namespace, type, name):
     cmd = "kubectl", "get", "-o", "name", type, name
@@ -90,6 +127,323 @@ def test_apply_namespace():
     sh("kubectl", "create", "namespace", mangle("dev-MANGLE"))
     test_apply(namespace=mangle("dev-MANGLE"))
 
+def test_apply_all():
+    directory = mktree(K8S_TREE, MANGLE=MANGLE)
+    other = mktree(K8S_TREE, MANGLE=mangle("other-MANGLE"))
+    kube = Kubernetes()
+    result = kube.apply_all([os.path.join(directory, "k8s"), os.path.join(other, "k8s")])
+    statuses, errors = applied(result.output)
+    assert not errors
+    assert ("service", mangle("kube-test-service-MANGLE")) in statuses
+    assert ("deployment", mangle("kube-test-deployment-other-MANGLE")) in statuses
+    kcheck(None, "deployments", "kube-test-deployment-MANGLE")
+
+def test_applied():
+    statuses, errors = applied("""deployment.apps/foo configured
+service/foo unchanged
+configmap "bar" created
+Error from server (Invalid): error when creating "STDIN": Deployment.apps "baz" is invalid
+""")
+    assert statuses == {("deployment", "foo"): "configured", ("service", "foo"): "unchanged",
+                        ("configmap", "bar"): "created"}
+    assert errors == ['Error from server (Invalid): error when creating "STDIN": Deployment.apps "baz" is invalid']
+
+def test_selector():
+    assert selector({"forge.service": ["a", "b"]}) == "-lforge.service in (a,b)"
+    assert selector({"forge.profile": "default"}) == "-lforge.profile=default"
+
+HASHED_TREE = """
+@@k8s/manifests.yaml
+---
+kind: Service
+metadata: {name: svc, annotations: {forge.manifest-hash: abc}}
+---
+kind: Deployment
+metadata: {name: dep, annotations: {forge.manifest-hash: def}}
+---
+kind: ConfigMap
+metadata: {name: cm}
+@@
+"""
+
+LIVE = """{"kind": "List", "items": [
+  {"kind": "Service", "metadata": {"name": "svc", "annotations": {"forge.manifest-hash": "abc"}}},
+  {"kind": "Deployment", "metadata": {"name": "dep", "annotations": {"forge.manifest-hash": "old"}}}
+]}"""
+
+def test_apply_unchanged(monkeypatch):
+    directory = os.path.join(mktree(HASHED_TREE), "k8s")
+    runs = fakebin(monkeypatch, "kubectl", """
+case "$1" in
+  get) echo '%s' ;;
+  apply) cat ;;
+esac""" % LIVE)
+    kube = Kubernetes(namespace="ns")
+    assert kube.unchanged([directory]) == set([("", "service", "ns", "svc")])
+    output = kube.apply(directory).output
+    assert "name: svc" not in output
+    assert "name: dep" in output
+    assert "name: cm" in output
+    assert runs() == 3
+
+def test_apply_unchanged_failed(monkeypatch):
+    directory = os.path.join(mktree(HASHED_TREE), "k8s")
+    runs = fakebin(monkeypatch, "kubectl", """
+case "$1" in
+  get) echo "error: You must be logged in to the server (Unauthorized)" ; exit 1 ;;
+  apply) echo applied ;;
+esac""")
+    kube = Kubernetes(namespace="ns")
+    assert kube.unchanged([directory]) == set()
+    assert kube.apply(directory).output.strip() == "applied"
+    assert runs() == 3
+
+NAMESPACED_TREE = """
+@@k8s/manifests.yaml
+---
+apiVersion: v1
+kind: ConfigMap
+metadata: {name: cm, namespace: a, annotations: {forge.manifest-hash: abc}}
+---
+apiVersion: v1
+kind: ConfigMap
+metadata: {name: cm, namespace: b, annotations: {forge.manifest-hash: abc}}
+---
+apiVersion: example.com/v1
+kind: ConfigMap
+metadata: {name: cm, namespace: a, annotations: {forge.manifest-hash: abc}}
+@@
+"""
+
+NAMESPACED_LIVE = """{"kind": "List", "items": [
+  {"apiVersion": "v1", "kind": "ConfigMap",
+   "metadata": {"name": "cm", "namespace": "a", "annotations": {"forge.manifest-hash": "abc"}}},
+  {"apiVersion": "v1", "kind": "ConfigMap",
+   "metadata": {"name": "cm", "namespace": "b", "annotations": {"forge.manifest-hash": "old"}}},
+  {"apiVersion": "example.com/v1", "kind": "ConfigMap",
+   "metadata": {"name": "cm", "namespace": "a", "annotations": {"forge.manifest-hash": "old"}}}
+]}"""
+
+def test_unchanged_namespaced(monkeypatch):
+    directory = os.path.join(mktree(NAMESPACED_TREE), "k8s")
+    fakebin(monkeypatch, "kubectl", "echo '%s'" % NAMESPACED_LIVE)
+    assert Kubernetes().unchanged([directory]) == set([("", "configmap", "a", "cm")])
+
+def test_apply_force(monkeypatch):
+    directory = os.path.join(mktree(HASHED_TREE), "k8s")
+    runs = fakebin(monkeypatch, "kubectl", "echo applied")
+    kube = Kubernetes(force_apply=True)
+    kube.apply(directory)
+    assert runs() == 1
+
+ITEMS = [{"apiVersion": "apps/v1",
+          "kind": "Deployment", "metadata": {"name": "dep", "namespace": "default",
+                                             "labels": {"forge.service": "svc", "forge.profile": "default"},
+                                             "annotations": {"forge.repo": "repo", "forge.version": "1.git"}},
+          "spec": {"template": {}}, "status": {"conditions": [{"message": "ok"}]}},
+         {"kind": "ConfigMap", "metadata": {"name": "cm", "namespace": "default",
+                                            "labels": {"forge.service": "svc", "forge.profile": "default"},
+                                            "annotations": {"forge.repo": "repo", "forge.version": "1.git"}},
+          "data": {"big": "x"*1000}}]
+
+LIST = {"apiVersion": "v1", "kind": "List", "items": ITEMS, "metadata": {}}
+
+def parse_items(text):
+    items = []
+    parser = JSONItems(items.append)
+    for line in text.splitlines(True):
+        parser.feed(line)
+    parser.close()
+    return items
+
+def test_json_items():
+    assert parse_items("warning: something\n" + json.dumps(LIST, indent=4) + "\n") == ITEMS
+
+def test_json_items_compact():
+    assert parse_items(json.dumps(LIST)) == ITEMS
+
+def test_json_items_empty():
+    assert parse_items(json.dumps(dict(LIST, items=[]), indent=4)) == []
+
+def fake_cluster(monkeypatch, log="/dev/null"):
+    deployment, configmap = ITEMS
+    listings = mktree({"deployments.apps.json": json.dumps(dict(LIST, items=[deployment]), indent=4),
+                       "configmaps.json": json.dumps(dict(LIST, items=[configmap]), indent=4)})
+    monkeypatch.setattr(kubernetes, "DISCOVERY_CACHE", mkdtemp())
+    monkeypatch.setattr(kubernetes, "SNAPSHOT_DIR", mkdtemp())
+    return fakebin(monkeypatch, "kubectl", """
+case "$1" in
+  api-resources) printf "deployments.apps\\nconfigmaps\\nsecrets\\n" ;;
+  get) echo "$@" | grep -q -- --chunk-size=500 && cat %s/$2.json 2>/dev/null ;;
+  delete|wait) echo "$@" >> %s ;;
+esac
+true""" % (listings, log))
+
+def test_list(monkeypatch):
+    runs = fake_cluster(monkeypatch)
+    repos = Kubernetes().list()
+    resources = sorted(repos["repo"]["svc"]["default"])
+    assert [(r["kind"], r["name"], r["version"], r["status"]) for r in resources] == \
+        [("configmap", "cm", "1.git", "{}"), ("deployment", "dep", "1.git", "ok")]
+    # one discovery plus one get per kind
+    assert runs() == 4
+
+def test_list_skipped(monkeypatch):
+    fake_cluster(monkeypatch)
+    kube = Kubernetes()
+    kube._kinds = ["deployments.apps", "configmaps"]
+    fakebin(monkeypatch, "kubectl", """
+[ "$2" = configmaps ] && { echo "error: the server doesn't have a resource type configmaps" ; exit 1 ; }
+echo '%s'""" % json.dumps(dict(LIST, items=ITEMS[:1]), indent=4))
+    skipped = []
+    assert [i["metadata"]["name"] for i in kube._list(kube.kinds(), {"forge.service": None}, skipped=skipped)] == \
+        ["dep"]
+    assert skipped == ["configmaps"]
+    kube.list(max_age=60)
+    kube.sync(interval=0, rounds=1)
+    assert not os.path.exists(kube.snapshot_path())
+
+def test_list_failed(monkeypatch):
+    fake_cluster(monkeypatch)
+    fakebin(monkeypatch, "kubectl", "echo 'Unable to connect to the server' ; exit 1")
+    kube = Kubernetes()
+    try:
+        kube.list()
+        assert False, "expected an error"
+    except TaskError, e:
+        assert "Unable to connect to the server" in str(e)
+
+def test_list_snapshot(monkeypatch):
+    runs = fake_cluster(monkeypatch)
+    def names(repos):
+        return sorted(r["name"] for r in repos["repo"]["svc"]["default"])
+    assert names(Kubernetes().list(max_age=60)) == ["cm", "dep"]
+    count = runs()
+    assert names(Kubernetes().list(max_age=60)) == ["cm", "dep"]
+    assert runs() == count
+    Kubernetes().list(max_age=0)
+    assert runs() > count
+
+def test_sync(monkeypatch):
+    fake_cluster(monkeypatch)
+    kube = Kubernetes()
+    kube.sync(interval=0, rounds=1)
+    runs = fakebin(monkeypatch, "kubectl", "exit 1")
+    repos = kube.list(max_age=60)
+    assert sorted(r["name"] for r in repos["repo"]["svc"]["default"]) == ["cm", "dep"]
+    assert runs() == 0
+
+def test_discovery_cached(monkeypatch):
+    runs = fake_cluster(monkeypatch)
+    assert Kubernetes().kinds() == ["deployments.apps", "configmaps", "secrets"]
+    assert Kubernetes().kinds() == ["deployments.apps", "configmaps", "secrets"]
+    assert runs() == 1
+
+def test_delete(monkeypatch):
+    log = os.path.join(mkdtemp(), "log")
+    fake_cluster(monkeypatch, log)
+    Kubernetes().delete({"forge.service": "svc"}, wait=True)
+    with open(log) as f:
+        assert f.read().splitlines() == [
+            "delete --wait=false -n default configmap/cm deployment.apps/dep",
+            "wait --for=delete --timeout=300s -n default configmap/cm deployment.apps/dep"
+        ]
+
+def test_delete_skipped(monkeypatch):
+    log = os.path.join(mkdtemp(), "log")
+    fake_cluster(monkeypatch)
+    fakebin(monkeypatch, "kubectl", """
+case "$1" in
+  get) [ "$2" = secrets ] && { echo "Error from server (Forbidden): secrets is forbidden" ; exit 1 ; }
+       echo '%s' ;;
+  delete|wait) echo "$@" >> %s ;;
+esac""" % (json.dumps(dict(LIST, items=ITEMS[:1]), indent=4), log))
+    kube = Kubernetes()
+    kube._kinds = ["deployments.apps", "secrets"]
+    try:
+        kube.delete({"forge.service": "svc"})
+        assert False, "expected an error"
+    except TaskError, e:
+        assert "unable to list secrets" in str(e)
+    assert not os.path.exists(log)
+
+def fake_wait(monkeypatch, log, wait):
+    fake_cluster(monkeypatch)
+    listings = mktree({"configmaps.json": json.dumps(dict(LIST, items=ITEMS[1:]), indent=4),
+                       "deployments.apps.json": json.dumps(dict(LIST, items=ITEMS[:1]), indent=4)})
+    fakebin(monkeypatch, "kubectl", """
+case "$1" in
+  get) echo "$@" | grep -q -- --chunk-size && { cat %s/configmaps.json ; cat %s/deployments.apps.json ; exit 0 ; }
+       echo deployment.apps/dep ;;
+  delete) ;;
+  wait) echo "$@" >> %s ; %s ;;
+esac""" % (listings, listings, log, wait))
+
+def test_delete_wait_gone(monkeypatch):
+    log = os.path.join(mkdtemp(), "log")
+    fake_wait(monkeypatch, log, """
+echo "$@" | grep -q configmap/cm && { echo 'Error from server (NotFound): configmaps "cm" not found' ; exit 1 ; }
+true""")
+    kube = Kubernetes()
+    kube._kinds = ["configmaps", "deployments.apps"]
+    kube.delete({"forge.service": "svc"}, wait=True)
+    with open(log) as f:
+        assert [l.split()[-1] for l in f.read().splitlines()] == ["deployment.apps/dep", "deployment.apps/dep"]
+
+def test_delete_wait_failed(monkeypatch):
+    log = os.path.join(mkdtemp(), "log")
+    fake_wait(monkeypatch, log, "echo 'Error from server (Forbidden): deployments.apps is forbidden' ; exit 1")
+    kube = Kubernetes()
+    kube._kinds = ["configmaps", "deployments.apps"]
+    try:
+        kube.delete({"forge.service": "svc"}, wait=True)
+        assert False, "expected an error"
+    except TaskError, e:
+        assert "Forbidden" in str(e)
+
+def deployment(generation, updated, available, conditions=()):
+    return {"apiVersion": "apps/v1", "kind": "Deployment",
+            "metadata": {"name": "dep", "namespace": "default", "generation": generation},
+            "spec": {"replicas": 2},
+            "status": {"observedGeneration": 2, "replicas": 2, "updatedReplicas": updated,
+                       "availableReplicas": available, "conditions": list(conditions)}}
+
+DEADLINE = {"type": "Progressing", "reason": "ProgressDeadlineExceeded", "message": "too slow"}
+
+def test_rollout():
+    assert rollout("deployment", deployment(2, 2, 2)) == READY
+    assert rollout("deployment", deployment(3, 2, 2)) == PROGRESSING
+    assert rollout("deployment", deployment(2, 1, 1)) == PROGRESSING
+    assert rollout("deployment", deployment(2, 2, 1)) == PROGRESSING
+    assert rollout("deployment", deployment(2, 1, 1, [DEADLINE])) == FAILED
+    assert rollout("daemonset", {"status": {"desiredNumberScheduled": 3, "updatedNumberScheduled": 3,
+                                            "numberAvailable": 2}}) == PROGRESSING
+    assert rollout("configmap", {}) == READY
+
+def fake_watch(monkeypatch, *states):
+    # print each state as kubectl does, then hang like a watch
+    listing = mktree({"states.json": "".join(json.dumps(s, indent=4) + "\n" for s in states)})
+    fakebin(monkeypatch, "kubectl", """
+echo "$@" | grep -q -- "get deployments.apps --watch -ojson --request-timeout=.* -lforge.service=svc" || exit 1
+cat %s/states.json
+sleep 30""" % listing)
+
+def test_wait(monkeypatch):
+    fake_watch(monkeypatch, deployment(2, 1, 1), deployment(2, 2, 1), deployment(2, 2, 2))
+    start = time.time()
+    Kubernetes().wait(["deployment.apps/dep", "configmap/cm"], {"forge.service": "svc"})
+    assert time.time() - start < 10
+
+def test_wait_failed(monkeypatch):
+    fake_watch(monkeypatch, deployment(2, 1, 1), deployment(2, 1, 1, [DEADLINE]))
+    start = time.time()
+    try:
+        Kubernetes().wait(["deployment.apps/dep"], {"forge.service": "svc"})
+        assert False, "expected an error"
+    except TaskError, e:
+        assert "deployment.apps/dep" in str(e)
+    assert time.time() - start < 10
+
 K8S_BAD_TREE = """
 @@k8s/deployment.yaml
 ---
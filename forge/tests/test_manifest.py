@@ -0,0 +1,196 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, yaml
+from collections import OrderedDict
+from forge.kubernetes import HASH
+from forge import manifest
+from forge.manifest import Manifests, RenderStamp, render_key, sync_tree
+from forge import yamlutil
+from forge.util import RecordingEnv
+from .common import mktree
+
+MANIFESTS = """
+@@deployment.yaml
+---
+apiVersion: v1
+kind: Namespace
+metadata:
+  name: ns
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: svc
+  labels:
+    app: svc
+---
+---
+apiVersion: extensions/v1beta1
+kind: Deployment
+metadata: {name: dep, annotations: {forge.version: old}}
+@@
+
+@@other.yaml
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: cm
+@@
+"""
+
+LABELS = OrderedDict((("forge.service", "svc"), ("forge.profile", "default")))
+ANNOTATIONS = OrderedDict((("forge.repo", "repo"), ("forge.version", "1.git")))
+
+def process(tree, **kwargs):
+    directory = mktree(tree)
+    manifests = Manifests(directory, **kwargs)
+    manifests.load()
+    manifests.fixup(LABELS, ANNOTATIONS)
+    manifests.write()
+    return directory, manifests
+
+def test_fixup():
+    directory, manifests = process(MANIFESTS)
+    ns, svc, dep = yamlutil.load(os.path.join(directory, "deployment.yaml"))
+    assert "labels" not in ns["metadata"]
+    assert svc["metadata"]["labels"]["app"] == "svc"
+    assert svc["metadata"]["labels"]["forge.service"] == "svc"
+    assert svc["metadata"]["annotations"]["forge.repo"] == "repo"
+    assert dep["metadata"]["labels"]["forge.profile"] == "default"
+    assert dep["metadata"]["annotations"]["forge.version"] == "1.git"
+    cm, = yamlutil.load(os.path.join(directory, "other.yaml"))
+    assert cm["metadata"]["labels"]["forge.service"] == "svc"
+
+def test_timings():
+    directory, manifests = process(MANIFESTS)
+    assert manifests.timings.keys() == ["load", "label", "write"]
+    assert "load" in manifests.report()
+
+def test_fixup_streamed():
+    directory, manifests = process(MANIFESTS)
+    streamed, _ = process(MANIFESTS, stream_size=0)
+    for name in ("deployment.yaml", "other.yaml"):
+        with open(os.path.join(streamed, name)) as a, open(os.path.join(directory, name)) as b:
+            docs, expected = list(yaml.safe_load_all(a)), list(yaml.safe_load_all(b))
+        # the hashes are computed differently when streaming
+        for doc in docs + expected:
+            anns = doc["metadata"].get("annotations", {})
+            if doc["kind"] != "Namespace":
+                assert anns.pop(HASH)
+        assert docs == expected
+
+LISTED = MANIFESTS + """
+@@list.yaml
+apiVersion: v1
+kind: List
+items:
+- apiVersion: apps/v1
+  kind: Deployment
+  metadata: {name: listed, labels: {name: other}}
+  spec: {template: {metadata: {name: ignored}}}
+- &cm {kind: ConfigMap, metadata: {name: anchored}}
+- *cm
+@@
+"""
+
+def test_resources_streamed(monkeypatch):
+    directory = mktree(LISTED)
+    expected = Manifests(directory)
+    expected.load()
+    monkeypatch.setattr(manifest, "compose_all", None)
+    streamed = Manifests(directory, stream_size=0)
+    streamed.load()
+    assert streamed.resources() == expected.resources()
+    assert "deployment.apps/listed" in streamed.resources()
+
+def test_manifest_hash():
+    directory, manifests = process(MANIFESTS)
+    again, _ = process(MANIFESTS)
+    ns, svc, dep = yamlutil.load(os.path.join(directory, "deployment.yaml"))
+    ns2, svc2, dep2 = yamlutil.load(os.path.join(again, "deployment.yaml"))
+    assert "annotations" not in ns["metadata"]
+    assert svc["metadata"]["annotations"][HASH] == svc2["metadata"]["annotations"][HASH]
+    assert svc["metadata"]["annotations"][HASH] != dep["metadata"]["annotations"][HASH]
+
+TEMPLATES = """
+@@k8s/deployment.yaml
+name: {{service.name}}
+@@
+
+@@k8s/sub/other.yaml
+kind: ConfigMap
+@@
+"""
+
+def test_render_key():
+    directory = os.path.join(mktree(TEMPLATES), "k8s")
+    metadata = {"service": {"name": "svc"}}
+    key = render_key(directory, metadata, LABELS, ANNOTATIONS, {})
+    assert render_key(directory, {"service": {"name": "svc"}}, LABELS, ANNOTATIONS, {}) == key
+    assert render_key(directory, {"service": {"name": "other"}}, LABELS, ANNOTATIONS, {}) != key
+    assert render_key(directory, metadata, LABELS, ANNOTATIONS, {"enabled": True}) != key
+    assert render_key(directory, metadata, LABELS, {"forge.version": "2.git"}, {}) != key
+    assert render_key(directory, dict(metadata, env={"HOME": "/"}), LABELS, ANNOTATIONS, {}) == key
+    with open(os.path.join(directory, "sub", "other.yaml"), "a") as f:
+        f.write("data: {}\n")
+    assert render_key(directory, metadata, LABELS, ANNOTATIONS, {}) != key
+
+def test_sync_tree():
+    source = os.path.join(mktree(TEMPLATES), "k8s")
+    target = os.path.join(mktree(TEMPLATES + "@@k8s/stale.yaml\nkind: Secret\n@@\n"), "k8s")
+    with open(os.path.join(source, "deployment.yaml"), "a") as f:
+        f.write("changed: true\n")
+    unchanged = os.stat(os.path.join(target, "sub", "other.yaml"))
+    assert sorted(sync_tree(source, target)) == ["deployment.yaml", "stale.yaml"]
+    assert sorted(os.listdir(target)) == ["deployment.yaml", "sub"]
+    assert os.stat(os.path.join(target, "sub", "other.yaml")).st_ino == unchanged.st_ino
+    assert open(os.path.join(target, "deployment.yaml")).read().endswith("changed: true\n")
+
+def test_render_stamp():
+    directory = os.path.join(mktree(TEMPLATES), "k8s")
+    stamp = RenderStamp(directory)
+    assert stamp.get("key") is None
+    stamp.put("key", ["configmap/cm"])
+    assert stamp.get("key") == ["configmap/cm"]
+    assert stamp.get("other") is None
+    # tampering with the output invalidates the stamp
+    with open(os.path.join(directory, "deployment.yaml"), "a") as f:
+        f.write("edited: true\n")
+    assert stamp.get("key") is None
+    stamp.put("key", ["configmap/cm"])
+    os.remove(os.path.join(directory, "deployment.yaml"))
+    assert stamp.get("key") is None
+
+def test_render_stamp_env(monkeypatch):
+    directory = os.path.join(mktree(TEMPLATES), "k8s")
+    stamp = RenderStamp(directory)
+    monkeypatch.setenv("FORGE_TEST_USED", "1")
+    env = RecordingEnv(os.environ)
+    assert env.get("FORGE_TEST_USED") == "1"
+    assert env.get("FORGE_TEST_UNSET") is None
+    stamp.put("key", ["configmap/cm"], env)
+    monkeypatch.setenv("FORGE_TEST_OTHER", "2")
+    assert stamp.get("key") == ["configmap/cm"]
+    monkeypatch.setenv("FORGE_TEST_UNSET", "3")
+    assert stamp.get("key") is None
+    monkeypatch.delenv("FORGE_TEST_UNSET")
+    assert stamp.get("key") == ["configmap/cm"]
+    monkeypatch.setenv("FORGE_TEST_USED", "2")
+    assert stamp.get("key") is None
+    # a template that enumerates the environment can't be stamped
+    env = RecordingEnv(os.environ)
+    list(env)
+    stamp.put("key", ["configmap/cm"], env)
+    assert stamp.get("key") is None
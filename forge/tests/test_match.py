@@ -13,7 +13,7 @@
 # limitations under the License.
 
 from forge.match import (
-    compile, match, many, opt, when, choice, one, delay, lazy, trait, MatchError
+    compile, match, many, opt, when, choice, one, delay, lazy, trait, MatchError, Begin, END
 )
 
 class Action(object):
@@ -394,3 +394,103 @@ def test_many_min3():
     assert min3(1, 2, 3) == 1
     assert min3(1, 2, 3, 4) == 1
     assert min3(1, 2, 3, 4, 5) == 1
+
+@match(basestring)
+def cached(x):
+    return "string"
+
+@match("special")
+def cached(x):
+    return "special"
+
+@match([many(int)])
+def cached(x):
+    return "ints"
+
+@match([many(basestring)])
+def cached(x):
+    return "strings"
+
+@match(trait("T"))
+def cached(x):
+    return "trait"
+
+def test_cache(monkeypatch):
+    compiled = cached._compiled
+    steps = []
+    step = compiled._step
+    monkeypatch.setattr(compiled, "_step", lambda dstate, value: steps.append(value) or step(dstate, value))
+    simulated = []
+    simulate = compiled._match
+    monkeypatch.setattr(compiled, "_match", lambda args: simulated.append(args) or simulate(args))
+    for i in range(2):
+        assert cached("a") == "string"
+        assert cached("b") == "string"
+        assert cached("special") == "special"
+        assert cached([1, 2]) == "ints"
+        assert cached([3, 4, 5]) == "ints"
+        assert cached(["a", "b"]) == "strings"
+        assert cached(Traitor()) == "trait"
+    # only new transitions are computed, and traits bypass the DFA
+    assert steps == ["a", "special", Begin(list), 1, 2, END, "a", "b", END]
+    assert [a[0].__class__ for a in simulated] == [Traitor, Traitor]
+    start = compiled.dfa
+    assert set(start.transitions) == set([str, (str, "special"), Begin(list)])
+
+def test_cache_bounded(monkeypatch):
+    import forge.match
+    monkeypatch.setattr(forge.match, "MATCH_CACHE_SIZE", 4)
+    n = compile(when(object, Action("object")))
+    for cls in [type("C%s" % i, (object,), {}) for i in range(10)]:
+        assert n.match(cls()).label == "object"
+        assert len(n.dfa.transitions) <= 4
+
+AMBIGUOUS = compile(choice(when(one(int, object), Action("int, object")),
+                           when(one(choice(int, float), object), Action("number, object")),
+                           when(one(int, str), Action("int, str"))))
+
+def test_dfa_ambiguous():
+    assert AMBIGUOUS.match(1, "a").label == "int, str"
+    assert AMBIGUOUS.match(1.0, "a").label == "number, object"
+    for i in range(2):
+        try:
+            AMBIGUOUS.match(1, 2)
+            assert False, "expected MatchError"
+        except MatchError, e:
+            assert "match multiple actions" in str(e)
+    # the ambiguity is found when the DFA state is built
+    assert sorted(a.label for a in AMBIGUOUS.dfa.transitions[int].transitions[int].nearest) == \
+        ["int, object", "number, object"]
+
+def test_dfa_agrees():
+    n = compile(choice(when(one(object), Action("object")),
+                       when(one(Foo), Action("Foo")),
+                       when(one(FOO), Action("FOO")),
+                       when(one(Foo, many(int)), Action("Foo, ints")),
+                       when(one(Bar, many(object)), Action("Bar, objects")),
+                       when(one([many(int)], opt(str)), Action("ints, str")),
+                       when(one(3, many(3)), Action("threes"))))
+    for args in [(Foo(),), (Bar(),), (FOO,), (Foo(), 1, 2), (Bar(), 1, 2), (Bar(), "a"), ([1, 2],), ([1], "x"),
+                 (3, 3), (3, 4), (), ([],), ([1], 2)]:
+        try:
+            expected = n._match(args)
+        except MatchError, e:
+            expected = str(e)
+        try:
+            actual = n.match(*args)
+        except MatchError, e:
+            actual = str(e)
+        assert actual == expected, args
+
+@match(lazy("Branch"), many(lazy("Branch")))
+def depth(branch, *rest):
+    return 1 + max([depth(*b.children) if b.children else 0 for b in (branch,) + rest])
+
+class Branch(object):
+
+    def __init__(self, *children):
+        self.children = children
+
+def test_recursive_lazy():
+    assert depth(Branch()) == 1
+    assert depth(Branch(Branch(), Branch(Branch()))) == 3
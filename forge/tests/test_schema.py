@@ -17,6 +17,8 @@ from collections import OrderedDict
 from forge.schema import Any, Scalar, Schema, Class, Field, String, Integer, Float, Sequence, Map, Union, Constant, \
     SchemaError, OMIT, Boolean
 from forge import util
+from forge.match import match
+from yaml import ScalarNode
 
 class Klass(object):
 
@@ -226,3 +228,103 @@ def test_union_error(schema, input, error):
         assert False, "expected error: %s" % error
     except SchemaError, e:
         assert error in str(e)
+
+def plain(value):
+    "Reduce a loaded value to builtin types so that it can be compared."
+    if isinstance(value, dict):
+        return dict((k, plain(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    elif hasattr(value, "__dict__"):
+        return value.__class__, plain(vars(value))
+    else:
+        return value
+
+def outcome(load, node):
+    try:
+        return "ok", plain(load(node))
+    except (SchemaError, TypeError), e:
+        return e.__class__, str(e)
+
+def assert_compiled(schema, input):
+    "Check that the compiled loader agrees with dispatch, including errors."
+    for node in yaml.compose_all(input):
+        assert outcome(schema.compile(), node) == outcome(schema.load, node)
+
+@pytest.mark.parametrize("cls,input,error", SCALAR_VALIDATIONS)
+def test_compiled_scalar_validation(cls, input, error):
+    assert_compiled(cls(), input)
+
+@pytest.mark.parametrize("schema,input,error", UNION_ERRORS)
+def test_compiled_union_error(schema, input, error):
+    assert_compiled(schema, input)
+
+COMPILED = (
+    (Any(), "[1, two, 3.0, {four: five, 6.0: 7, ate: 8.0}, null, true, 2017-01-01]"),
+    (Scalar(), "pi\n---\n3\n---\n3.5\n---\n[1]\n---\nnull"),
+    (Sequence(Integer()), "[1, 2, three]\n---\n{a: b}\n---\na"),
+    (Map(Float()), "{a: 1, b: 2.0}\n---\n[1]\n---\n{a: b}"),
+    (Constant("a"), "a\n---\nb\n---\n1\n---\nnull\n---\n{}"),
+    (Constant(3, Integer()), "3\n---\n'3'"),
+    (Boolean(), "true\n---\nFalse\n---\nyes"),
+    (Class("foo", Klass, Field("foo-bar", String(), "foo_bar"), Field("baz", Integer(), default=None)),
+     "{foo-bar: x}\n---\n{baz: 3}\n---\n{foo-bar: x, moo: 1}\n---\n[]\n---\n{foo-bar: [x]}"),
+    (Class("foo", "docs", Field("foo", String()), strict=False), "{foo: bar, baz: [1, {a: b}]}\n---\n{}"),
+    (ABC_STR_CONSTANTS, "1\n---\n1.0\n---\ntrue\n---\nb\n---\nc\n---\n{a: y}\n---\nd\n---\n[]")
+)
+
+@pytest.mark.parametrize("schema,input", COMPILED)
+def test_compiled(schema, input):
+    assert_compiled(schema, input)
+
+def test_compiled_constructor_error():
+    def constructor(**kwargs):
+        raise SchemaError("bad %s" % kwargs["foo"])
+    assert_compiled(Class("foo", constructor, Field("foo", String())), "\n\n{foo: bar}")
+
+def test_compiled_descriptors():
+    from forge import config, service_info
+    assert_compiled(service_info.SERVICE, """
+name: hello
+requires: [auth, db]
+containers:
+- Dockerfile
+- dockerfile: sidecar/Dockerfile
+  args: {VERSION: 1, BRANCH: master}
+  builder: imagebuilder
+  rebuild: {root: /src, sources: [a, b]}
+profiles:
+  default: {replicas: 1, endpoint: /hello}
+istio: {enabled: true, includeIPRanges: [10.0.0.0/8]}
+custom: {any: [thing]}
+---
+name: hello
+containers:
+- dockerfile: Dockerfile
+  builder: kaniko
+---
+name: hello
+istio: maybe
+""")
+    assert_compiled(config.CONFIG, """
+registry: {type: gcr, url: gcr.io, project: proj}
+profiles:
+  dev: {search-path: [a, b], registry: {type: local}}
+---
+docker-repo: nothing
+---
+registry: {type: docker, url: example.com, namespace: ns}
+docker-repo: example.com/ns
+""")
+
+def test_compile_cached():
+    s = Sequence(String())
+    assert s.compile() is s.compile()
+
+def test_compile_override():
+    class Upper(String):
+        @match(ScalarNode)
+        def decode(self, node):
+            return node.value.upper()
+    s = Sequence(Upper())
+    assert s.load("test", "[a, b]") == ["A", "B"]
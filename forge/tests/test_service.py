@@ -13,9 +13,11 @@
 # limitations under the License.
 
 import os, pytest
+from tempfile import mkdtemp
+from forge import service
 from forge.core import Forge
-from forge.service import load_service_yamls, Discovery
-from forge.tasks import sh, TaskError
+from forge.service import is_service_descriptor, load_service_yaml, load_service_yamls, Discovery
+from forge.tasks import sh, task, TaskError
 from .common import mktree
 
 def ERROR(message, content):
@@ -311,3 +313,128 @@ def test_nondirectory():
         Discovery(Forge()).search(__file__)
     except TaskError, e:
         assert "not a directory" in str(e)
+
+CACHED_YAML = """
+@@service.yaml
+name: {{env.FORGE_TEST_NAME}}
+{% if branch == "dev" %}
+profiles: {dev: {replicas: 1}}
+{% endif %}
+@@
+"""
+
+@pytest.fixture
+def service_cache(monkeypatch):
+    monkeypatch.setattr(service, "SERVICE_CACHE", mkdtemp())
+    monkeypatch.setattr(service, "_LOADED", {})
+    calls = []
+    def counting(*args, **kwargs):
+        calls.append(args)
+        return load_service_yamls(*args, **kwargs)
+    monkeypatch.setattr(service, "load_service_yamls", counting)
+    return calls
+
+def test_load_service_yaml_cached(monkeypatch, service_cache):
+    path = os.path.join(mktree(CACHED_YAML), "service.yaml")
+    monkeypatch.setenv("FORGE_TEST_NAME", "cached")
+    assert load_service_yaml(path, branch="master")["name"] == "cached"
+    assert load_service_yaml(path, branch="master")["name"] == "cached"
+    assert len(service_cache) == 1
+
+    # a new run uses the on disk cache
+    service._LOADED.clear()
+    assert load_service_yaml(path, branch="master")["name"] == "cached"
+    assert len(service_cache) == 1
+
+    # the results are independent copies
+    load_service_yaml(path, branch="master")["name"] = "changed"
+    assert load_service_yaml(path, branch="master")["name"] == "cached"
+
+def test_load_service_yaml_invalidated(monkeypatch, service_cache):
+    path = os.path.join(mktree(CACHED_YAML), "service.yaml")
+    monkeypatch.setenv("FORGE_TEST_NAME", "cached")
+    load_service_yaml(path, branch="master")
+
+    service._LOADED.clear()
+    monkeypatch.setenv("FORGE_TEST_UNUSED", "whatever")
+    load_service_yaml(path, branch="master")
+    assert len(service_cache) == 1
+
+    service._LOADED.clear()
+    monkeypatch.setenv("FORGE_TEST_NAME", "renamed")
+    assert load_service_yaml(path, branch="master")["name"] == "renamed"
+    assert len(service_cache) == 2
+
+    assert "profiles" in load_service_yaml(path, branch="dev")
+    assert len(service_cache) == 3
+
+    with open(path, "a") as f:
+        f.write("requires: [other]\n")
+    assert load_service_yaml(path, branch="master")["requires"] == ["other"]
+    assert len(service_cache) == 4
+
+def test_load_service_yaml_warnings(monkeypatch, service_cache):
+    path = os.path.join(mktree("@@service.yaml\nname: svc{{nosuch}}\n@@\n"), "service.yaml")
+    echoed = []
+    monkeypatch.setattr(task, "echo", staticmethod(echoed.append))
+    assert load_service_yaml(path)["name"] == "svc"
+    assert len(echoed) == 1 and "nosuch" in echoed[0]
+    service._LOADED.clear()
+    assert load_service_yaml(path)["name"] == "svc"
+    assert len(service_cache) == 1
+    assert echoed[1:] == echoed[:1]
+
+def test_load_service_yaml_version(monkeypatch, service_cache):
+    path = os.path.join(mktree(CACHED_YAML), "service.yaml")
+    monkeypatch.setenv("FORGE_TEST_NAME", "cached")
+    load_service_yaml(path, branch="master")
+    service._LOADED.clear()
+    monkeypatch.setattr(service, "SERVICE_CACHE_VERSION", "new")
+    load_service_yaml(path, branch="master")
+    assert len(service_cache) == 2
+
+def test_load_service_yaml_pruned(monkeypatch, service_cache):
+    monkeypatch.setattr(service, "SERVICE_CACHE_SIZE", 4)
+    path = os.path.join(mktree(CACHED_YAML), "service.yaml")
+    for name in "abcd":
+        monkeypatch.setenv("FORGE_TEST_NAME", name)
+        load_service_yaml(path, branch=name)
+        assert len(os.listdir(service.SERVICE_CACHE)) <= 4
+    # the least recently used entries went first
+    service._LOADED.clear()
+    monkeypatch.setenv("FORGE_TEST_NAME", "d")
+    load_service_yaml(path, branch="d")
+    assert len(service_cache) == 4
+
+DESCRIPTORS = """
+@@service/service.yaml
+name: svc
+containers:
+- dockerfile: Dockerfile
+@@
+
+@@resource/service.yaml
+apiVersion: v1
+kind: Service
+metadata:
+  name: {{build.name}}
+spec:
+  ports: [{port: 80}]
+@@
+
+@@templated/service.yaml
+name: {{env.NAME}}
+{% if branch %}
+@@
+
+@@list/service.yaml
+- apiVersion: v1
+@@
+"""
+
+def test_is_service_descriptor():
+    root = mktree(DESCRIPTORS)
+    assert is_service_descriptor(os.path.join(root, "service", "service.yaml"))
+    assert not is_service_descriptor(os.path.join(root, "resource", "service.yaml"))
+    assert is_service_descriptor(os.path.join(root, "templated", "service.yaml"))
+    assert is_service_descriptor(os.path.join(root, "list", "service.yaml"))
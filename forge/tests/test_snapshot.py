@@ -0,0 +1,56 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json, os, time
+from tempfile import mkdtemp
+from forge.snapshot import Snapshot
+
+def item(name, uid=None):
+    md = {"name": name, "namespace": "default"}
+    if uid:
+        md["uid"] = uid
+    return {"kind": "ConfigMap", "metadata": md}
+
+def test_snapshot_events():
+    snapshot = Snapshot(os.path.join(mkdtemp(), "snapshot.json"))
+    snapshot.replace("configmaps", [item("a", "1"), item("b")], "10")
+    snapshot.update("configmaps", "ADDED", item("c", "3"), "11")
+    snapshot.update("configmaps", "MODIFIED", dict(item("a", "1"), data={"x": "y"}), "12")
+    snapshot.update("configmaps", "DELETED", item("b"), "13")
+    assert snapshot.resource_version("configmaps") == "13"
+    assert sorted((i["metadata"]["name"], i.get("data")) for i in snapshot.items()) == \
+        [("a", {"x": "y"}), ("c", None)]
+
+def test_snapshot_duplicates():
+    snapshot = Snapshot(os.path.join(mkdtemp(), "snapshot.json"))
+    snapshot.replace("deployments.apps", [item("a", "1")])
+    snapshot.replace("deployments.extensions", [item("a", "1")])
+    assert len(snapshot.items()) == 1
+
+def test_snapshot_freshness():
+    path = os.path.join(mkdtemp(), "nested", "snapshot.json")
+    assert Snapshot.load(path, 60) is None
+    snapshot = Snapshot(path)
+    snapshot.replace("configmaps", [item("a", "1")], "10")
+    snapshot.save()
+    loaded = Snapshot.load(path, 60)
+    assert [i["metadata"]["name"] for i in loaded.items()] == ["a"]
+    assert loaded.resource_version("configmaps") == "10"
+
+    with open(path) as f:
+        saved = json.load(f)
+    saved["time"] = time.time() - 120
+    with open(path, "write") as f:
+        json.dump(saved, f)
+    assert Snapshot.load(path, 60) is None
@@ -210,6 +210,28 @@ def test_sh_cwd_env():
     assert result.command.startswith("[/tmp] ")
     assert result.command[7:].startswith("FOO=bar ")
 
+def test_sh_input():
+    assert "hello" == sh("cat", input="hello").output
+
+def test_sh_input_large():
+    data = "x"*(1024*1024) + "\n"
+    assert data == sh("cat", input=data).output
+
+def test_sh_output_handler():
+    lines = []
+    result = sh("seq", "100", output_handler=lines.append)
+    assert lines == ["%s\n" % i for i in range(1, 101)]
+    # only the tail of the output is kept
+    assert result.output == "".join(lines[-10:])
+
+def test_sh_output_handler_stop():
+    def handler(line):
+        raise StopIteration()
+    start = time.time()
+    result = sh("sh", "-c", "echo stop; sleep 10", output_handler=handler)
+    assert result.output == "stop\n"
+    assert time.time() - start < 5
+
 def test_get():
     response = get("https://httpbin.org/get")
     assert response.json()["url"] == "https://httpbin.org/get"
@@ -0,0 +1,153 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest, yaml
+from StringIO import StringIO
+from forge import yamlbackend
+from forge.yamlbackend import backend, compose, compose_all, parse, safe_load, safe_load_all
+
+libyaml = pytest.mark.skipif(yamlbackend.CLoader is None, reason="libyaml is not available")
+
+DOCS = """
+apiVersion: v1
+kind: Service
+metadata: {name: hello, labels: {app: hello}}
+spec:
+  ports:
+  - port: 80
+    targetPort: &port 8080
+  - port: 443
+    targetPort: *port
+---
+kind: ConfigMap
+data:
+  text: |
+    multiple
+    lines
+  empty:
+"""
+
+BAD = """
+kind: ConfigMap
+---
+a: [1, 2
+b: 3
+"""
+
+def named(content, name="test.yaml"):
+    stream = StringIO(content)
+    stream.name = name
+    return stream
+
+def both(monkeypatch, function, *args):
+    "Return the results (or error messages) of function with each backend."
+    results = []
+    for name in ("python", "libyaml"):
+        monkeypatch.setattr(yamlbackend, "BACKEND", name)
+        try:
+            results.append(function(*[named(a) if isinstance(a, str) else a for a in args]))
+        except yaml.YAMLError, e:
+            results.append((e.__class__, str(e)))
+    return results
+
+def test_backend_auto(monkeypatch):
+    monkeypatch.setattr(yamlbackend, "CLoader", None)
+    assert backend("auto") == "python"
+    assert backend("python") == "python"
+
+def test_backend_missing(monkeypatch):
+    monkeypatch.setattr(yamlbackend, "CLoader", None)
+    with pytest.raises(ValueError) as e:
+        backend("libyaml")
+    assert "libyaml is not available" in str(e.value)
+
+def test_backend_unknown():
+    with pytest.raises(ValueError):
+        backend("fast")
+
+def test_fallback(monkeypatch):
+    monkeypatch.setattr(yamlbackend, "CLoader", None)
+    monkeypatch.setattr(yamlbackend, "CSafeLoader", None)
+    monkeypatch.setattr(yamlbackend, "BACKEND", "auto")
+    assert yaml.serialize_all(compose_all(DOCS)) == yaml.serialize_all(yaml.compose_all(DOCS))
+    assert list(safe_load_all(DOCS)) == list(yaml.safe_load_all(DOCS))
+
+@libyaml
+def test_backend_libyaml():
+    assert backend("auto") == "libyaml"
+    assert backend("libyaml") == "libyaml"
+
+def events(stream):
+    return [(e.__class__, getattr(e, "anchor", None), getattr(e, "tag", None), getattr(e, "value", None))
+            for e in parse(stream)]
+
+@libyaml
+def test_same_results(monkeypatch):
+    python, libyaml = both(monkeypatch, lambda s: yaml.serialize_all(compose_all(s)), DOCS)
+    assert python == libyaml
+    python, libyaml = both(monkeypatch, events, DOCS)
+    assert python == libyaml
+    python, libyaml = both(monkeypatch, lambda s: list(safe_load_all(s)), DOCS)
+    assert python == libyaml
+
+@libyaml
+def test_same_errors(monkeypatch):
+    for function in (compose_all, events, lambda s: list(safe_load_all(s))):
+        python, libyaml = both(monkeypatch, function, BAD)
+        assert python == libyaml
+        assert "expected ',' or ']', but got ':'" in python[1]
+        assert 'in "test.yaml", line 5, column 2' in python[1]
+    python, libyaml = both(monkeypatch, safe_load, BAD)
+    assert python == libyaml
+    assert "expected a single document" in python[1]
+
+@libyaml
+def test_same_errors_string(monkeypatch):
+    python, libyaml = both(monkeypatch, lambda s: compose(s.getvalue()), "a: b: c")
+    assert python == libyaml
+    assert "^" in python[1]
+
+@libyaml
+def test_parse_error_resumes(monkeypatch):
+    monkeypatch.setattr(yamlbackend, "BACKEND", "libyaml")
+    seen = []
+    with pytest.raises(yaml.YAMLError):
+        for event in parse(named(BAD)):
+            seen.append(event.__class__)
+    monkeypatch.setattr(yamlbackend, "BACKEND", "python")
+    expected = []
+    with pytest.raises(yaml.YAMLError):
+        for event in parse(named(BAD)):
+            expected.append(event.__class__)
+    assert seen == expected
+
+class Unseekable(object):
+
+    def __init__(self, content):
+        self.stream = StringIO(content)
+        self.name = "pipe"
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def tell(self):
+        raise IOError("illegal seek")
+
+@libyaml
+def test_unseekable(monkeypatch):
+    monkeypatch.setattr(yamlbackend, "BACKEND", "libyaml")
+    with pytest.raises(yaml.YAMLError) as e:
+        compose_all(Unseekable(BAD))
+    assert 'in "pipe", line 5, column 2' in str(e.value)
+    assert len(compose_all(Unseekable(DOCS))) == 2
@@ -39,6 +39,11 @@ def test_map_view_setitem_none():
     v["foo"] = None
     assert serialize(as_node(v)) == "{foo: null}\n"
 
+def test_map_view_setitem_existing():
+    v = view(compose("{a: 1, b: 2, c: 3}"))
+    v["b"] = 4
+    assert serialize(as_node(v)) == "{a: 1, b: 4, c: 3}\n"
+
 def test_sequence_view_getitem():
     v = view(compose("[item]"))
     assert v[0] == "item"
@@ -109,3 +114,16 @@ def test_load_filename():
 def test_load_content():
     v = load("foo", "a: b")
     assert v[0]["a"] == "b"
+
+def test_top_level_keys():
+    assert list(top_level_keys("a: 1\nb: {c: [1, {d: 2}]}\ne:\n- f: 3\n---\ng: 4\n")) == ["a", "b", "e"]
+    assert list(top_level_keys("base: &base {x: 1}\nother: *base\n? [complex]\n: key\nlast: 2\n")) == \
+        ["base", "other", "last"]
+    assert list(top_level_keys("- a: 1\n")) == []
+    assert list(top_level_keys("scalar\n")) == []
+    assert list(top_level_keys("")) == []
+
+def test_top_level_keys_lazy():
+    keys = top_level_keys("a: 1\nb: 2\nc: {{jinja}}\n")
+    assert next(keys) == "a"
+    assert next(keys) == "b"
@@ -59,3 +59,33 @@ def search_parents(name, start=None, root=False):
                 return candidate
         path = os.path.dirname(path)
     return rootiest
+
+class RecordingEnv(collections.Mapping):
+
+    """
+    A read only view of the environment that records the variables a
+    template looks up, including those that aren't set, so that a
+    cached render can be reused as long as they are unchanged. If the
+    template enumerates the environment everything is marked as used.
+    Lookups may come from several threads.
+    """
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.used = {}
+        self.everything = False
+
+    def __getitem__(self, name):
+        value = self.environ.get(name)
+        self.used[name] = value
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __iter__(self):
+        self.everything = True
+        return iter(self.environ)
+
+    def __len__(self):
+        self.everything = True
+        return len(self.environ)
@@ -0,0 +1,125 @@
+# Copyright 2017 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The yaml backend used to read yaml throughout forge. When libyaml is
+available it is used to parse and compose, since it is many times
+faster than the pure python implementation. Errors are always reported
+by the pure python implementation, so that they read the same whichever
+backend is in use. Writing yaml is left to the pure python emitter, so
+that output (and the hashes computed from it) doesn't depend on whether
+libyaml is installed.
+"""
+
+import os, yaml
+from StringIO import StringIO
+
+try:
+    from yaml import CLoader, CSafeLoader
+except ImportError:
+    CLoader = CSafeLoader = None
+
+# the backend to use: auto (libyaml when it is available), libyaml or python
+BACKEND = os.environ.get("FORGE_YAML_BACKEND", "auto")
+
+BACKENDS = ("auto", "libyaml", "python")
+
+def backend(name=None):
+    """
+    Return the backend that is actually used for the requested one,
+    which defaults to BACKEND.
+    """
+    name = name or BACKEND
+    if name not in BACKENDS:
+        raise ValueError("unknown yaml backend %r, expecting one of: %s" % (name, ", ".join(BACKENDS)))
+    if name == "python" or (name == "auto" and CLoader is None):
+        return "python"
+    if CLoader is None:
+        raise ValueError("the libyaml yaml backend was requested, but libyaml is not available")
+    return "libyaml"
+
+def _rewindable(stream):
+    """
+    Return a stream that can be read a second time from where it
+    started, so that a libyaml failure can be redone in python.
+    """
+    if not hasattr(stream, "read"):
+        return stream
+    if hasattr(stream, "seek"):
+        try:
+            stream.tell()
+            return stream
+        except IOError:
+            pass
+    copy = StringIO(stream.read())
+    if hasattr(stream, "name"):
+        copy.name = stream.name
+    return copy
+
+def _start(stream):
+    return stream.tell() if hasattr(stream, "read") else None
+
+def _rewind(stream, start):
+    if start is not None:
+        stream.seek(start)
+
+def _eager(function, fast, slow, stream):
+    if backend() == "python":
+        return function(stream, Loader=slow)
+    stream = _rewindable(stream)
+    start = _start(stream)
+    try:
+        return function(stream, Loader=fast)
+    except yaml.YAMLError:
+        _rewind(stream, start)
+        return function(stream, Loader=slow)
+
+def _lazy(function, fast, slow, stream):
+    if backend() == "python":
+        for item in function(stream, Loader=slow):
+            yield item
+        return
+    stream = _rewindable(stream)
+    start = _start(stream)
+    count = 0
+    try:
+        for item in function(stream, Loader=fast):
+            yield item
+            count += 1
+    except yaml.YAMLError:
+        # pick up where libyaml left off, which raises the python error
+        _rewind(stream, start)
+        for idx, item in enumerate(function(stream, Loader=slow)):
+            if idx >= count:
+                yield item
+
+def parse(stream):
+    "Parse a yaml stream, producing events."
+    return _lazy(yaml.parse, CLoader, yaml.Loader, stream)
+
+def compose(stream):
+    "Compose the single document of a yaml stream into a node."
+    return _eager(yaml.compose, CLoader, yaml.Loader, stream)
+
+def compose_all(stream):
+    "Compose the documents of a yaml stream into a list of nodes."
+    return _eager(lambda s, Loader: list(yaml.compose_all(s, Loader=Loader)), CLoader, yaml.Loader, stream)
+
+def safe_load(stream):
+    "Load the single document of a yaml stream into python objects."
+    return _eager(yaml.load, CSafeLoader, yaml.SafeLoader, stream)
+
+def safe_load_all(stream):
+    "Load the documents of a yaml stream into python objects."
+    return _lazy(yaml.load_all, CSafeLoader, yaml.SafeLoader, stream)
@@ -12,9 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from yaml import ScalarNode, SequenceNode, MappingNode, CollectionNode, Node, compose, compose_all, serialize, \
-    serialize_all
+from yaml import ScalarNode, SequenceNode, MappingNode, CollectionNode, Node, serialize, serialize_all, AliasEvent, \
+    CollectionEndEvent, CollectionStartEvent, DocumentStartEvent, MappingStartEvent, ScalarEvent
 from forge.match import choice, match, many
+from forge.yamlbackend import compose, compose_all, parse
 from StringIO import StringIO
 
 from .schema import _scalar2py
@@ -146,13 +147,14 @@ class MapView(View):
     def __setitem__(self, key, value):
         value = as_node(value)
         values = []
+        found = False
         for k, v in self.node.value:
-            if k.value == key:
+            if k.value == key and not found:
                 values.append((k, value))
-                break
+                found = True
             else:
                 values.append((k, v))
-        else:
+        if not found:
             values.append((as_node(key), value))
         self.node.value = values
 
@@ -200,3 +202,80 @@ def _load(stream):
     for nd in compose_all(stream):
         results.append(view(nd, LEAF_AS_PYTHON))
     return results
+
+def top_level_keys(stream):
+    """
+    Generate the scalar keys of the first document of a yaml stream,
+    if it is a mapping. The stream is parsed lazily and values are
+    skipped over as events without being composed, so a caller that
+    stops early only pays for what it has read.
+    """
+    depth = 0
+    position = 0
+    for event in parse(stream):
+        if isinstance(event, CollectionStartEvent):
+            if depth == 0 and not isinstance(event, MappingStartEvent):
+                return
+            depth += 1
+        elif isinstance(event, CollectionEndEvent):
+            depth -= 1
+            if depth == 0:
+                return
+            if depth == 1:
+                position += 1
+        elif isinstance(event, (ScalarEvent, AliasEvent)):
+            if depth == 0:
+                return
+            if depth == 1:
+                if position % 2 == 0 and isinstance(event, ScalarEvent):
+                    yield event.value
+                position += 1
+
+def _skip(event, events, keys, anchors):
+    # anchored nodes are skimmed in case an alias refers to them
+    if getattr(event, "anchor", None) and not isinstance(event, AliasEvent):
+        _skim(event, events, keys, anchors)
+    elif isinstance(event, CollectionStartEvent):
+        for item in events:
+            if isinstance(item, CollectionEndEvent):
+                return
+            _skip(item, events, keys, anchors)
+
+def _skim(event, events, keys, anchors):
+    if isinstance(event, AliasEvent):
+        return anchors.get(event.anchor)
+    if isinstance(event, ScalarEvent):
+        result = event.value
+    elif isinstance(event, MappingStartEvent):
+        result = {}
+        for key in events:
+            if isinstance(key, CollectionEndEvent):
+                break
+            value = next(events)
+            if isinstance(key, ScalarEvent) and key.value in keys:
+                result[key.value] = _skim(value, events, keys, anchors)
+            else:
+                _skip(key, events, keys, anchors)
+                _skip(value, events, keys, anchors)
+    else:
+        result = []
+        for item in events:
+            if isinstance(item, CollectionEndEvent):
+                break
+            result.append(_skim(item, events, keys, anchors))
+    if event.anchor:
+        anchors[event.anchor] = result
+    return result
+
+def skim(stream, keys):
+    """
+    Generate a skeleton of each document of a yaml stream, with
+    mappings as dicts of just the entries for the given keys (at any
+    depth), sequences as lists and scalars as their string values.
+    The stream is parsed as events and never composed, so only the
+    skeleton is held in memory.
+    """
+    events = iter(parse(stream))
+    for event in events:
+        if isinstance(event, DocumentStartEvent):
+            yield _skim(next(events), events, keys, {})